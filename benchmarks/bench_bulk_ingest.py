@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# /// script
+# requires-python = ">=3.10"
+# dependencies = [
+#     "fastapi>=0.109.0",
+#     "uvicorn>=0.27.0",
+#     "pydantic>=2.0.0",
+#     "numpy>=1.26.0",
+# ]
+# ///
+"""
+Claude Code Usage Tracker - API サーバーの受信スループット 負荷テスト
+同じイベントを3通りの経路で送り、サーバーが受け付けた events/sec を比較する。
+
+  single (new conn) : POST /api/events に1件ずつ。毎回接続し直す（Hook が1回ずつ送る場合と同じ）
+  single (keep-alive): POST /api/events に1件ずつ。接続は使い回す
+  bulk              : POST /api/events/bulk に --bulk-size 行ずつの gzip NDJSON。接続は使い回す
+
+各経路とも --concurrency 本のスレッドが並列に送る。リクエスト本文（JSON / gzip）は計測前に作っておく。
+--url を指定しなければ server/main.py を uvicorn で空きポートに起動し、終了時に止める。
+
+Usage:
+    uv run benchmarks/bench_bulk_ingest.py [--events 100000] [--single-events 5000] [--bulk-size 1000] [--concurrency 8]
+    uv run benchmarks/bench_bulk_ingest.py --url https://your-api.example.com --api-key xxx
+"""
+
+import argparse
+import gzip
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from urllib.parse import urlsplit
+
+SERVER_DIR = Path(__file__).resolve().parent.parent / "plugin" / "usage-tracker" / "server"
+
+EVENT_TYPES = ["PreToolUse", "PostToolUse", "PostToolUse", "UserPromptSubmit", "SessionStart", "SubagentStop", "Stop"]
+TOOLS = ["Read", "Edit", "Bash", "Grep", "Task", "mcp__github__get_issue", "NotebookEdit"]
+
+
+def make_event(i: int, now: datetime) -> bytes:
+    tool = TOOLS[i % len(TOOLS)]
+    return json.dumps({
+        "event_id": f"{i:032x}",
+        "event_type": EVENT_TYPES[i % len(EVENT_TYPES)],
+        "timestamp": (now - timedelta(seconds=i % 86400)).isoformat(),
+        "user_id": f"user{i % 40}@example.com",
+        "team_id": f"team-{i % 3}",
+        "project": f"project-{i % 12}",
+        "session_id": f"session-{i // 50}",
+        "tool_name": tool,
+        "categories": {
+            "skill": tool.startswith("Notebook"),
+            "subagent": tool == "Task",
+            "mcp": tool.startswith("mcp__"),
+            "command": tool == "Bash",
+            "file_operation": tool in ("Read", "Edit", "Grep"),
+        },
+        "success": True,
+        "output_length": (i * 7919) % 20000,
+        "metadata": {"cwd": "/home/user/project", "permission_mode": "default", "model": "sonnet"},
+    }).encode()
+
+
+# ==============================================================================
+# サーバー
+# ==============================================================================
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextmanager
+def local_server(capacity: int):
+    """server/main.py を uvicorn で起動する（認証なし）"""
+    port = _free_port()
+    env = dict(os.environ, USAGE_TRACKER_API_KEY="", USAGE_TRACKER_MAX_EVENTS=str(capacity))
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", "--no-access-log"],
+        cwd=SERVER_DIR, env=env,
+    )
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+                conn.request("GET", "/health")
+                conn.getresponse().read()
+                conn.close()
+                break
+            except OSError:
+                if proc.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("server did not start")
+                time.sleep(0.1)
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+# ==============================================================================
+# クライアント
+# ==============================================================================
+
+class Sender:
+    """1スレッド分の送信。keep_alive=False なら1リクエストごとに接続し直す。"""
+
+    def __init__(self, base_url: str, api_key: str, keep_alive: bool):
+        url = urlsplit(base_url)
+        self.cls = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        self.netloc = url.netloc
+        self.prefix = url.path.rstrip("/")
+        self.keep_alive = keep_alive
+        self.headers = {"Content-Type": "application/json"}
+        if api_key:
+            self.headers["Authorization"] = f"Bearer {api_key}"
+        self.conn = None
+
+    def post(self, path: str, body: bytes, headers: dict | None = None) -> dict:
+        if self.conn is None:
+            self.conn = self.cls(self.netloc, timeout=60)
+        self.conn.request("POST", self.prefix + path, body=body, headers={**self.headers, **(headers or {})})
+        response = self.conn.getresponse()
+        data = response.read()
+        if not self.keep_alive or response.will_close:
+            self.close()
+        if response.status != 200:
+            raise RuntimeError(f"{path} returned {response.status}: {data[:200]!r}")
+        return json.loads(data)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def run_parallel(work: list, concurrency: int, send) -> float:
+    """work を concurrency 本のスレッドに分けて send(sender_index, item) し、経過秒数を返す"""
+    chunks = [work[i::concurrency] for i in range(concurrency)]
+    errors = []
+
+    def worker(index: int):
+        try:
+            for item in chunks[index]:
+                send(index, item)
+        except Exception as e:  # noqa: BLE001 - 集計して最後に表示する
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    if errors:
+        raise errors[0]
+    return elapsed
+
+
+def bench_single(base_url: str, args, events: list[bytes], keep_alive: bool) -> float:
+    senders = [Sender(base_url, args.api_key, keep_alive) for _ in range(args.concurrency)]
+    elapsed = run_parallel(events, args.concurrency, lambda i, body: senders[i].post("/api/events", body))
+    for s in senders:
+        s.close()
+    return len(events) / elapsed
+
+
+def bench_bulk(base_url: str, args, events: list[bytes]) -> tuple[float, float]:
+    """(events/sec, 1イベントあたりの送信バイト数)"""
+    bodies = [gzip.compress(b"\n".join(events[i:i + args.bulk_size]) + b"\n", compresslevel=6)
+              for i in range(0, len(events), args.bulk_size)]
+    senders = [Sender(base_url, args.api_key, keep_alive=True) for _ in range(args.concurrency)]
+    headers = {"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"}
+    accepted = [0] * args.concurrency
+
+    def send(i: int, body: bytes):
+        accepted[i] += senders[i].post("/api/events/bulk", body, headers)["accepted"]
+
+    elapsed = run_parallel(bodies, args.concurrency, send)
+    for s in senders:
+        s.close()
+    if sum(accepted) != len(events):
+        raise RuntimeError(f"bulk accepted {sum(accepted)} of {len(events)} events")
+    return len(events) / elapsed, sum(map(len, bodies)) / len(events)
+
+
+def run(base_url: str, args):
+    now = datetime.now(timezone.utc)
+    events = [make_event(i, now) for i in range(args.events)]
+    single = events[:args.single_events]
+
+    # 初回リクエストのコスト（import・接続確立）を計測から外す
+    Sender(base_url, args.api_key, keep_alive=False).post("/api/events", events[0])
+
+    results = [
+        ("single (new conn)", len(single), bench_single(base_url, args, single, keep_alive=False), len(events[0])),
+        ("single (keep-alive)", len(single), bench_single(base_url, args, single, keep_alive=True), len(events[0])),
+    ]
+    bulk_rate, bulk_bytes = bench_bulk(base_url, args, events)
+    results.append((f"bulk ({args.bulk_size} lines, gzip)", len(events), bulk_rate, bulk_bytes))
+
+    base = results[0][2]
+    print()
+    print(f"Ingest throughput ({args.concurrency} client threads, {base_url})")
+    print(f"  {'path':<26} {'events':>8} {'events/sec':>12} {'bytes/event':>12} {'vs single':>10}")
+    for name, count, rate, size in results:
+        print(f"  {name:<26} {count:>8,} {rate:>12,.0f} {size:>12,.0f} {rate / base:>9.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="受信スループット 負荷テスト")
+    parser.add_argument("--url", default="", help="既存サーバーのベース URL（未指定ならローカルに起動）")
+    parser.add_argument("--api-key", default=os.environ.get("USAGE_TRACKER_API_KEY", ""))
+    parser.add_argument("--events", type=int, default=100_000, help="bulk で送る件数")
+    parser.add_argument("--single-events", type=int, default=5_000, help="single で送る件数")
+    parser.add_argument("--bulk-size", type=int, default=1_000, help="bulk の1リクエストあたりの行数")
+    parser.add_argument("--concurrency", type=int, default=8, help="送信スレッド数")
+    args = parser.parse_args()
+
+    if args.url:
+        run(args.url, args)
+    else:
+        with local_server(capacity=args.events + 2 * args.single_events + 1) as base_url:
+            run(base_url, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# /// script
+# requires-python = ">=3.10"
+# dependencies = [
+#     "numpy>=1.26.0",
+#     "fastapi>=0.109.0",
+#     "pydantic>=2.0.0",
+# ]
+# ///
+"""
+Claude Code Usage Tracker - API サーバーのイベントストア ベンチマーク
+
+ingest モード: 容量いっぱい（定常状態）のストアに追加し続けたときの1件あたりの時間を、
+               変更前の list.append + pop(0) と EventRing で比較する。
+               list.pop(0) は1回ごとに容量分のポインタを詰め直すため、容量が大きいと極端に遅い。
+               旧実装の計測回数は --legacy-ops で別に指定する。
+query モード : --events 件（14日分、ほぼ時刻順に到着し 5% は最大1時間遅れ）を保持したときのメモリと、
+               /api/stats・/api/users・/api/tools・/api/timeline の応答時間を、変更前
+               （payload の dict のリストを毎回走査）と列指向の EventRing で期間（--days）ごとに比較する。
+               EventRing は期間の先頭を二分探索するため、応答時間は期間内の件数に比例する。
+               server/main.py を読み込むため FastAPI が必要。
+
+Usage:
+    uv run benchmarks/bench_event_store.py [--capacities 50000 500000 5000000] [--ops 200000] [--legacy-ops 2000]
+    uv run benchmarks/bench_event_store.py --mode query [--events 50000 500000] [--days 1 7] [--runs 5]
+"""
+
+import argparse
+import asyncio
+import gc
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+SERVER_DIR = Path(__file__).resolve().parent.parent / "plugin" / "usage-tracker" / "server"
+sys.path.insert(0, str(SERVER_DIR))
+
+from event_store import EventRing  # noqa: E402
+
+EVENT_TYPES = ["PreToolUse", "PostToolUse", "PostToolUse", "UserPromptSubmit", "SessionStart", "SubagentStop", "Stop"]
+TOOLS = ["Read", "Edit", "Bash", "Grep", "Task", "mcp__github__get_issue", "NotebookEdit"]
+
+
+SPAN_SECONDS = 14 * 86400
+
+
+def make_event(i: int, now: datetime, count: int = 1) -> dict:
+    """変更前のストアが保持していた payload.dict() と同じ形のイベント。
+    i 番目に到着するイベントの時刻は 14 日前から now までを等分した位置（5% は最大1時間遅れ）。"""
+    tool = TOOLS[i % len(TOOLS)]
+    age = SPAN_SECONDS * (count - i) / count
+    if random.random() < 0.05:
+        age += random.randint(0, 3600)
+    return {
+        "event_id": f"{i:032x}",
+        "event_type": EVENT_TYPES[i % len(EVENT_TYPES)],
+        "timestamp": (now - timedelta(seconds=age)).isoformat(),
+        "user_id": f"user{i % 40}@example.com",
+        "team_id": f"team-{i % 3}",
+        "project": f"project-{i % 12}",
+        "session_id": f"session-{i // 50}",
+        "tool_name": tool,
+        "categories": {
+            "skill": tool.startswith("Notebook"),
+            "subagent": tool == "Task",
+            "mcp": tool.startswith("mcp__"),
+            "command": tool == "Bash",
+            "file_operation": tool in ("Read", "Edit", "Grep"),
+        },
+        "success": True,
+        "output_length": random.randint(0, 20000),
+        "prompt_length": None,
+        "error": None,
+        "metadata": {"cwd": "/home/user/project", "permission_mode": "default", "model": "sonnet"},
+        "received_at": now.isoformat(),
+    }
+
+
+# ==============================================================================
+# ingest モード
+# ==============================================================================
+
+def bench_legacy_ingest(event: dict, capacity: int, ops: int) -> float:
+    """変更前の実装（比較用）。1件あたりの秒数を返す。"""
+    store = [event] * capacity
+    start = time.perf_counter()
+    for _ in range(ops):
+        store.append(event)
+        if len(store) > capacity:
+            store.pop(0)
+    return (time.perf_counter() - start) / ops
+
+
+def bench_ring_ingest(event: dict, capacity: int, ops: int) -> float:
+    store = EventRing(capacity)
+    for _ in range(capacity):
+        store.append(**event)
+    start = time.perf_counter()
+    for _ in range(ops):
+        store.append(**event)
+    return (time.perf_counter() - start) / ops
+
+
+def run_ingest(args):
+    event = make_event(0, datetime.now(timezone.utc))
+    results = []
+    for capacity in args.capacities:
+        legacy = bench_legacy_ingest(event, capacity, args.legacy_ops)
+        ring = bench_ring_ingest(event, capacity, args.ops)
+        results.append((capacity, legacy, ring))
+        print(f"  capacity={capacity:,}: list+pop(0) {legacy * 1e9:,.0f} ns/op, ring {ring * 1e9:,.0f} ns/op")
+
+    print()
+    print("Ingest at steady state (store full)")
+    print(f"  {'capacity':>10} {'list+pop(0)':>16} {'EventRing':>14} {'speedup':>9}")
+    for capacity, legacy, ring in results:
+        print(f"  {capacity:>10,} {legacy * 1e9:>11,.0f} ns/op {ring * 1e9:>9,.0f} ns/op {legacy / ring:>8.0f}x")
+
+
+# ==============================================================================
+# query モード（変更前のエンドポイントの実装を比較用に残す）
+# ==============================================================================
+
+def _parse_ts(ts_str):
+    return datetime.fromisoformat(ts_str.replace("Z", "+00:00"))
+
+
+def legacy_stats(events, team_id, days):
+    now = datetime.now(timezone.utc)
+    period_start = now - timedelta(days=days)
+    prev_period_start = period_start - timedelta(days=days)
+    current = [e for e in events if e.get("team_id") == team_id and _parse_ts(e["timestamp"]) >= period_start]
+    prev = [e for e in events
+            if e.get("team_id") == team_id and prev_period_start <= _parse_ts(e["timestamp"]) < period_start]
+    result = {}
+    for label, evs in (("cur", current), ("prev", prev)):
+        for cat in ("skill", "mcp", "command"):
+            result[f"{label}_{cat}"] = sum(1 for e in evs if e.get("categories", {}).get(cat, False))
+        for et in ("SubagentStop", "UserPromptSubmit", "SessionStart"):
+            result[f"{label}_{et}"] = sum(1 for e in evs if e.get("event_type") == et)
+    result["active_users"] = len(set(e.get("user_id") for e in current))
+    result["total_users"] = len(set(e.get("user_id") for e in events if e.get("team_id") == team_id))
+    return result
+
+
+def legacy_users(events, team_id, days):
+    period_start = datetime.now(timezone.utc) - timedelta(days=days)
+    stats = defaultdict(lambda: defaultdict(int))
+    for e in events:
+        if e.get("team_id") != team_id or _parse_ts(e["timestamp"]) < period_start:
+            continue
+        s = stats[e["user_id"]]
+        s["total_count"] += 1
+        for cat in ("skill", "mcp", "command"):
+            if e.get("categories", {}).get(cat):
+                s[cat] += 1
+        s[e.get("event_type")] += 1
+        s["last_active"] = max(s["last_active"] or "", e["timestamp"])
+    return sorted(stats.items(), key=lambda x: x[1]["total_count"], reverse=True)[:20]
+
+
+def legacy_tools(events, team_id, days):
+    period_start = datetime.now(timezone.utc) - timedelta(days=days)
+    counts = defaultdict(int)
+    for e in events:
+        if (e.get("team_id") == team_id and e.get("event_type") in ["PostToolUse", "PreToolUse"]
+                and _parse_ts(e["timestamp"]) >= period_start):
+            counts[e.get("tool_name", "unknown")] += 1
+    return sorted(counts.items(), key=lambda x: x[1], reverse=True)
+
+
+def legacy_timeline(events, team_id, days):
+    period_start = datetime.now(timezone.utc) - timedelta(days=days)
+    daily = defaultdict(lambda: {"messages": 0, "tools": 0, "sessions": 0})
+    for e in events:
+        if e.get("team_id") != team_id or _parse_ts(e["timestamp"]) < period_start:
+            continue
+        et = e.get("event_type", "")
+        if et == "UserPromptSubmit":
+            daily[e["timestamp"][:10]]["messages"] += 1
+        elif et in ["PostToolUse", "PreToolUse"]:
+            daily[e["timestamp"][:10]]["tools"] += 1
+        elif et == "SessionStart":
+            daily[e["timestamp"][:10]]["sessions"] += 1
+    return sorted(daily.items())
+
+
+def measure_memory(build) -> tuple[object, int]:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    obj = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return obj, after - before
+
+
+def timed(fn, runs: int) -> float:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def run_query(args):
+    import main  # FastAPI が必要
+
+    now = datetime.now(timezone.utc)
+    for count in args.events:
+        random.seed(count)
+        payloads = [make_event(i, now, count) for i in range(count)]
+
+        legacy, legacy_bytes = measure_memory(lambda: [dict(p, metadata=dict(p["metadata"]),
+                                                            categories=dict(p["categories"])) for p in payloads])
+
+        def build_ring():
+            ring = EventRing(count)
+            for p in payloads:
+                ring.append(**p)
+            return ring
+        ring, ring_bytes = measure_memory(build_ring)
+        main.events_store = ring
+
+        call = asyncio.run
+        print(f"{count:,} events")
+        print(f"  memory      list of dicts {legacy_bytes / 2**20:8.1f} MB   "
+              f"EventRing {ring_bytes / 2**20:6.1f} MB  ({legacy_bytes / ring_bytes:.0f}x smaller)")
+        for days in args.days:
+            endpoints = [
+                (f"/api/stats?days={days}",
+                 lambda: legacy_stats(legacy, "team-0", days),
+                 lambda: call(main.get_stats(team_id="team-0", days=days, _=True))),
+                (f"/api/users?days={days}",
+                 lambda: legacy_users(legacy, "team-0", days),
+                 lambda: call(main.get_user_stats(team_id="team-0", days=days, limit=20, _=True))),
+                (f"/api/tools?days={days}",
+                 lambda: legacy_tools(legacy, "team-0", days),
+                 lambda: call(main.get_tool_stats(team_id="team-0", days=days, _=True))),
+                (f"/api/timeline?days={days}",
+                 lambda: legacy_timeline(legacy, "team-0", days),
+                 lambda: call(main.get_timeline(team_id="team-0", days=days, _=True))),
+            ]
+            for name, old_fn, new_fn in endpoints:
+                old_s = timed(old_fn, args.runs)
+                new_s = timed(new_fn, args.runs)
+                print(f"  {name:<22} list {old_s * 1e3:9.1f} ms   EventRing {new_s * 1e3:7.2f} ms  "
+                      f"({old_s / new_s:.0f}x)")
+        print()
+        del legacy, ring, payloads
+
+
+def main():
+    parser = argparse.ArgumentParser(description="イベントストア ベンチマーク")
+    parser.add_argument("--mode", choices=["ingest", "query"], default="ingest")
+    parser.add_argument("--capacities", type=int, nargs="+", default=[50_000, 500_000, 5_000_000])
+    parser.add_argument("--ops", type=int, default=200_000, help="EventRing の計測回数（ingest）")
+    parser.add_argument("--legacy-ops", type=int, default=2_000, help="list + pop(0) の計測回数（ingest）")
+    parser.add_argument("--events", type=int, nargs="+", default=[50_000, 500_000], help="保持件数（query）")
+    parser.add_argument("--days", type=int, nargs="+", default=[1, 7], help="集計期間（query）")
+    parser.add_argument("--runs", type=int, default=5, help="1エンドポイントあたりの計測回数（query）")
+    args = parser.parse_args()
+
+    if args.mode == "ingest":
+        run_ingest(args)
+    else:
+        run_query(args)
+
+
+if __name__ == "__main__":
+    main()
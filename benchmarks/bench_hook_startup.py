@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Claude Code Usage Tracker - Hook 起動ベンチマーク
+Hook 1回あたりの実時間（プロセス起動〜終了）を、変更前（ベースライン）と現在の hooks.json で比較する。
+
+比較対象（どれも hooks.json のコマンドラインをそのまま sh -c で実行する）:
+  baseline        : hook_client.py 追加前のコミットの hooks.json + send_event.py（git show で一時ディレクトリに取り出す）
+                    コマンドは `uv run send_event.py`。uv が無い環境では uv run を python3 に置き換える（表に明記）
+  new (cold)      : 現在の hooks.json、デーモン未起動の SessionStart（接続失敗 → デーモン起動 → プロセス内処理）
+  new (in-process): 現在の hooks.json、USAGE_TRACKER_DAEMON=false（デーモンを使わない）
+  new (warm)      : 現在の hooks.json、デーモン起動済み（ソケットに渡してすぐ終了）
+
+cold は1回ごとに別の HOME を使い、起動したデーモンが受け付け可能になるまで待ってから次を計測する
+（デーモンの起動自体は Hook の外なので計測に含めない）。
+ログは一時ディレクトリ（HOME を差し替え）に書き込むため、実際のログは汚さない。
+
+Usage:
+    python benchmarks/bench_hook_startup.py [--runs 30] [--event-type PreToolUse] [--base <commit>]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+PLUGIN_DIR = REPO_DIR / "plugin" / "usage-tracker"
+SCRIPTS_DIR = PLUGIN_DIR / "scripts"
+# ベースラインは hook_client.py を追加したコミットの親（--base で変更できる）
+NEW_ENTRY_POINT = "plugin/usage-tracker/scripts/hook_client.py"
+# cold で起動したデーモンがすぐ終了するようにする（フィンガープリントには含まれない）
+DAEMON_IDLE_TIMEOUT = 2
+
+SAMPLE_INPUT = {
+    "session_id": "bench-session",
+    "transcript_path": "",
+    "cwd": "/tmp/bench",
+    "permission_mode": "default",
+    "hook_event_name": "PreToolUse",
+    "tool_name": "Read",
+    "tool_use_id": "toolu_bench",
+    "tool_input": {"file_path": "/tmp/bench/README.md"},
+}
+
+
+# ==============================================================================
+# ベースライン
+# ==============================================================================
+
+def git(*args: str) -> str:
+    return subprocess.run(["git", *args], cwd=REPO_DIR, check=True,
+                          capture_output=True, text=True).stdout
+
+
+def default_base() -> str:
+    """hook_client.py を追加したコミットの親"""
+    added = git("log", "--diff-filter=A", "--format=%H", "--", NEW_ENTRY_POINT).split()
+    if not added:
+        raise SystemExit(f"{NEW_ENTRY_POINT} を追加したコミットが見つかりません（--base で指定してください）")
+    return added[-1] + "^"
+
+
+def export_baseline(base: str, dest: Path) -> dict:
+    """ベースラインの send_event.py を dest/scripts に書き出し、その時点の hooks.json を返す"""
+    (dest / "scripts").mkdir(parents=True)
+    (dest / "scripts" / "send_event.py").write_text(
+        git("show", f"{base}:plugin/usage-tracker/scripts/send_event.py"), encoding="utf-8")
+    return json.loads(git("show", f"{base}:plugin/usage-tracker/hooks/hooks.json"))
+
+
+def hook_command(hooks: dict, event_type: str) -> str:
+    return hooks["hooks"][event_type][0]["hooks"][0]["command"]
+
+
+# ==============================================================================
+# 計測
+# ==============================================================================
+
+def run_once(command: str, stdin: bytes, env: dict) -> float:
+    start = time.perf_counter()
+    result = subprocess.run(["sh", "-c", command], input=stdin, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = (time.perf_counter() - start) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(f"{command!r} exited {result.returncode}: {result.stderr[-300:]!r}")
+    return elapsed
+
+
+def summarize(label: str, samples: list[float]) -> dict:
+    samples = sorted(samples)
+    return {
+        "label": label,
+        "median_ms": round(statistics.median(samples), 1),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 1),
+        "min_ms": round(samples[0], 1),
+    }
+
+
+def measure(label: str, command: str, stdin: bytes, env: dict, runs: int) -> dict:
+    run_once(command, stdin, env)  # ウォームアップ
+    return summarize(label, [run_once(command, stdin, env) for _ in range(runs)])
+
+
+def measure_cold(label: str, command: str, stdin: bytes, env: dict, runs: int, root: Path) -> dict:
+    """デーモンが無い状態で1回ずつ実行する（毎回別の HOME）。
+    実行後、Hook が起動したデーモンに接続できるまで待つ（計測外）。"""
+    samples = []
+    for i in range(runs + 1):
+        home = root / f"cold-{i}"
+        home.mkdir()
+        run_env = dict(env, HOME=str(home), USERPROFILE=str(home))
+        elapsed = run_once(command, stdin, run_env)
+        if not wait_for_daemon(run_env):
+            raise RuntimeError("Hook がデーモンを起動しませんでした")
+        if i:  # 1回目はウォームアップ
+            samples.append(elapsed)
+    return summarize(label, samples)
+
+
+def wait_for_daemon(env: dict, timeout: float = 10.0) -> bool:
+    """デーモンのソケット（またはパイプ）に接続できるまで待つ"""
+    sys.path.insert(0, str(SCRIPTS_DIR))
+    import hook_client
+
+    deadline = time.monotonic() + timeout
+    saved = dict(os.environ)
+    os.environ.update(env)
+    hook_client.LOG_DIR = os.path.join(env["HOME"], ".claude", "usage-tracker-logs")
+    try:
+        while time.monotonic() < deadline:
+            probe = hook_client.encode_message("Bench", b"{}", time.time())
+            if hook_client.forward_to_daemon(probe):
+                return True
+            time.sleep(0.05)
+        return False
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+def wait_for_daemons_exit(root: Path, timeout: float = 30.0):
+    """cold で起動したデーモンがアイドルタイムアウトで終了する（ソケットが消える）のを待つ"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and any(root.glob("cold-*/.claude/usage-tracker-logs/.collector-*.sock")):
+        time.sleep(0.5)
+
+
+# ==============================================================================
+# メイン
+# ==============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Hook 起動時間ベンチマーク")
+    parser.add_argument("--runs", type=int, default=30)
+    parser.add_argument("--event-type", default="PreToolUse")
+    parser.add_argument("--base", default="", help="ベースラインのコミット（既定: hook_client.py 追加の直前）")
+    args = parser.parse_args()
+
+    base = args.base or default_base()
+    stdin = json.dumps(SAMPLE_INPUT).encode("utf-8")
+    current_hooks = json.loads((PLUGIN_DIR / "hooks" / "hooks.json").read_text(encoding="utf-8"))
+    uv = shutil.which("uv")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        baseline_dir = root / "baseline"
+        baseline_hooks = export_baseline(base, baseline_dir)
+        home = root / "home"
+        home.mkdir()
+        env = dict(os.environ, HOME=str(home), USERPROFILE=str(home),
+                   USAGE_TRACKER_LOCAL_ONLY="true",
+                   USAGE_TRACKER_DAEMON_IDLE_TIMEOUT=str(DAEMON_IDLE_TIMEOUT))
+        baseline_env = dict(env, CLAUDE_PLUGIN_DIR=str(baseline_dir))
+        new_env = dict(env, CLAUDE_PLUGIN_DIR=str(PLUGIN_DIR))
+
+        def baseline(event_type: str) -> tuple[str, str]:
+            command = hook_command(baseline_hooks, event_type)
+            if uv or not command.startswith("uv run "):
+                return "baseline", command
+            return "baseline (uv→python3)", "python3 " + command[len("uv run "):]
+
+        event_types = [args.event_type] + (["SessionStart"] if args.event_type != "SessionStart" else [])
+        results = []
+        for event_type in event_types:
+            label, command = baseline(event_type)
+            results.append(measure(f"{label} {event_type}", command, stdin, baseline_env, args.runs))
+
+        results.append(measure_cold(
+            "new (cold, daemon spawn) SessionStart", hook_command(current_hooks, "SessionStart"),
+            stdin, new_env, args.runs, root))
+        results.append(measure(
+            f"new (in-process) {args.event_type}", hook_command(current_hooks, args.event_type),
+            stdin, dict(new_env, USAGE_TRACKER_DAEMON="false"), args.runs))
+
+        # デーモン起動済み（warm）
+        daemon = subprocess.Popen(
+            ["python3", str(SCRIPTS_DIR / "collector_daemon.py")],
+            env=dict(new_env, USAGE_TRACKER_DAEMON_IDLE_TIMEOUT="1800"),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if not wait_for_daemon(new_env):
+                raise RuntimeError("デーモンに接続できません")
+            results.append(measure(
+                f"new (warm, daemon running) {args.event_type}", hook_command(current_hooks, args.event_type),
+                stdin, new_env, args.runs))
+        finally:
+            daemon.terminate()
+            daemon.wait()
+            wait_for_daemons_exit(root)
+
+    base_ms = {r["label"].rsplit(" ", 1)[1]: r["median_ms"] for r in results if r["label"].startswith("baseline")}
+    print()
+    print(f"Hook 起動時間 ({args.runs} runs, base={base}, uv={'あり' if uv else 'なし'})")
+    print(f"  {'hooks.json command':<44} {'median':>9} {'p95':>9} {'min':>9} {'vs base':>8}")
+    for r in results:
+        ratio = base_ms[r["label"].rsplit(" ", 1)[1]] / r["median_ms"]
+        print(f"  {r['label']:<44} {r['median_ms']:>6} ms {r['p95_ms']:>6} ms {r['min_ms']:>6} ms {ratio:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
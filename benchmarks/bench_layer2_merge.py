@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# /// script
+# requires-python = ">=3.10"
+# dependencies = [
+#     "snowflake-connector-python>=3.6.0",
+#     "cryptography>=42.0.0",
+# ]
+# ///
+"""
+Claude Code Usage Tracker - LAYER2 MERGE ベンチマーク
+RAW_EVENTS の履歴を増やしながら、同じ件数の新規行を LAYER2 に MERGE する時間を
+全件 MERGE（変更前）とストリーム MERGE（変更後）で比較する。
+
+使い捨てスキーマ CLAUDE_USAGE_DB.BENCH_MERGE_<pid> を作って計測し、終了時に削除する。
+接続設定は snowflake-upload/upload_to_snowflake.py と同じ環境変数を使う。
+
+Usage:
+    uv run benchmarks/bench_layer2_merge.py [--history 100000 1000000 5000000] [--batch 10000]
+"""
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "snowflake-upload"))
+
+import upload_to_snowflake as uploader  # noqa: E402
+
+# 1行あたり実際のイベントに近い大きさ（~400B）の合成データ
+SYNTHETIC_ROW = """
+OBJECT_CONSTRUCT(
+    'event_id',    MD5('bench-' || (SEQ8() + {offset})),
+    'event_type',  IFF(MOD(SEQ8(), 3) = 0, 'PostToolUse', 'PreToolUse'),
+    'timestamp',   TO_VARCHAR(DATEADD(SECOND, SEQ8() + {offset}, '2026-01-01'::TIMESTAMP_NTZ)),
+    'user_id',     'bench-user-' || MOD(SEQ8(), 50),
+    'team_id',     'bench-team',
+    'session_id',  'bench-session-' || MOD(SEQ8(), 1000),
+    'project',     'bench',
+    'tool_name',   'Read',
+    'seq',         SEQ8() + {offset},
+    'tool_input',  OBJECT_CONSTRUCT('file_path', RANDSTR(200, RANDOM()))
+)
+"""
+
+
+def insert_rows(cur, schema: str, count: int, offset: int):
+    cur.execute(f"""
+        INSERT INTO {schema}.RAW_EVENTS (RAW_DATA, SOURCE_FILE, SOURCE_ROW)
+        SELECT {SYNTHETIC_ROW.format(offset=offset)}, 'bench', SEQ8() + {offset}
+        FROM TABLE(GENERATOR(ROWCOUNT => {count}))
+    """)
+
+
+def timed(cur, sql: str) -> tuple[float, int]:
+    start = time.perf_counter()
+    cur.execute(sql)
+    row = cur.fetchone()
+    return time.perf_counter() - start, (row[0] if row else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LAYER2 MERGE ベンチマーク")
+    parser.add_argument("--history", type=int, nargs="+", default=[100_000, 1_000_000, 5_000_000],
+                        help="計測時点の RAW_EVENTS の履歴行数")
+    parser.add_argument("--batch", type=int, default=10_000, help="1回の MERGE で追加される新規行数")
+    parser.add_argument("--keep", action="store_true", help="計測用スキーマを削除しない")
+    args = parser.parse_args()
+
+    schema = f"CLAUDE_USAGE_DB.BENCH_MERGE_{os.getpid()}"
+    conn = uploader.create_connection()
+    cur = conn.cursor()
+    cur.execute("ALTER SESSION SET USE_CACHED_RESULT = FALSE")
+
+    full_sql = uploader.build_merge_events_sql(f"{schema}.RAW_EVENTS", f"{schema}.EVENTS_FULL")
+    stream_sql = uploader.build_merge_events_sql(f"{schema}.RAW_EVENTS_STREAM", f"{schema}.EVENTS_STREAM")
+
+    results = []
+    try:
+        cur.execute(f"CREATE SCHEMA {schema}")
+        cur.execute(f"""
+            CREATE TABLE {schema}.RAW_EVENTS (
+                RAW_DATA VARIANT NOT NULL,
+                SOURCE_FILE VARCHAR(255),
+                SOURCE_ROW INTEGER,
+                RECEIVED_AT TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP()
+            )
+        """)
+        cur.execute(f"CREATE TABLE {schema}.EVENTS_FULL LIKE {uploader._L2}.EVENTS")
+        cur.execute(f"CREATE TABLE {schema}.EVENTS_STREAM LIKE {uploader._L2}.EVENTS")
+        cur.execute(f"CREATE STREAM {schema}.RAW_EVENTS_STREAM ON TABLE {schema}.RAW_EVENTS APPEND_ONLY = TRUE")
+
+        loaded = 0
+        for history in sorted(args.history):
+            # 履歴を目標件数まで積んで両方の EVENTS に取り込む（計測対象外）
+            if history > loaded:
+                insert_rows(cur, schema, history - loaded, loaded)
+                cur.execute(full_sql)
+                cur.execute(stream_sql)
+                loaded = history
+
+            # 新規行を追加して MERGE 時間を計測
+            insert_rows(cur, schema, args.batch, loaded)
+            loaded += args.batch
+            full_s, full_rows = timed(cur, full_sql)
+            stream_s, stream_rows = timed(cur, stream_sql)
+            results.append((history, full_s, full_rows, stream_s, stream_rows))
+            print(f"  history={history:,}: full {full_s:.2f}s ({full_rows} rows), "
+                  f"stream {stream_s:.2f}s ({stream_rows} rows)")
+    finally:
+        if not args.keep:
+            cur.execute(f"DROP SCHEMA IF EXISTS {schema}")
+        cur.close()
+        conn.close()
+
+    print()
+    print(f"LAYER2 MERGE ({args.batch:,} new rows per run)")
+    print(f"  {'RAW_EVENTS history':>20} {'full MERGE':>12} {'stream MERGE':>14}")
+    for history, full_s, _, stream_s, _ in results:
+        print(f"  {history:>20,} {full_s:>10.2f} s {stream_s:>12.2f} s")
+
+
+if __name__ == "__main__":
+    main()
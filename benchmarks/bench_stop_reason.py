@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Claude Code Usage Tracker - 停止理由判定ベンチマーク
+detect_stop_reason() の旧実装（全文 read_text + splitlines）と
+新実装（末尾からの逆方向読み込み / mmap）をトランスクリプトサイズ別に比較する。
+
+Usage:
+    python benchmarks/bench_stop_reason.py [--sizes-mb 1 10 50 200] [--runs 10]
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SCRIPTS_DIR = Path(__file__).resolve().parent.parent / "plugin" / "usage-tracker" / "scripts"
+sys.path.insert(0, str(SCRIPTS_DIR))
+
+import send_event  # noqa: E402
+
+
+def detect_stop_reason_legacy(transcript_path: str) -> str:
+    """変更前の実装（比較用）"""
+    path = Path(transcript_path)
+    try:
+        text = path.read_text(encoding="utf-8", errors="ignore")
+        lines = text.splitlines()
+        recent_lines = lines[-30:] if len(lines) >= 30 else lines
+        content_lower = " ".join(recent_lines).lower()
+        for keyword in send_event.USAGE_LIMIT_KEYWORDS:
+            if keyword in content_lower:
+                return "usage_limit"
+        return "normal"
+    except Exception:
+        return "unknown"
+
+
+def write_transcript(path: Path, size_mb: int):
+    """実際のトランスクリプトに近い JSONL（1行 1〜4KB）を指定サイズまで書く"""
+    target = size_mb * 1024 * 1024
+    written = 0
+    i = 0
+    with open(path, "w", encoding="utf-8") as f:
+        while written < target:
+            line = json.dumps({
+                "type": "assistant" if i % 2 else "user",
+                "uuid": f"msg-{i}",
+                "message": {"content": "ログ出力のサンプル " * (20 + i % 150)},
+            }, ensure_ascii=False) + "\n"
+            f.write(line)
+            written += len(line.encode("utf-8"))
+            i += 1
+        f.write(json.dumps({"type": "system", "message": "Claude AI usage limit reached"}) + "\n")
+
+
+def timed(fn, runs: int) -> float:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="detect_stop_reason ベンチマーク")
+    parser.add_argument("--sizes-mb", type=int, nargs="+", default=[1, 10, 50, 200])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'size':>8} {'legacy':>12} {'seek':>12} {'mmap':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size_mb in args.sizes_mb:
+            path = Path(tmp) / f"transcript-{size_mb}mb.jsonl"
+            write_transcript(path, size_mb)
+            p = str(path)
+
+            assert detect_stop_reason_legacy(p) == send_event.detect_stop_reason(p) == "usage_limit"
+            tail = send_event.STOP_REASON_TAIL_LINES
+            assert (send_event.read_tail_lines(path, tail, use_mmap=False)
+                    == send_event.read_tail_lines(path, tail, use_mmap=True))
+
+            legacy = timed(lambda: detect_stop_reason_legacy(p), args.runs)
+            seek = timed(lambda: send_event.read_tail_lines(path, tail, use_mmap=False), args.runs)
+            mm = timed(lambda: send_event.read_tail_lines(path, tail, use_mmap=True), args.runs)
+            print(f"{size_mb:>6}MB {legacy:>9.2f} ms {seek:>9.2f} ms {mm:>9.2f} ms")
+            path.unlink()
+
+
+if __name__ == "__main__":
+    main()
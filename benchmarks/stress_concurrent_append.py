@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Claude Code Usage Tracker - 同時追記ストレステスト
+並列セッション・サブエージェントを想定して多数の Hook プロセスを同時に起動し、
+ローカルログに1行も欠落・破損・重複が無いことを検証する。
+
+- hook モード  : hook_client.py（デーモン無し・プロセス内処理）を --procs 個同時に起動する。
+                 これを --rounds 回繰り返す
+- worker モード: --procs 個のプロセスがそれぞれ send_event.log_locally を --writes 回呼ぶ
+                 （Hook 起動を挟まないぶん、同時書き込みの密度が高い）
+- --legacy     : worker モードで変更前の open(..., "a") による追記を使う（比較用）
+
+ペイロードの一部は PIPE_BUF を超える大きさにしてロック経路も通し、
+セグメント上限を小さくしてローテーションも同時に発生させる。
+ログは一時ディレクトリ（HOME を差し替え）に書き込むため、実際のログは汚さない。
+
+Usage:
+    python benchmarks/stress_concurrent_append.py [--procs 64] [--rounds 4]
+    python benchmarks/stress_concurrent_append.py --mode worker [--procs 64] [--writes 200] [--legacy]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SCRIPTS_DIR = Path(__file__).resolve().parent.parent / "plugin" / "usage-tracker" / "scripts"
+LARGE_EVERY = 5          # 5件に1件は PIPE_BUF を超えるペイロードにする
+LARGE_SIZE = 12 * 1024
+
+
+def make_input(worker: int, seq: int) -> dict:
+    data = {
+        "session_id": f"stress-{worker}-{seq}",
+        "cwd": "/tmp/stress",
+        "hook_event_name": "PreToolUse",
+        "tool_name": "Bash",
+        "tool_use_id": f"toolu_{worker}_{seq}",
+        "tool_input": {"command": "echo ok"},
+    }
+    if seq % LARGE_EVERY == 0:
+        data["tool_input"]["command"] = "x" * LARGE_SIZE
+    return data
+
+
+def worker_main(worker: int, writes: int, legacy: bool):
+    """worker モードの子プロセス: log_locally を連続して呼ぶ"""
+    sys.path.insert(0, str(SCRIPTS_DIR))
+    import send_event
+
+    for seq in range(writes):
+        payload = send_event.create_event_payload("PreToolUse", make_input(worker, seq))
+        if legacy:
+            path = send_event.LOG_DIR / f"events-{time.strftime('%Y-%m-%d')}.jsonl"
+            with open(path, "a", encoding="utf-8", errors="replace") as f:
+                f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+        else:
+            send_event.log_locally(payload)
+
+
+def run_hook_mode(args, env: dict) -> set:
+    hook_client = str(SCRIPTS_DIR / "hook_client.py")
+    expected = set()
+    for rnd in range(args.rounds):
+        procs = []
+        for worker in range(args.procs):
+            stdin = json.dumps(make_input(worker, rnd)).encode("utf-8")
+            p = subprocess.Popen(
+                [sys.executable, "-X", "frozen_modules=on", hook_client, "--event-type", "PreToolUse"],
+                stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+            procs.append((p, stdin))
+            expected.add(f"stress-{worker}-{rnd}")
+        for p, stdin in procs:
+            p.communicate(stdin)
+    return expected
+
+
+def run_worker_mode(args, env: dict) -> set:
+    procs = []
+    for worker in range(args.procs):
+        cmd = [sys.executable, __file__, "--_worker", str(worker), "--writes", str(args.writes)]
+        if args.legacy:
+            cmd.append("--legacy")
+        procs.append(subprocess.Popen(cmd, env=env))
+    for p in procs:
+        p.wait()
+    return {f"stress-{w}-{s}" for w in range(args.procs) for s in range(args.writes)}
+
+
+def verify(log_dir: Path, expected: set) -> bool:
+    seen = {}
+    corrupt = 0
+    segments = sorted(log_dir.glob("events-*.jsonl"))
+    for path in segments:
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    sid = json.loads(line)["session_id"]
+                except (ValueError, KeyError):
+                    corrupt += 1
+                    continue
+                seen[sid] = seen.get(sid, 0) + 1
+
+    missing = expected - seen.keys()
+    duplicated = [k for k, v in seen.items() if v > 1]
+    print(f"  segments   : {len(segments)}")
+    print(f"  expected   : {len(expected)}")
+    print(f"  found      : {sum(seen.values())}")
+    print(f"  corrupt    : {corrupt}")
+    print(f"  missing    : {len(missing)}")
+    print(f"  duplicated : {len(duplicated)}")
+    return corrupt == 0 and not missing and not duplicated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="同時追記ストレステスト")
+    parser.add_argument("--mode", choices=["hook", "worker"], default="hook")
+    parser.add_argument("--procs", type=int, default=64)
+    parser.add_argument("--rounds", type=int, default=4, help="hook モードの繰り返し回数")
+    parser.add_argument("--writes", type=int, default=200, help="worker モードの1プロセスあたり書き込み数")
+    parser.add_argument("--segment-max-mb", default="0.25", help="ローテーションを起こすためのセグメント上限")
+    parser.add_argument("--legacy", action="store_true", help="変更前の追記方法を使う（worker モードのみ）")
+    parser.add_argument("--_worker", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args._worker is not None:
+        worker_main(args._worker, args.writes, args.legacy)
+        return
+
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home, USERPROFILE=home,
+                   USAGE_TRACKER_LOCAL_ONLY="true",
+                   USAGE_TRACKER_DAEMON="false",
+                   USAGE_TRACKER_PAYLOAD_PROFILE="full",
+                   USAGE_TRACKER_SEGMENT_MAX_MB=args.segment_max_mb)
+        log_dir = Path(home) / ".claude" / "usage-tracker-logs"
+        log_dir.mkdir(parents=True)
+
+        start = time.perf_counter()
+        if args.mode == "hook":
+            expected = run_hook_mode(args, env)
+        else:
+            expected = run_worker_mode(args, env)
+        elapsed = time.perf_counter() - start
+
+        print(f"{args.mode} mode: {args.procs} procs{' (legacy)' if args.legacy else ''}, {elapsed:.1f}s")
+        ok = verify(log_dir, expected)
+
+    print("OK" if ok else "NG")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# /// script
+# requires-python = ">=3.10"
+# dependencies = [
+#     "requests>=2.28.0",
+# ]
+# ///
+"""
+Claude Code Usage Tracker - Collector Daemon
+hook_client.py からイベントを受け取り、ペイロード作成・ローカル保存・送信を
+Hook の外（常駐プロセス）で実行する。
+
+- ローカルログ（とスプール）への書き込みを終えてから ack する。ack が返らなければ
+  hook_client.py はプロセス内で処理するため、デーモンが止まってもイベントは失われない
+
+- SessionStart 時に hook_client.py が自動起動する
+- 待ち受けは Unix ソケット（Windows は名前付きパイプ）
+- USAGE_TRACKER_DAEMON_IDLE_TIMEOUT 秒（デフォルト1800）イベントが無ければ終了する
+- サーバー送信ありの場合はスプールのシッパー（shipper.py）をスレッドで同居させる
+"""
+
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import send_event
+from hook_client import LOG_DIR, daemon_address, decode_message
+
+# ==============================================================================
+# 設定
+# ==============================================================================
+
+IDLE_TIMEOUT = float(os.environ.get("USAGE_TRACKER_DAEMON_IDLE_TIMEOUT", "1800"))
+
+
+# ==============================================================================
+# デーモン本体
+# ==============================================================================
+
+class CollectorDaemon:
+    """受信・保存スレッド（メイン）と、ack 後の処理スレッドの2本で動く常駐コレクタ"""
+
+    def __init__(self, address: str):
+        self.address = address
+        self.events: queue.Queue = queue.Queue()
+        self.last_activity = time.monotonic()
+        self.stopping = False
+
+    def _bind(self) -> Listener | None:
+        """待ち受けを開始する。既に別デーモンが動いていれば None。"""
+        if sys.platform == "win32":
+            try:
+                return Listener(self.address, family="AF_PIPE")
+            except OSError:
+                return None
+
+        # 既存ソケットに接続できれば稼働中、できなければ残骸なので削除
+        sock_path = Path(self.address)
+        if sock_path.exists():
+            try:
+                Client(self.address).close()
+                return None
+            except OSError:
+                sock_path.unlink(missing_ok=True)
+
+        Path(LOG_DIR).mkdir(parents=True, exist_ok=True)
+        old_umask = os.umask(0o077)
+        try:
+            return Listener(self.address, family="AF_UNIX")
+        except OSError:
+            return None
+        finally:
+            os.umask(old_umask)
+
+    def _record(self, data: bytes) -> tuple[str, dict | None]:
+        """受信したイベントをローカルログ（サーバー送信ありならスプール）に書く。
+        書き終えてから ack するため、ack 後にデーモンが終了してもイベントは失われない。
+        戻り値は (イベントタイプ, 後で同期送信するペイロード | None)"""
+        event_type, ts, raw = decode_message(data)
+        try:
+            input_data = json.loads(raw) if raw.strip() else {}
+        except ValueError:
+            input_data = {}
+        if not isinstance(input_data, dict):
+            input_data = {}
+        payload = send_event.create_event_payload(
+            event_type, input_data,
+            now=datetime.fromtimestamp(ts, timezone.utc),
+        )
+        send_event.log_locally(payload)
+        config = send_event.CONFIG
+        if config["local_only"] or config["spool"]:
+            send_event.send_event(payload)  # スプールへの追記だけ（送信はシッパー）
+            return event_type, None
+        return event_type, payload
+
+    def _worker(self):
+        """ack 後でよい処理（スプールを使わない同期送信・SessionStart のログ整理）を実行する"""
+        while True:
+            event_type, payload = self.events.get()
+            try:
+                if payload is not None:
+                    send_event.send_event(payload)
+                if event_type == "SessionStart":
+                    send_event.housekeep_logs()
+            except Exception as e:
+                send_event.log_error(f"collector_daemon: {e}")
+            finally:
+                self.events.task_done()
+
+    def _watchdog(self):
+        """アイドルタイムアウトで停止フラグを立て、自分に接続して accept を起こす。
+        キューに残った処理があるうちは止めない（停止後も serve が処理し終えてから終了する）"""
+        while not self.stopping:
+            time.sleep(min(IDLE_TIMEOUT, 30))
+            if (time.monotonic() - self.last_activity >= IDLE_TIMEOUT
+                    and self.events.unfinished_tasks == 0):
+                self.stopping = True
+                try:
+                    Client(self.address).close()
+                except OSError:
+                    pass
+
+    def serve(self):
+        listener = self._bind()
+        if listener is None:
+            return
+
+        threading.Thread(target=self._worker, daemon=True).start()
+        threading.Thread(target=self._watchdog, daemon=True).start()
+
+        # サーバー送信ありの構成では、スプールのシッパーもこのプロセスで動かす
+        if not send_event.CONFIG["local_only"] and send_event.CONFIG["spool"]:
+            import shipper
+            shipper.start_in_thread()
+
+        try:
+            while not self.stopping:
+                try:
+                    conn = listener.accept()
+                except OSError:
+                    continue
+                try:
+                    if self.stopping:
+                        break  # ack しないので、クライアントはプロセス内で処理する
+                    data = conn.recv_bytes()
+                    self.last_activity = time.monotonic()
+                    try:
+                        deferred = self._record(data)
+                    except Exception as e:
+                        # 保存できなかったイベントは ack せず、クライアントのプロセス内処理に任せる
+                        send_event.log_error(f"collector_daemon: {e}")
+                        conn.send_bytes(b"error")
+                        continue
+                    self.events.put(deferred)
+                    conn.send_bytes(b"ok")
+                except (OSError, EOFError):
+                    pass
+                finally:
+                    conn.close()
+        finally:
+            listener.close()
+            # ack 済みのイベントの残りの処理を全て終えてから終了する
+            self.events.join()
+
+
+# ==============================================================================
+# メイン
+# ==============================================================================
+
+def main():
+    CollectorDaemon(daemon_address()).serve()
+
+
+if __name__ == "__main__":
+    main()
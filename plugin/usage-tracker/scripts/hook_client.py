@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Claude Code Usage Tracker - Hook Client
+Hook から呼ばれる軽量クライアント。stdin の JSON を常駐デーモン
+(collector_daemon.py) に渡してすぐ終了する。
+
+- デーモンに接続できない場合は send_event.py の処理をプロセス内で実行する
+- SessionStart のときはデーモンが起動していなければバックグラウンドで起動する
+- USAGE_TRACKER_DAEMON=false でデーモンを使わず常にプロセス内で処理する
+
+標準ライブラリのみで動作し、依存解決不要のため uv を経由せず
+`python -X frozen_modules=on hook_client.py` で直接起動できる。
+起動時間を抑えるため、トップレベルでは os / sys / time だけを import し、
+それ以外は必要になった経路でのみ import する。
+"""
+
+import os
+import sys
+import time
+
+# ==============================================================================
+# 設定
+# ==============================================================================
+
+# pathlib の import を避けるため os.path で扱う
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+LOG_DIR = os.path.join(os.path.expanduser("~"), ".claude", "usage-tracker-logs")
+
+# デーモンのプロセス内 CONFIG を決める環境変数（これが同じデーモンだけを共有する）
+_FINGERPRINT_PREFIXES = ("USAGE_TRACKER_",)
+_FINGERPRINT_KEYS = ("CLAUDE_PROJECT_DIR", "USER", "USERNAME")
+# デーモン自体の動作設定はフィンガープリントに含めない
+_FINGERPRINT_IGNORE = ("USAGE_TRACKER_DAEMON",)
+
+
+# ==============================================================================
+# デーモンのアドレス
+# ==============================================================================
+
+def env_fingerprint(environ=None) -> str:
+    """デーモン共有単位を決める環境変数のフィンガープリント（8桁hex）"""
+    import zlib
+
+    environ = os.environ if environ is None else environ
+    items = sorted(
+        f"{k}={v}" for k, v in environ.items()
+        if (k.startswith(_FINGERPRINT_PREFIXES) or k in _FINGERPRINT_KEYS)
+        and not k.startswith(_FINGERPRINT_IGNORE)
+    )
+    items.append(SCRIPT_DIR)
+    return f"{zlib.crc32(chr(0).join(items).encode('utf-8', 'replace')):08x}"
+
+
+def daemon_address(environ=None) -> str:
+    """デーモンの待ち受けアドレス（Windows: 名前付きパイプ / その他: Unixソケット）"""
+    fp = env_fingerprint(environ)
+    if sys.platform == "win32":
+        return rf"\\.\pipe\claude-usage-tracker-{fp}"
+    return os.path.join(LOG_DIR, f".collector-{fp}.sock")
+
+
+def daemon_enabled() -> bool:
+    return os.environ.get("USAGE_TRACKER_DAEMON", "true").lower() != "false"
+
+
+# ==============================================================================
+# デーモンへの受け渡し
+# ==============================================================================
+
+def encode_message(event_type: str, raw: bytes, ts: float) -> bytes:
+    """1行目にヘッダ（イベントタイプ TAB 時刻）、2行目以降に stdin の生データを連結する。
+    クライアント側で json を import しないよう、ヘッダはプレーンテキストにする。"""
+    header = f"{event_type}\t{ts!r}"
+    return header.encode("utf-8") + b"\n" + raw
+
+
+def decode_message(data: bytes) -> tuple[str, float, bytes]:
+    """encode_message の逆変換"""
+    header, _, raw = data.partition(b"\n")
+    event_type, _, ts = header.decode("utf-8").partition("\t")
+    return event_type, float(ts), raw
+
+
+def _recv_exact(sock, size: int) -> bytes:
+    buf = b""
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise EOFError
+        buf += chunk
+    return buf
+
+
+def _forward_unix(message: bytes) -> bool:
+    """Unix ソケット版。multiprocessing.connection の import（数十ms）を避けるため
+    同じフレーミング（4バイト長 + 本体）を socket で直接扱う。"""
+    import socket
+    import struct
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(2)
+    try:
+        sock.connect(daemon_address())
+        sock.sendall(struct.pack("!i", len(message)) + message)
+        size, = struct.unpack("!i", _recv_exact(sock, 4))
+        return _recv_exact(sock, size) == b"ok"
+    except (OSError, EOFError):
+        return False
+    finally:
+        sock.close()
+
+
+def forward_to_daemon(message: bytes) -> bool:
+    """デーモンにメッセージを渡す。受理の応答が返れば True。"""
+    if sys.platform != "win32":
+        return _forward_unix(message)
+
+    from multiprocessing.connection import Client
+
+    try:
+        conn = Client(daemon_address())
+    except (OSError, EOFError):
+        return False
+    try:
+        conn.send_bytes(message)
+        return conn.recv_bytes() == b"ok"
+    except (OSError, EOFError):
+        return False
+    finally:
+        conn.close()
+
+
+def spawn_daemon():
+    """デーモンをバックグラウンドで起動する（Hook の終了を待たせない）"""
+    import shutil
+    import subprocess
+
+    daemon_script = os.path.join(SCRIPT_DIR, "collector_daemon.py")
+    uv = shutil.which("uv")
+    cmd = [uv, "run", "--quiet", daemon_script] if uv else [sys.executable, daemon_script]
+
+    kwargs = {
+        "stdin": subprocess.DEVNULL,
+        "stdout": subprocess.DEVNULL,
+        "stderr": subprocess.DEVNULL,
+        "close_fds": True,
+    }
+    if sys.platform == "win32":
+        kwargs["creationflags"] = (
+            subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+        )
+    else:
+        kwargs["start_new_session"] = True
+
+    try:
+        subprocess.Popen(cmd, **kwargs)
+    except OSError:
+        pass
+
+
+def run_in_process(event_type: str, raw: bytes, ts: float):
+    """デーモン不在時のフォールバック: send_event.py の処理をそのまま実行"""
+    import json
+    from datetime import datetime, timezone
+
+    sys.path.insert(0, SCRIPT_DIR)
+    import send_event
+
+    try:
+        input_data = json.loads(raw) if raw.strip() else {}
+    except ValueError:
+        input_data = {}
+    if not isinstance(input_data, dict):
+        input_data = {}
+
+    send_event.handle_event(
+        event_type, input_data,
+        now=datetime.fromtimestamp(ts, timezone.utc),
+    )
+
+
+# ==============================================================================
+# メイン
+# ==============================================================================
+
+def parse_event_type(argv: list[str]) -> str:
+    """--event-type X / --event-type=X を取り出す（argparse は使わない）"""
+    for i, arg in enumerate(argv):
+        if arg == "--event-type" and i + 1 < len(argv):
+            return argv[i + 1]
+        if arg.startswith("--event-type="):
+            return arg.split("=", 1)[1]
+    return "unknown"
+
+
+def main():
+    ts = time.time()
+    event_type = parse_event_type(sys.argv[1:])
+
+    try:
+        raw = sys.stdin.buffer.read()
+    except (OSError, AttributeError):
+        raw = b""
+
+    try:
+        forwarded = False
+        if daemon_enabled():
+            forwarded = forward_to_daemon(encode_message(event_type, raw, ts))
+            if not forwarded and event_type == "SessionStart":
+                spawn_daemon()
+        if not forwarded:
+            run_in_process(event_type, raw, ts)
+    except Exception:
+        pass
+
+    # 正常終了（Hookをブロックしない）
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
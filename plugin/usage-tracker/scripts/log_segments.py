@@ -0,0 +1,331 @@
+"""
+Claude Code Usage Tracker - Log Segments
+ローカルログ（~/.claude/usage-tracker-logs）をサイズと日付でローテーションし、
+閉じたセグメントを圧縮・保持期間管理する。
+
+ファイル構成:
+  events-YYYY-MM-DD.jsonl          書き込み中のセグメント（当日分）
+  events-YYYY-MM-DD.NNN.jsonl      サイズ上限でローテーションした閉じたセグメント
+  events-YYYY-MM-DD[.NNN].jsonl.gz 圧縮済みセグメント（zstd 設定時は .jsonl.zst）
+  .segments.json                   圧縮済みセグメントのイベント数・元サイズの索引
+
+- ローテーションは rename だけ行う（書き込み中の Hook を待たない）
+- 圧縮は最終更新から SEAL_GRACE_SECONDS 経過したセグメントだけを対象にする
+  （rename 直前に開かれた fd からの追記が終わってから圧縮するため）
+- 圧縮済みセグメントは Snowflake に AUTO_COMPRESS=FALSE でそのまま PUT できる
+- 保持容量 USAGE_TRACKER_LOG_RETENTION_MB を超えたら古い圧縮済みセグメントから削除する
+- 追記は1レコード1回の os.write（O_APPEND）で行い、並列セッション・サブエージェントの
+  Hook が同時に書いても行が混ざらないようにする（append_record）
+- ハウスキーピングは LOG_DIR 単位のロックを取れたプロセスだけが行う
+  （環境ごとのデーモンが同じ LOG_DIR を共有するため。取れなければ今回は何もしない）
+"""
+
+import json
+import os
+import re
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+# ==============================================================================
+# 設定
+# ==============================================================================
+
+LOG_DIR = Path.home() / ".claude" / "usage-tracker-logs"
+INDEX_FILE_NAME = ".segments.json"
+UPLOADED_FILE_NAME = ".uploaded_files.json"      # 旧形式のアップロード記録
+UPLOAD_MANIFEST_NAME = ".upload_manifest.json"   # Snowflake アップローダーの差分マニフェスト
+
+SEGMENT_MAX_BYTES = int(float(os.environ.get("USAGE_TRACKER_SEGMENT_MAX_MB", "16")) * 1024 * 1024)
+RETENTION_BYTES = int(float(os.environ.get("USAGE_TRACKER_LOG_RETENTION_MB", "200")) * 1024 * 1024)
+COMPRESSION = os.environ.get("USAGE_TRACKER_LOG_COMPRESSION", "gzip").lower()  # gzip / zstd / none
+SEAL_GRACE_SECONDS = 60
+
+# ロックなしの1回の write で追記してよいレコードの上限。
+# これを超えるレコード・Windows（O_APPEND が seek + write のエミュレーション）ではロックを取る。
+# （Linux の PIPE_BUF。select モジュールの import を避けるため定数で持つ）
+ATOMIC_APPEND_MAX = 4096
+APPEND_LOCK_NAME = ".append.lock"
+HOUSEKEEP_LOCK_NAME = ".housekeep.lock"
+
+# events-2026-01-01.jsonl / events-2026-01-01.003.jsonl / *.jsonl.gz / *.jsonl.zst
+SEGMENT_RE = re.compile(
+    r"^events-(?P<date>\d{4}-\d{2}-\d{2})(?:\.(?P<seq>\d{3,}))?\.jsonl(?P<ext>\.gz|\.zst)?$"
+)
+
+
+def active_segment(log_dir: Path = LOG_DIR, now: datetime | None = None) -> Path:
+    """書き込み先（当日分）のセグメント"""
+    now = now or datetime.now()
+    return log_dir / f"events-{now.strftime('%Y-%m-%d')}.jsonl"
+
+
+def list_segments(log_dir: Path = LOG_DIR) -> list[Path]:
+    """全セグメント（圧縮済み含む）を日付・連番順に返す"""
+    def key(p: Path):
+        m = SEGMENT_RE.match(p.name)
+        # 連番なし（書き込み中）は同じ日付の中で最後
+        seq = int(m.group("seq")) if m.group("seq") else 10 ** 9
+        return (m.group("date"), seq, p.name)
+
+    return sorted((p for p in log_dir.glob("events-*") if SEGMENT_RE.match(p.name)), key=key)
+
+
+# ==============================================================================
+# ローテーション（書き込み時）
+# ==============================================================================
+
+def _next_sequence(log_dir: Path, date: str) -> int:
+    seqs = [
+        int(m.group("seq"))
+        for p in log_dir.glob(f"events-{date}.*")
+        if (m := SEGMENT_RE.match(p.name)) and m.group("seq")
+    ]
+    return max(seqs, default=0) + 1
+
+
+def _needs_rotation(path: Path, incoming: int) -> bool:
+    try:
+        size = path.stat().st_size
+    except FileNotFoundError:
+        return False
+    return size > 0 and size + incoming > SEGMENT_MAX_BYTES
+
+
+def rotate_if_needed(path: Path, incoming: int = 0) -> bool:
+    """書き込み中セグメントがサイズ上限を超えるなら連番付きの名前に rename する。
+    複数プロセスが同時に上限を超えても同じ連番へ上書き rename しないよう、
+    ロックを取ってからサイズを確認し直す。
+    他プロセスが開いていて rename できない場合（Windows）は次回に回す。"""
+    if not _needs_rotation(path, incoming):
+        return False
+
+    with append_lock(path.parent):
+        if not _needs_rotation(path, incoming):
+            return False  # 他プロセスが先にローテーションした
+        date = SEGMENT_RE.match(path.name).group("date")
+        target = path.with_name(f"events-{date}.{_next_sequence(path.parent, date):03d}.jsonl")
+        try:
+            os.rename(path, target)
+            return True
+        except OSError:
+            return False
+
+
+# ==============================================================================
+# 追記（複数プロセスから同時に書かれる）
+# ==============================================================================
+
+@contextmanager
+def append_lock(directory: Path):
+    """ディレクトリ単位の排他ロック（ブロッキング）。
+    対象ファイルそのものは rename されるため、別のロックファイルに対して取る。"""
+    f = open(Path(directory) / APPEND_LOCK_NAME, "a+b")
+    try:
+        if sys.platform == "win32":
+            import msvcrt
+            f.seek(0)
+            # LK_LOCK は取れるまで最大10秒再試行し、それでも取れなければ OSError
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            yield  # flock は close で解放される
+    finally:
+        f.close()
+
+
+def _write_all(fd: int, data: bytes):
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def append_record(path: Path, data: bytes, lock_dir: Path | None = None):
+    """1レコード（改行終端のバイト列）をファイル末尾に追記する。
+
+    - PIPE_BUF 以下のレコードは O_APPEND の fd への1回の os.write で書く。
+      カーネルがオフセット更新と書き込みを一体で行うため、同時に追記しても行が混ざらない。
+    - それより大きいレコード、および Windows ではロックを取ってから書く。
+    - バッファ付きの open(..., "a") と違い、途中まで flush された行が残ることはない。
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o600)
+    try:
+        if len(data) <= ATOMIC_APPEND_MAX and sys.platform != "win32":
+            os.write(fd, data)
+            return
+        with append_lock(lock_dir or path.parent):
+            _write_all(fd, data)
+    finally:
+        os.close(fd)
+
+
+def append_line(line: str, log_dir: Path = LOG_DIR):
+    """1行を書き込み中セグメントに追記する（必要ならローテーションしてから）"""
+    log_dir.mkdir(parents=True, exist_ok=True)
+    path = active_segment(log_dir)
+    # errors="replace": Windowsパス等に含まれるサロゲート文字でのUnicodeEncodeErrorを防止
+    data = line.encode("utf-8", errors="replace")
+    rotate_if_needed(path, len(data))
+    append_record(path, data, log_dir)
+
+
+# ==============================================================================
+# 圧縮・保持期間（ハウスキーピング）
+# ==============================================================================
+
+def load_index(log_dir: Path = LOG_DIR) -> dict:
+    try:
+        return json.loads((log_dir / INDEX_FILE_NAME).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+def save_index(index: dict, log_dir: Path = LOG_DIR):
+    path = log_dir / INDEX_FILE_NAME
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(index, indent=2, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def _compressor():
+    """(拡張子, 書き込み用ファイルを開く関数)。zstd が使えなければ gzip。"""
+    if COMPRESSION == "zstd":
+        try:
+            import zstandard
+
+            def open_zstd(path):
+                return zstandard.ZstdCompressor(level=10).stream_writer(open(path, "wb"))
+            return ".zst", open_zstd
+        except ImportError:
+            pass
+    import gzip
+    return ".gz", lambda path: gzip.open(path, "wb", compresslevel=6)
+
+
+@contextmanager
+def housekeep_lock(directory: Path):
+    """ハウスキーピング用の排他ロック（非ブロッキング）。取れたら True、他のプロセスが実行中なら False。"""
+    f = open(Path(directory) / HOUSEKEEP_LOCK_NAME, "a+b")
+    try:
+        try:
+            if sys.platform == "win32":
+                import msvcrt
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        yield True  # close で解放される（Windows もハンドルを閉じればロックは外れる）
+    finally:
+        f.close()
+
+
+def is_sealed(path: Path, now: float | None = None) -> bool:
+    """書き込みが終わった（圧縮してよい）非圧縮セグメントか"""
+    m = SEGMENT_RE.match(path.name)
+    if not m or m.group("ext"):
+        return False
+    if path == active_segment(path.parent):
+        return False
+    now = now or time.time()
+    try:
+        return now - path.stat().st_mtime >= SEAL_GRACE_SECONDS
+    except FileNotFoundError:
+        return False
+
+
+def compress_segment(path: Path, index: dict) -> Path | None:
+    """セグメントを圧縮して元ファイルを削除し、索引にイベント数を記録する。
+    一覧を取ってから圧縮するまでに消えていたセグメントは飛ばして None を返す。"""
+    ext, opener = _compressor()
+    target = path.with_name(path.name + ext)
+    tmp = target.with_name(f"{target.name}.{os.getpid()}.tmp")
+    events = 0
+    try:
+        with open(path, "rb") as src:
+            raw_bytes = os.fstat(src.fileno()).st_size
+            with opener(tmp) as dst:
+                for line in src:
+                    dst.write(line)
+                    events += 1
+    except FileNotFoundError:
+        tmp.unlink(missing_ok=True)
+        return None
+    os.replace(tmp, target)
+    index[target.name] = {"events": events, "raw_bytes": raw_bytes}
+    path.unlink(missing_ok=True)
+    return target
+
+
+def _uploaded_names(log_dir: Path) -> set[str] | None:
+    """最後まで送信済みのセグメント名。記録が無ければ None（アップローダー未使用）。"""
+    manifest = log_dir / UPLOAD_MANIFEST_NAME
+    legacy = log_dir / UPLOADED_FILE_NAME
+    try:
+        if manifest.exists():
+            files = json.loads(manifest.read_text(encoding="utf-8")).get("files", {})
+            return {name for name, entry in files.items() if entry.get("complete")}
+        if legacy.exists():
+            data = json.loads(legacy.read_text(encoding="utf-8"))
+            return set(data) if isinstance(data, list) else set()
+    except (OSError, ValueError, AttributeError):
+        return set()
+    return None
+
+
+def enforce_retention(log_dir: Path, index: dict, budget: int = RETENTION_BYTES) -> list[Path]:
+    """合計サイズが budget を超えていれば古い圧縮済みセグメントから削除する。
+    アップローダーを使っている場合は、アップロード済みのものだけを削除対象にする。"""
+    segments = list_segments(log_dir)
+    total = sum(p.stat().st_size for p in segments)
+    uploaded = _uploaded_names(log_dir)
+    removed = []
+    for path in segments:
+        if total <= budget:
+            break
+        if not SEGMENT_RE.match(path.name).group("ext"):
+            continue
+        if uploaded is not None and path.name not in uploaded:
+            continue
+        total -= path.stat().st_size
+        path.unlink()
+        index.pop(path.name, None)
+        removed.append(path)
+    return removed
+
+
+def housekeep(log_dir: Path = LOG_DIR):
+    """閉じたセグメントの圧縮と保持容量の適用。SessionStart やデーモンから呼ぶ。
+    他のプロセスが実行中なら何もしない（索引の読み書きもロックの中で行う）。"""
+    if not log_dir.exists():
+        return
+    with housekeep_lock(log_dir) as locked:
+        if locked:
+            _housekeep(log_dir)
+
+
+def _housekeep(log_dir: Path):
+    index = load_index(log_dir)
+    now = time.time()
+    if COMPRESSION != "none":
+        for path in list_segments(log_dir):
+            if is_sealed(path, now):
+                compress_segment(path, index)
+    enforce_retention(log_dir, index)
+    # 実在しないファイルの索引を掃除
+    names = {p.name for p in list_segments(log_dir)}
+    for name in [n for n in index if n not in names]:
+        index.pop(name)
+    save_index(index, log_dir)
@@ -13,11 +13,11 @@ Claude Code Usage Tracker - Event Sender
 import json
 import sys
 import os
-import hashlib
-import socket
 from datetime import datetime, timezone
 from pathlib import Path
-import argparse
+
+# hashlib / socket / argparse / requests は必要な経路でのみ import する
+# （Hook の起動時間を抑えるため。local_only では標準ライブラリのみで動作する）
 
 # ==============================================================================
 # 設定
@@ -35,6 +35,46 @@ CONFIG = {
     # S3経由で収集する構成ではAPIエンドポイント不要のためデフォルトTrue
     # APIエンドポイントを使う場合のみ環境変数で "false" を指定すること
     "local_only": os.environ.get("USAGE_TRACKER_LOCAL_ONLY", "true").lower() == "true",
+    # true: スプールに追記してバックグラウンドのシッパーがバッチ送信（Hook をブロックしない）
+    # false: 従来どおり Hook 内で1件ずつ同期送信
+    "spool": os.environ.get("USAGE_TRACKER_SPOOL", "true").lower() == "true",
+    # 保存・送信するペイロードの大きさ: minimal / standard / full（PAYLOAD_PROFILES 参照）
+    "payload_profile": os.environ.get("USAGE_TRACKER_PAYLOAD_PROFILE", "standard").lower(),
+}
+
+# ペイロードプロファイル: フィールドごとの上限バイト数（UTF-8 / JSON 直列化後）
+#   上限以下 → そのまま
+#   上限超過 → {"_truncated", "bytes", "sha256"}（サイズ+ハッシュの要約）に置換
+#              ただし上限が 1 以上の文字列は先頭を上限まで残し、要約は
+#              payload["truncated_fields"][フィールド名] に記録する
+# 分類（categories）・output_length・停止理由などの判定は切り詰め前の値で行う。
+# raw_input（stdin の生データ）からは、上限を持つフィールドのうちペイロード直下にも
+# コピーしたもの（tool_response・tool_input など）を除いてから上限を適用する
+# （直下の値が切り詰め済みのコピーになるため。生データ経由で上限を素通りさせない）。
+PAYLOAD_PROFILES = {
+    "minimal": {
+        "raw_input": 0,
+        "tool_input": 0,
+        "tool_response": 0,
+        "prompt": 0,
+        "last_assistant_message": 0,
+        "custom_instructions": 0,
+        "message": 256,
+        "title": 256,
+        "error": 256,
+    },
+    "standard": {
+        "raw_input": 4096,
+        "tool_input": 2048,
+        "tool_response": 0,
+        "prompt": 0,
+        "last_assistant_message": 1024,
+        "custom_instructions": 1024,
+        "message": 1024,
+        "title": 1024,
+        "error": 2048,
+    },
+    "full": {},
 }
 
 # ログディレクトリ
@@ -52,10 +92,14 @@ def get_user_identifier() -> str:
     if user_id:
         return user_id
 
+    import socket
+
     username = os.environ.get("USER") or os.environ.get("USERNAME") or "unknown"
     hostname = socket.gethostname()
 
     if CONFIG["anonymize_user"]:
+        import hashlib
+
         # ハッシュ化して匿名化
         raw = f"{username}@{hostname}"
         return hashlib.sha256(raw.encode()).hexdigest()[:16]
@@ -106,6 +150,62 @@ def get_project_name() -> str:
     return "unknown"
 
 
+# ==============================================================================
+# 識別情報キャッシュ
+# ==============================================================================
+# user_id / team_id / project は同じ環境変数のもとでは変わらないため、
+# SessionStart で1回だけ計算して LOG_DIR/.identity-<フィンガープリント>.json に保存し、
+# PreToolUse / PostToolUse などはそれを読むだけにする（socket / hashlib の import と
+# gethostname・ハッシュ計算を省く）。
+# フィンガープリントはデーモンと同じ env_fingerprint()（USAGE_TRACKER_* と
+# CLAUDE_PROJECT_DIR / USER / USERNAME）なので、これらが変われば別のキャッシュになる。
+
+_identity_cache: dict | None = None
+
+
+def _identity_cache_path() -> Path:
+    from hook_client import env_fingerprint
+
+    return LOG_DIR / f".identity-{env_fingerprint()}.json"
+
+
+def compute_identity() -> dict:
+    return {
+        "user_id": get_user_identifier(),
+        "team_id": CONFIG["team_id"],
+        "project": get_project_name(),
+    }
+
+
+def get_identity(refresh: bool = False) -> dict:
+    """共通ヘッダ（user_id / team_id / project）を返す。
+    refresh=True（SessionStart）のときは計算し直してキャッシュを書き換える。"""
+    global _identity_cache
+    if _identity_cache is not None and not refresh:
+        return _identity_cache
+
+    path = _identity_cache_path()
+    if not refresh:
+        try:
+            cached = json.loads(path.read_text(encoding="utf-8"))
+            if isinstance(cached, dict) and cached.keys() >= {"user_id", "team_id", "project"}:
+                _identity_cache = cached
+                return cached
+        except (OSError, ValueError):
+            pass
+
+    identity = compute_identity()
+    try:
+        LOG_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(identity, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
+    except OSError:
+        pass  # キャッシュできなくても毎回計算すればよい
+    _identity_cache = identity
+    return identity
+
+
 # 利用上限に関連するキーワード（Claude Codeが出すメッセージ）
 USAGE_LIMIT_KEYWORDS = [
     "usage limit reached",
@@ -123,6 +223,65 @@ USAGE_LIMIT_KEYWORDS = [
 ]
 
 
+# 停止理由判定で読むトランスクリプト末尾の行数
+STOP_REASON_TAIL_LINES = 30
+# これ以上のサイズのトランスクリプトは mmap で末尾を走査する
+TAIL_MMAP_THRESHOLD = 64 * 1024 * 1024
+_TAIL_BLOCK_SIZE = 8192
+
+_usage_limit_re = None
+
+
+def _usage_limit_pattern():
+    """USAGE_LIMIT_KEYWORDS を1本の正規表現（OR結合）にコンパイルしてキャッシュする"""
+    global _usage_limit_re
+    if _usage_limit_re is None:
+        import re
+        _usage_limit_re = re.compile("|".join(re.escape(kw) for kw in USAGE_LIMIT_KEYWORDS))
+    return _usage_limit_re
+
+
+def read_tail_lines(path: Path, n: int, use_mmap: bool | None = None) -> list[str]:
+    """ファイル末尾から n 行だけを読む（全体は読まない）。
+
+    末尾からブロック単位で逆方向に seek し、改行が n+1 個見つかった時点で止める。
+    use_mmap=None の場合は TAIL_MMAP_THRESHOLD 以上のファイルで mmap を使う。
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return []
+        if use_mmap is None:
+            use_mmap = size >= TAIL_MMAP_THRESHOLD
+
+        if use_mmap:
+            import mmap
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # 末尾の改行は行の終端なので数えない
+                start = size - 1 if mm[size - 1:size] == b"\n" else size
+                for _ in range(n):
+                    start = mm.rfind(b"\n", 0, start)
+                    if start < 0:
+                        break
+                data = mm[start + 1:] if start >= 0 else mm[:]
+        else:
+            blocks: list[bytes] = []
+            newlines = 0
+            pos = size
+            while pos > 0 and newlines <= n:
+                read_size = min(_TAIL_BLOCK_SIZE, pos)
+                pos -= read_size
+                f.seek(pos)
+                block = f.read(read_size)
+                blocks.append(block)
+                newlines += block.count(b"\n")
+            data = b"".join(reversed(blocks))
+
+    lines = data.decode("utf-8", errors="ignore").splitlines()
+    return lines[-n:]
+
+
 def detect_stop_reason(transcript_path: str) -> str:
     """トランスクリプトファイルの末尾を読んで停止理由を判定する。
 
@@ -139,15 +298,12 @@ def detect_stop_reason(transcript_path: str) -> str:
         return "unknown"
 
     try:
-        # 末尾 30 行だけ読む（大きいファイルでも高速）
-        text = path.read_text(encoding="utf-8", errors="ignore")
-        lines = text.splitlines()
-        recent_lines = lines[-30:] if len(lines) >= 30 else lines
+        # 末尾 30 行だけ読む（末尾から seek するので数十MBのファイルでも一定時間）
+        recent_lines = read_tail_lines(path, STOP_REASON_TAIL_LINES)
         content_lower = " ".join(recent_lines).lower()
 
-        for keyword in USAGE_LIMIT_KEYWORDS:
-            if keyword in content_lower:
-                return "usage_limit"
+        if _usage_limit_pattern().search(content_lower):
+            return "usage_limit"
 
         return "normal"
     except Exception:
@@ -156,26 +312,50 @@ def detect_stop_reason(transcript_path: str) -> str:
 
 def is_usage_limit_message(text: str) -> bool:
     """テキストが利用上限メッセージかどうか判定する"""
-    text_lower = text.lower()
-    return any(kw in text_lower for kw in USAGE_LIMIT_KEYWORDS)
+    return _usage_limit_pattern().search(text.lower()) is not None
 
 
 # ==============================================================================
 # イベントペイロード作成
 # ==============================================================================
 
-def create_event_payload(event_type: str, input_data: dict) -> dict:
-    """イベントペイロードを作成（全情報取得版）"""
+def make_event_id(event_type: str, input_data: dict, timestamp: str, user_id: str) -> str:
+    """イベントを一意に表す固定長の ID（32桁hex）。
+    同じ Hook 呼び出し（デーモン経由・プロセス内処理のどちらでも Hook 起動時刻を使う）からは
+    常に同じ値になるため、Snowflake の LAYER2 はこの列だけで重複排除できる。"""
+    import hashlib
+
+    key = "\0".join((
+        user_id,
+        input_data.get("session_id", ""),
+        event_type,
+        timestamp,
+        input_data.get("tool_use_id", "") or input_data.get("agent_id", ""),
+    ))
+    return hashlib.blake2b(key.encode("utf-8", errors="replace"), digest_size=16).hexdigest()
+
+
+def create_event_payload(event_type: str, input_data: dict,
+                         now: datetime | None = None) -> dict:
+    """イベントペイロードを作成（全情報取得版）
+
+    now: イベント発生時刻。デーモン経由で遅延処理する場合に Hook 起動時刻を渡す。
+    """
 
-    now = datetime.now(timezone.utc)
+    if now is None:
+        now = datetime.now(timezone.utc)
 
     # ── 共通フィールド ──────────────────────────────────────────
+    # SessionStart で識別情報を計算し直し、それ以外はキャッシュを使う
+    identity = get_identity(refresh=event_type == "SessionStart")
+    timestamp = now.isoformat()
     payload = {
+        "event_id": make_event_id(event_type, input_data, timestamp, identity["user_id"]),
         "event_type": event_type,
-        "timestamp": now.isoformat(),
-        "user_id": get_user_identifier(),
-        "team_id": CONFIG["team_id"],
-        "project": get_project_name(),
+        "timestamp": timestamp,
+        "user_id": identity["user_id"],
+        "team_id": identity["team_id"],
+        "project": identity["project"],
         "session_id": input_data.get("session_id", ""),
         "transcript_path": input_data.get("transcript_path", ""),
         "cwd": input_data.get("cwd", ""),
@@ -255,6 +435,51 @@ def create_event_payload(event_type: str, input_data: dict) -> dict:
         transcript_path = input_data.get("transcript_path", "")
         payload["stop_reason"] = detect_stop_reason(transcript_path)
 
+    return apply_payload_profile(payload, CONFIG["payload_profile"])
+
+
+def _summarize(encoded: bytes) -> dict:
+    import hashlib
+
+    return {
+        "_truncated": True,
+        "bytes": len(encoded),
+        "sha256": hashlib.sha256(encoded).hexdigest()[:16],
+    }
+
+
+def apply_payload_profile(payload: dict, profile: str) -> dict:
+    """プロファイルの上限を超えるフィールドを切り詰める（書き込み前に1回だけ適用）"""
+    caps = PAYLOAD_PROFILES.get(profile, PAYLOAD_PROFILES["standard"])
+    truncated = {}
+
+    raw = payload.get("raw_input")
+    if isinstance(raw, dict):
+        payload["raw_input"] = {
+            k: v for k, v in raw.items()
+            if not (k in caps and k != "raw_input" and k in payload)
+        }
+
+    for field, cap in caps.items():
+        if field not in payload:
+            continue
+        value = payload[field]
+        if isinstance(value, str):
+            encoded = value.encode("utf-8", errors="replace")
+        else:
+            encoded = json.dumps(value, ensure_ascii=False).encode("utf-8", errors="replace")
+        if len(encoded) <= cap:
+            continue
+
+        summary = _summarize(encoded)
+        if isinstance(value, str) and cap > 0:
+            payload[field] = encoded[:cap].decode("utf-8", errors="ignore")
+            truncated[field] = summary
+        else:
+            payload[field] = summary
+
+    if truncated:
+        payload["truncated_fields"] = truncated
     return payload
 
 
@@ -266,10 +491,19 @@ def send_event(payload: dict) -> bool:
     """イベントをサーバーに送信"""
     if CONFIG["local_only"]:
         return True
+
+    if CONFIG["spool"]:
+        try:
+            from shipper import ensure_shipper, spool_event
+
+            spool_event(payload)
+            ensure_shipper()
+            return True
+        except Exception as e:
+            log_error(f"spool: {e}")
+            # スプールに書けない場合は同期送信にフォールバック
     
     try:
-        import requests
-        
         headers = {
             "Content-Type": "application/json",
         }
@@ -277,6 +511,12 @@ def send_event(payload: dict) -> bool:
         if CONFIG["api_key"]:
             headers["Authorization"] = f"Bearer {CONFIG['api_key']}"
         
+        try:
+            import requests
+        except ImportError:
+            # uv を経由せず素の python で起動された場合は urllib で送信
+            return _post_with_urllib(payload, headers)
+        
         response = requests.post(
             CONFIG["api_endpoint"],
             json=payload,
@@ -291,16 +531,23 @@ def send_event(payload: dict) -> bool:
         return False
 
 
-def log_locally(payload: dict):
-    """イベントをローカルにも保存（バックアップ/デバッグ用）"""
-    LOG_DIR.mkdir(parents=True, exist_ok=True)
+def _post_with_urllib(payload: dict, headers: dict) -> bool:
+    """requests が無い環境向けの標準ライブラリ版 POST"""
+    import urllib.request
+
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8", errors="replace")
+    req = urllib.request.Request(
+        CONFIG["api_endpoint"], data=body, headers=headers, method="POST")
+    with urllib.request.urlopen(req, timeout=5) as response:
+        return response.status == 200
 
-    date_str = datetime.now().strftime("%Y-%m-%d")
-    log_file = LOG_DIR / f"events-{date_str}.jsonl"
 
-    # errors="replace": Windowsパス等に含まれるサロゲート文字でのUnicodeEncodeErrorを防止
-    with open(log_file, "a", encoding="utf-8", errors="replace") as f:
-        f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+def log_locally(payload: dict):
+    """イベントをローカルにも保存（バックアップ/デバッグ用）
+    サイズ・日付でローテーションするセグメントに追記する（log_segments.py）"""
+    import log_segments
+
+    log_segments.append_line(json.dumps(payload, ensure_ascii=False) + "\n", LOG_DIR)
 
 
 def log_error(error: str):
@@ -314,11 +561,40 @@ def log_error(error: str):
         f.write(f"[{timestamp}] {error}\n")
 
 
+def handle_event(event_type: str, input_data: dict,
+                 now: datetime | None = None) -> dict:
+    """ペイロード作成 → ローカル保存 → サーバー送信 を一括で行う"""
+    payload = create_event_payload(event_type, input_data, now=now)
+
+    # ローカルに保存（常に）
+    log_locally(payload)
+
+    # サーバーに送信
+    send_event(payload)
+
+    # セッション開始時に閉じたログセグメントの圧縮・保持容量の適用を行う
+    if event_type == "SessionStart":
+        housekeep_logs()
+
+    return payload
+
+
+def housekeep_logs():
+    """閉じたログセグメントの圧縮・保持容量の適用（失敗してもイベント処理は止めない）"""
+    try:
+        import log_segments
+        log_segments.housekeep(LOG_DIR)
+    except Exception as e:
+        log_error(f"housekeep: {e}")
+
+
 # ==============================================================================
 # メイン
 # ==============================================================================
 
 def main():
+    import argparse
+
     parser = argparse.ArgumentParser(description="Claude Code Usage Tracker")
     parser.add_argument("--event-type", required=True, help="Hook event type")
     
@@ -330,17 +606,8 @@ def main():
     except (json.JSONDecodeError, EOFError):
         input_data = {}
     
-    # イベントペイロードを作成
-    payload = create_event_payload(
-        event_type=args.event_type,
-        input_data=input_data
-    )
-    
-    # ローカルに保存（常に）
-    log_locally(payload)
-    
-    # サーバーに送信
-    send_event(payload)
+    # ペイロード作成・保存・送信
+    handle_event(args.event_type, input_data)
     
     # 正常終了（Hookをブロックしない）
     sys.exit(0)
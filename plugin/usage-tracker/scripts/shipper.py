@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+"""
+Claude Code Usage Tracker - Spool Shipper
+USAGE_TRACKER_LOCAL_ONLY=false のとき、Hook はイベントをスプールに追記するだけにして、
+このシッパーがバックグラウンドでサーバーの bulk エンドポイントへまとめて送信する。
+
+- スプール: ~/.claude/usage-tracker-logs/spool/spool-YYYYMMDDHH.jsonl（1行1イベント）
+- 送信先  : USAGE_TRACKER_BATCH_ENDPOINT（未設定時は API エンドポイント + "/bulk"）。
+            スプールの行をそのまま gzip NDJSON で送り、行ごとの受理・拒否を受け取る
+- 送信済み位置はファイルごとのバイトオフセットで .checkpoint.json に記録する
+- 送信前に「送信中の範囲」も記録し、再起動時は同じ範囲を同じバッチIDで再送する
+  （サーバーはバッチIDで重複排除するため、取りこぼしも二重登録も起きない）
+- 失敗時は指数バックオフで再試行する。同時に動くシッパーはロックで1つに制限する
+
+Usage:
+    python shipper.py            # スプールが空になるまで送信して終了
+    python shipper.py --follow   # 常駐して送信し続ける
+"""
+
+import gzip
+import json
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import log_segments
+import send_event
+from send_event import CONFIG, LOG_DIR, log_error
+
+# ==============================================================================
+# 設定
+# ==============================================================================
+
+SPOOL_DIR = LOG_DIR / "spool"
+CHECKPOINT_FILE = SPOOL_DIR / ".checkpoint.json"
+LOCK_FILE = SPOOL_DIR / ".shipper.lock"
+REJECTED_FILE = SPOOL_DIR / "rejected.jsonl"
+
+BATCH_MAX_EVENTS = int(os.environ.get("USAGE_TRACKER_BATCH_MAX_EVENTS", "500"))
+BATCH_MAX_BYTES = int(os.environ.get("USAGE_TRACKER_BATCH_MAX_BYTES", str(1024 * 1024)))
+POLL_INTERVAL = 2.0          # スプールを確認する間隔（秒）
+IDLE_EXIT_AFTER = 30.0       # 単発モードで空のまま待つ時間（秒）
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 300.0
+# 最終更新からこの秒数が過ぎた過去のスプールだけを削除する
+# （時刻が変わる直前にファイル名を決めた Hook の追記が終わるのを待つ）
+CLEANUP_GRACE_SECONDS = 120
+
+# サーバーが内容を理由に拒否した（再送しても通らない）ステータス。
+# これ以外の 4xx/5xx（401/403 の API キー誤り、404 の送信先誤り、408、429 など）は
+# 設定や一時的な障害とみなし、チェックポイントを進めずにバックオフして再送する。
+REJECT_STATUSES = (400, 413, 422)
+
+
+def batch_endpoint() -> str:
+    override = os.environ.get("USAGE_TRACKER_BATCH_ENDPOINT", "").strip()
+    if override:
+        return override
+    return CONFIG["api_endpoint"].rstrip("/") + "/bulk"
+
+
+# ==============================================================================
+# スプールへの追記（Hook 側）
+# ==============================================================================
+
+def spool_event(payload: dict):
+    """イベントを現在時刻のスプールファイルへ1行追記する。
+    ローカルログと同じ append_record で書くため、複数プロセスが同時に追記しても行が混ざらない。"""
+    SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+    path = SPOOL_DIR / f"spool-{datetime.now().strftime('%Y%m%d%H')}.jsonl"
+    line = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8", errors="replace")
+    log_segments.append_record(path, line)
+
+
+# ==============================================================================
+# ロック（同時に動くシッパーを1つにする）
+# ==============================================================================
+
+def try_lock():
+    """排他ロックを非ブロッキングで取得。取れなければ None。"""
+    SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+    f = open(LOCK_FILE, "a+b")
+    try:
+        if sys.platform == "win32":
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return f
+    except OSError:
+        f.close()
+        return None
+
+
+def ensure_shipper():
+    """シッパーが動いていなければバックグラウンドで起動する"""
+    lock = try_lock()
+    if lock is None:
+        return  # 既に稼働中
+    lock.close()
+
+    import subprocess
+
+    kwargs = {
+        "stdin": subprocess.DEVNULL,
+        "stdout": subprocess.DEVNULL,
+        "stderr": subprocess.DEVNULL,
+        "close_fds": True,
+    }
+    if sys.platform == "win32":
+        kwargs["creationflags"] = (
+            subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+        )
+    else:
+        kwargs["start_new_session"] = True
+    try:
+        subprocess.Popen([sys.executable, str(Path(__file__).resolve())], **kwargs)
+    except OSError as e:
+        log_error(f"shipper: 起動失敗: {e}")
+
+
+# ==============================================================================
+# チェックポイント
+# ==============================================================================
+
+def load_checkpoint() -> dict:
+    """{"offsets": {ファイル名: 送信済みオフセット}, "inflight": {file, start, end} | None}"""
+    try:
+        data = json.loads(CHECKPOINT_FILE.read_text(encoding="utf-8"))
+        return {
+            "offsets": {k: int(v) for k, v in data.get("offsets", {}).items()},
+            "inflight": data.get("inflight"),
+        }
+    except (OSError, ValueError, AttributeError):
+        return {"offsets": {}, "inflight": None}
+
+
+def save_checkpoint(checkpoint: dict):
+    """一時ファイルに書いてから置き換える（途中でクラッシュしても壊れない）"""
+    tmp = CHECKPOINT_FILE.with_suffix(".tmp")
+    tmp.write_text(json.dumps(checkpoint, indent=2), encoding="utf-8")
+    os.replace(tmp, CHECKPOINT_FILE)
+
+
+# ==============================================================================
+# HTTP（keep-alive で1本の接続を使い回す）
+# ==============================================================================
+
+class BatchClient:
+    """http.client の持続接続で gzip NDJSON のバッチを POST する"""
+
+    def __init__(self, endpoint: str, api_key: str = ""):
+        from urllib.parse import urlsplit
+
+        url = urlsplit(endpoint)
+        self.https = url.scheme == "https"
+        self.netloc = url.netloc
+        self.path = url.path or "/"
+        if url.query:
+            self.path += "?" + url.query
+        self.headers = {
+            "Content-Type": "application/x-ndjson",
+            "Content-Encoding": "gzip",
+            "Connection": "keep-alive",
+        }
+        if api_key:
+            self.headers["Authorization"] = f"Bearer {api_key}"
+        self.conn = None
+
+    def post(self, batch_id: str, body: bytes) -> tuple[int, bytes]:
+        """(ステータス, 応答本文) を返す。batch_id はクエリで渡す（サーバーが重複排除に使う）"""
+        import http.client
+        from urllib.parse import quote
+
+        if self.conn is None:
+            cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            self.conn = cls(self.netloc, timeout=30)
+        path = self.path + ("&" if "?" in self.path else "?") + "batch_id=" + quote(batch_id, safe="")
+        try:
+            self.conn.request("POST", path, body=body, headers=self.headers)
+            response = self.conn.getresponse()
+            data = response.read()
+            if response.will_close:
+                self.close()
+            return response.status, data
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+# ==============================================================================
+# シッパー本体
+# ==============================================================================
+
+def read_batch(path: Path, offset: int, stop: int | None = None) -> tuple[list[bytes], int]:
+    """offset から完結した行だけを最大 BATCH_MAX_EVENTS / BATCH_MAX_BYTES 分読む。
+    stop を指定した場合はその位置まで（再送時に範囲を固定するため）。
+    戻り値は (行リスト, 読み終えた位置)。書きかけの最終行は次回に回す。"""
+    lines: list[bytes] = []
+    size = 0
+    end = offset
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if stop is not None:
+                if end >= stop:
+                    break
+            elif not line.endswith(b"\n") or (lines and size + len(line) > BATCH_MAX_BYTES):
+                break
+            lines.append(line)
+            size += len(line)
+            end += len(line)
+            if stop is None and len(lines) >= BATCH_MAX_EVENTS:
+                break
+    return lines, end
+
+
+def build_body(lines: list[bytes]) -> bytes:
+    """スプールの行をそのまま gzip NDJSON にする（行番号はサーバーの results の line と一致する）"""
+    return gzip.compress(b"".join(lines), compresslevel=6)
+
+
+def rejected_lines(status: int, data: bytes, lines: list[bytes]) -> list[bytes]:
+    """サーバーが受理しなかった行。results があれば accepted 以外の行、
+    無ければ（413 など本文ごとの拒否）全行。重複（再送）なら前回の送信で処理済みなので無し。"""
+    try:
+        response = json.loads(data)
+    except ValueError:
+        response = {}
+    if not isinstance(response, dict):
+        response = {}
+    if response.get("duplicate"):
+        return []
+    if "results" not in response:
+        return [] if 200 <= status < 300 else lines
+    accepted = {r.get("line") for r in response["results"] if r.get("status") == "accepted"}
+    return [line for i, line in enumerate(lines, start=1) if i not in accepted and line.strip()]
+
+
+class Shipper:
+    def __init__(self, client: BatchClient | None = None):
+        self.client = client or BatchClient(batch_endpoint(), CONFIG["api_key"])
+        self.checkpoint = load_checkpoint()
+        self.offsets: dict[str, int] = self.checkpoint["offsets"]
+        self.source = send_event.get_user_identifier()
+        self.failures = 0
+        self.stop_event = threading.Event()
+
+    def _backoff(self) -> float:
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** self.failures))
+        return delay * (0.5 + random.random() / 2)
+
+    def _cleanup(self, files: list[Path]):
+        """送信し終えた過去のスプールファイルを削除する"""
+        current = f"spool-{datetime.now().strftime('%Y%m%d%H')}.jsonl"
+        now = time.time()
+        changed = False
+        for path in files:
+            if path.name == current or not self._fully_shipped(path, now):
+                continue
+            # 大きいレコードの追記と同じロックの中で確認し直してから削除する
+            with log_segments.append_lock(SPOOL_DIR):
+                if not self._fully_shipped(path, now):
+                    continue
+                path.unlink(missing_ok=True)
+            self.offsets.pop(path.name, None)
+            changed = True
+        # 既に存在しないファイルのチェックポイントを掃除
+        names = {p.name for p in files}
+        for name in [n for n in self.offsets if n not in names]:
+            self.offsets.pop(name)
+            changed = True
+        if changed:
+            save_checkpoint(self.checkpoint)
+
+    def _fully_shipped(self, path: Path, now: float) -> bool:
+        """最後まで送信済みで、しばらく追記されていないか"""
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return False
+        return (self.offsets.get(path.name, 0) >= st.st_size
+                and now - st.st_mtime >= CLEANUP_GRACE_SECONDS)
+
+    def _ship_range(self, path: Path, start: int, stop: int | None) -> int:
+        """[start, stop) の範囲を1バッチとして送信し、チェックポイントを進める"""
+        lines, end = read_batch(path, start, stop)
+        if not lines:
+            return 0
+        batch_id = f"{self.source}:{path.name}:{start}-{end}"
+        body = build_body(lines)
+
+        # 送信前に範囲を記録（クラッシュ後も同じ範囲・同じIDで再送する）
+        self.checkpoint["inflight"] = {"file": path.name, "start": start, "end": end}
+        save_checkpoint(self.checkpoint)
+
+        status, data = self.client.post(batch_id, body)
+        if status not in REJECT_STATUSES and not 200 <= status < 300:
+            raise RuntimeError(f"batch endpoint returned {status}")
+        bad = rejected_lines(status, data, lines)
+        if bad:
+            # リトライしても通らない行は退避して先へ進む
+            log_error(f"shipper: batch {batch_id}: {len(bad)} lines rejected ({status})")
+            with open(REJECTED_FILE, "ab") as f:
+                f.writelines(bad)
+
+        self.offsets[path.name] = end
+        self.checkpoint["inflight"] = None
+        save_checkpoint(self.checkpoint)
+        return len(lines)
+
+    def ship_pending(self) -> int:
+        """スプールの未送信分を送る。送信したイベント数を返す。
+        送信に失敗した場合は例外を投げる（呼び出し側でバックオフ）。"""
+        shipped = 0
+        inflight = self.checkpoint.get("inflight")
+        if inflight:
+            path = SPOOL_DIR / inflight["file"]
+            if path.exists():
+                shipped += self._ship_range(path, inflight["start"], inflight["end"])
+            else:
+                self.checkpoint["inflight"] = None
+
+        files = sorted(SPOOL_DIR.glob("spool-*.jsonl"))
+        for path in files:
+            while True:
+                sent = self._ship_range(path, self.offsets.get(path.name, 0), None)
+                if not sent:
+                    break
+                shipped += sent
+        self._cleanup(files)
+        return shipped
+
+    def run(self, follow: bool = False):
+        """スプールを送信し続ける。follow=False なら一定時間空なら終了する。"""
+        idle_since = time.monotonic()
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    if self.ship_pending():
+                        idle_since = time.monotonic()
+                    self.failures = 0
+                    wait = POLL_INTERVAL
+                except Exception as e:
+                    self.failures += 1
+                    wait = self._backoff()
+                    log_error(f"shipper: 送信失敗 (retry in {wait:.1f}s): {e}")
+                    idle_since = time.monotonic()
+                if not follow and time.monotonic() - idle_since >= IDLE_EXIT_AFTER:
+                    break
+                self.stop_event.wait(wait)
+        finally:
+            self.client.close()
+
+
+def start_in_thread() -> threading.Thread | None:
+    """常駐プロセス（collector_daemon）内でシッパーをスレッドとして動かす"""
+    lock = try_lock()
+    if lock is None:
+        return None
+
+    def _run():
+        try:
+            Shipper().run(follow=True)
+        finally:
+            lock.close()
+
+    thread = threading.Thread(target=_run, daemon=True)
+    thread.start()
+    return thread
+
+
+# ==============================================================================
+# メイン
+# ==============================================================================
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Usage Tracker spool shipper")
+    parser.add_argument("--follow", action="store_true", help="常駐して送信し続ける")
+    args = parser.parse_args()
+
+    lock = try_lock()
+    if lock is None:
+        return  # 他のシッパーが稼働中
+    try:
+        Shipper().run(follow=args.follow)
+    finally:
+        lock.close()
+
+
+if __name__ == "__main__":
+    main()
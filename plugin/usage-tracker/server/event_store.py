@@ -0,0 +1,432 @@
+"""
+Claude Code Usage Tracker - Event Store
+API サーバーのインメモリイベントストア（固定容量・列指向のリングバッファ）
+
+- 容量分の NumPy 配列を起動時に確保し、満杯になったら最も古いイベントを上書きする
+  （list.pop(0) と違い、追加・削除とも O(1)）
+- 各イベントに 1 から始まる連番 seq を振る。古いイベントが捨てられても番号は再利用しない
+- 集計エンドポイントが使う列だけを持つ:
+    timestamp  … int64 の epoch 秒（受信時に1回だけパース）
+    watermark  … それまでに受信したイベントの timestamp の最大値（受信順に単調増加する時刻索引）
+    team / user / tool / event_type … 辞書エンコードした int32 のコード（未使用スロットは -1）
+    categories … uint8 のビットマスク（FLAG_*）
+  ペイロードの dict（metadata・categories の dict を含む）は保持しない
+- 期間の集計は watermark を二分探索して「start 以降のイベントを含み得る最初の行」から先だけを読む（since）。
+  イベントはほぼ時刻順に届くため、読む行数は保持件数ではなく期間内の件数に比例する。
+  遅れて届いた古いイベント（シッパーの再送など）も範囲に含まれ、時刻のマスクで除かれる
+- 受信時にチーム別の1分・1時間・1日のバケット（RollingCounters）も更新する。
+  /api/stats・/api/tools・/api/timeline は行を読まずにバケットを合計する（期間の端は1分単位）。
+  リングから捨てたイベントはバケットから差し引くため、集計は常に保持中のイベントと一致する
+- 容量は USAGE_TRACKER_MAX_EVENTS（既定 50000）
+
+FastAPI に依存しない（benchmarks/bench_event_store.py から直接読み込むため）。
+"""
+
+import os
+from datetime import datetime, timezone
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_CAPACITY = int(os.environ.get("USAGE_TRACKER_MAX_EVENTS", "50000"))
+
+# categories のビット
+FLAG_SKILL = 1
+FLAG_SUBAGENT = 2
+FLAG_MCP = 4
+FLAG_COMMAND = 8
+FLAG_FILE_OPERATION = 16
+
+CATEGORY_FLAGS = {
+    "skill": FLAG_SKILL,
+    "subagent": FLAG_SUBAGENT,
+    "mcp": FLAG_MCP,
+    "command": FLAG_COMMAND,
+    "file_operation": FLAG_FILE_OPERATION,
+}
+
+
+def parse_timestamp(ts: str) -> int:
+    """ISO 8601 の文字列を epoch 秒にする（タイムゾーン無しは UTC とみなす）"""
+    dt = datetime.fromisoformat(ts.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+def category_bits(categories: Optional[Dict[str, bool]]) -> int:
+    bits = 0
+    for name, flag in CATEGORY_FLAGS.items():
+        if categories and categories.get(name):
+            bits |= flag
+    return bits
+
+
+class Codes:
+    """値 ⇔ int32 コードの辞書（チーム・ユーザー・ツール・イベント種別用）"""
+
+    __slots__ = ("values", "_index")
+
+    def __init__(self):
+        self.values: List[Hashable] = []
+        self._index: Dict[Hashable, int] = {}
+
+    def encode(self, value: Hashable) -> int:
+        code = self._index.get(value)
+        if code is None:
+            code = self._index[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def lookup(self, value: Hashable) -> int:
+        """value のコード。一度も出てきていない値は -1（未使用の行と同じ値なので、比較の前に除くこと）"""
+        return self._index.get(value, -1)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+# ==============================================================================
+# 集計バケット（受信時に加算し、リングから捨てたイベントは減算する）
+# ==============================================================================
+
+# バケットが数える件数（/api/stats・/api/timeline と同じ定義）
+COUNTER_FIELDS = ("messages", "sessions", "tools", "mcp", "skill", "subagent", "command")
+TOOL_EVENT_TYPES = ("PreToolUse", "PostToolUse")
+
+# バケットの粒度（秒）。期間の端は細かい粒度、間は粗い粒度のバケットを足す
+MINUTE = 60
+HOUR = 3600
+DAY = 86400
+TIERS = (MINUTE, HOUR, DAY)
+
+
+def counter_vector(event_type: str, flags: int) -> Tuple[bool, ...]:
+    """イベント1件が COUNTER_FIELDS のどれに数えられるか"""
+    return (
+        event_type == "UserPromptSubmit",
+        event_type == "SessionStart",
+        event_type in TOOL_EVENT_TYPES,
+        bool(flags & FLAG_MCP),
+        bool(flags & FLAG_SKILL),
+        event_type == "SubagentStop",
+        bool(flags & FLAG_COMMAND),
+    )
+
+
+def _bump(counter: Dict[int, int], key: int, delta: int):
+    n = counter.get(key, 0) + delta
+    if n:
+        counter[key] = n
+    else:
+        counter.pop(key, None)
+
+
+class Bucket:
+    """1分・1時間・1日の件数。
+    users はユーザーコードごとのイベント数で、キーの数がアクティブユーザー数になる
+    （ユーザーは辞書エンコード済みの少数の整数なので、近似スケッチではなく正確な集合で持ち、減算もできる）。
+    tools はツールコードごとの PreToolUse / PostToolUse の件数（ツールのイベントが無ければ None）。"""
+
+    __slots__ = ("events", "counts", "users", "tools")
+
+    def __init__(self):
+        self.events = 0
+        self.counts = [0] * len(COUNTER_FIELDS)
+        self.users: Dict[int, int] = {}
+        self.tools: Optional[Dict[int, int]] = None   # 1分バケットが大半なので必要になるまで作らない
+
+    def add(self, vector: Tuple[bool, ...], user: int, tool: int, delta: int):
+        self.events += delta
+        for i, hit in enumerate(vector):
+            if hit:
+                self.counts[i] += delta
+        _bump(self.users, user, delta)
+        if vector[2]:
+            if self.tools is None:
+                self.tools = {}
+            _bump(self.tools, tool, delta)
+
+    def count(self, field: str) -> int:
+        return self.counts[COUNTER_FIELDS.index(field)]
+
+
+class Totals:
+    """複数のバケットの合計。users はユーザーコードの集合（len がアクティブユーザー数）。"""
+
+    __slots__ = ("events", "counts", "users", "tools")
+
+    def __init__(self):
+        self.events = 0
+        self.counts = [0] * len(COUNTER_FIELDS)
+        self.users: set = set()
+        self.tools: Dict[int, int] = {}
+
+    def merge(self, bucket: Bucket):
+        self.events += bucket.events
+        self.counts = [a + b for a, b in zip(self.counts, bucket.counts)]
+        self.users.update(bucket.users)
+        for tool, n in (bucket.tools or {}).items():
+            self.tools[tool] = self.tools.get(tool, 0) + n
+
+    def count(self, field: str) -> int:
+        return self.counts[COUNTER_FIELDS.index(field)]
+
+
+class TeamCounters:
+    __slots__ = ("tiers", "users")
+
+    def __init__(self):
+        # TIERS と同じ順の {epoch 分・時・日（UTC）: バケット}
+        self.tiers: Tuple[Dict[int, Bucket], ...] = tuple({} for _ in TIERS)
+        self.users: Dict[int, int] = {}   # 保持中の全イベントのユーザー別件数
+
+
+class RollingCounters:
+    """チーム別の1分・1時間・1日バケット"""
+
+    __slots__ = ("teams",)
+
+    def __init__(self):
+        self.teams: Dict[str, TeamCounters] = {}
+
+    def update(self, team_id: str, user: int, tool: int, ts: int, event_type: str, flags: int,
+               delta: int = 1):
+        """イベント1件を加算（delta=-1 で減算）する。空になったバケットは削除する。"""
+        team = self.teams.get(team_id)
+        if team is None:
+            team = self.teams[team_id] = TeamCounters()
+        vector = counter_vector(event_type, flags)
+        for size, buckets in zip(TIERS, team.tiers):
+            key = ts // size
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = Bucket()
+            bucket.add(vector, user, tool, delta)
+            if bucket.events == 0:
+                del buckets[key]
+        _bump(team.users, user, delta)
+
+    def total_users(self, team_id: str) -> int:
+        team = self.teams.get(team_id)
+        return len(team.users) if team else 0
+
+    def _collect(self, team: TeamCounters, result: Totals, lo: int, hi: Optional[int],
+                 tier: int = len(TIERS) - 1):
+        """lo <= timestamp < hi のバケットを result に足す（lo・hi は分の境界。hi が None なら上限なし）。
+        tier の粒度で割り切れる範囲はその粒度のバケット、端は1つ細かい粒度で足す。"""
+        size, buckets = TIERS[tier], team.tiers[tier]
+        if tier == 0:
+            keys = range(lo // size, hi // size)
+        else:
+            first = -(-lo // size)                          # lo 以降で最初の境界
+            last = None if hi is None else hi // size
+            if last is not None and first > last:           # 1つの区間の中に収まる
+                self._collect(team, result, lo, hi, tier - 1)
+                return
+            self._collect(team, result, lo, first * size, tier - 1)
+            if last is not None:
+                self._collect(team, result, last * size, hi, tier - 1)
+                keys = range(first, last)
+            else:
+                keys = [key for key in buckets if key >= first]
+        for key in keys:
+            bucket = buckets.get(key)
+            if bucket is not None:
+                result.merge(bucket)
+
+    def window(self, team_id: str, start: int, end: Optional[int] = None) -> Totals:
+        """start <= timestamp < end の合計（epoch 秒。end が None なら上限なし。start・end は分単位に切り捨て）"""
+        result = Totals()
+        team = self.teams.get(team_id)
+        if team is not None:
+            self._collect(team, result, start // MINUTE * MINUTE,
+                          None if end is None else end // MINUTE * MINUTE)
+        return result
+
+    def daily(self, team_id: str, start: int) -> Dict[int, Any]:
+        """start 以降の日別（epoch 日 → Bucket）。最初の日は start からの合計（Totals）。"""
+        team = self.teams.get(team_id)
+        if team is None:
+            return {}
+        start = start // MINUTE * MINUTE
+        first_day = -(-start // DAY)
+        result = {}
+        head = Totals()
+        self._collect(team, head, start, first_day * DAY, len(TIERS) - 2)
+        if head.events:
+            result[first_day - 1] = head
+        for day, bucket in team.tiers[-1].items():
+            if day >= first_day:
+                result[day] = bucket
+        return result
+
+
+# 列の名前（EventRing と EventView で共通）
+COLUMNS = ("timestamp", "team", "user", "tool", "event_type", "flags")
+
+
+class EventView:
+    """EventRing の連続した範囲の列（読み取り専用）と、集計用のマスク"""
+
+    __slots__ = COLUMNS + ("_store",)
+
+    def __init__(self, store: "EventRing", columns: Dict[str, np.ndarray]):
+        self._store = store
+        for name in COLUMNS:
+            setattr(self, name, columns[name])
+
+    def __len__(self) -> int:
+        return len(self.timestamp)
+
+    def window(self, team_id: str, start: Optional[int] = None, end: Optional[int] = None) -> np.ndarray:
+        """team_id のイベントのうち start <= timestamp < end のもの（epoch 秒。None は無制限）"""
+        code = self._store.teams.lookup(team_id)
+        if code < 0:
+            return np.zeros(len(self), dtype=bool)
+        mask = self.team == code
+        if start is not None:
+            mask &= self.timestamp >= start
+        if end is not None:
+            mask &= self.timestamp < end
+        return mask
+
+    def has_flag(self, flag: int) -> np.ndarray:
+        return (self.flags & flag) != 0
+
+    def is_type(self, *event_types: str) -> np.ndarray:
+        codes = [code for code in map(self._store.event_types.lookup, event_types) if code >= 0]
+        return np.isin(self.event_type, codes)
+
+
+class EventRing:
+    """固定容量の列指向リングバッファ。seq のイベントは行 (seq - 1) % capacity に入る。"""
+
+    __slots__ = COLUMNS + (
+        "capacity", "_next_seq", "watermark", "_watermark",
+        "teams", "users", "tools", "event_types", "counters",
+    )
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self._next_seq = 1
+        self.timestamp = np.zeros(capacity, dtype=np.int64)
+        self.team = np.full(capacity, -1, dtype=np.int32)
+        self.user = np.full(capacity, -1, dtype=np.int32)
+        self.tool = np.full(capacity, -1, dtype=np.int32)
+        self.event_type = np.full(capacity, -1, dtype=np.int32)
+        self.flags = np.zeros(capacity, dtype=np.uint8)
+        self.watermark = np.zeros(capacity, dtype=np.int64)
+        self._watermark = np.iinfo(np.int64).min
+        self.teams = Codes()
+        self.users = Codes()
+        self.tools = Codes()
+        self.event_types = Codes()
+        self.counters = RollingCounters()
+
+    def append(self, *, timestamp: str, team_id: str, user_id: str, event_type: str,
+               tool_name: Optional[str] = None, categories: Optional[Dict[str, bool]] = None,
+               **_: Any) -> int:
+        """イベントを追加して seq を返す。満杯なら最も古いイベントを上書きする。
+        集計に使わないフィールドはキーワード引数で渡されても捨てる。"""
+        ts = parse_timestamp(timestamp)
+        seq = self._next_seq
+        row = (seq - 1) % self.capacity
+        if seq > self.capacity:
+            self._evict(row)
+        self.timestamp[row] = ts
+        if ts > self._watermark:
+            self._watermark = ts
+        self.watermark[row] = self._watermark
+        user = self.users.encode(user_id)
+        tool = self.tools.encode(tool_name)
+        flags = category_bits(categories)
+        self.team[row] = self.teams.encode(team_id)
+        self.user[row] = user
+        self.tool[row] = tool
+        self.event_type[row] = self.event_types.encode(event_type)
+        self.flags[row] = flags
+        self.counters.update(team_id, user, tool, ts, event_type, flags)
+        self._next_seq = seq + 1
+        return seq
+
+    def _evict(self, row: int):
+        """上書きされる行のイベントを集計バケットから差し引く"""
+        self.counters.update(
+            self.teams.values[self.team[row]], int(self.user[row]), int(self.tool[row]),
+            int(self.timestamp[row]), self.event_types.values[self.event_type[row]],
+            int(self.flags[row]), delta=-1,
+        )
+
+    @property
+    def first_seq(self) -> int:
+        """保持している最も古いイベントの seq（空なら last_seq + 1）"""
+        return max(1, self._next_seq - self.capacity)
+
+    @property
+    def last_seq(self) -> int:
+        """最後に追加したイベントの seq（空なら 0）"""
+        return self._next_seq - 1
+
+    @property
+    def evicted(self) -> int:
+        """容量超過で捨てたイベント数"""
+        return self.first_seq - 1
+
+    @property
+    def nbytes(self) -> int:
+        """列の配列が確保しているバイト数（辞書は含まない）"""
+        return sum(getattr(self, name).nbytes for name in COLUMNS + ("watermark",))
+
+    def __len__(self) -> int:
+        return min(self._next_seq - 1, self.capacity)
+
+    def get(self, seq: int) -> Optional[Dict[str, Any]]:
+        """seq のイベント（保持している列だけ）。捨てられた・未発行の seq は None。"""
+        if not self.first_seq <= seq <= self.last_seq:
+            return None
+        row = (seq - 1) % self.capacity
+        flags = int(self.flags[row])
+        return {
+            "timestamp": datetime.fromtimestamp(int(self.timestamp[row]), timezone.utc).isoformat(),
+            "team_id": self.teams.values[self.team[row]],
+            "user_id": self.users.values[self.user[row]],
+            "tool_name": self.tools.values[self.tool[row]],
+            "event_type": self.event_types.values[self.event_type[row]],
+            "categories": {name: bool(flags & flag) for name, flag in CATEGORY_FLAGS.items()},
+        }
+
+    # --------------------------------------------------------------------------
+    # 期間の読み出し
+    # --------------------------------------------------------------------------
+
+    def _segments(self) -> List[slice]:
+        """保持している行を古い順に並べた区間（リングが一周していれば2つ）"""
+        size = len(self)
+        if size < self.capacity:
+            return [slice(0, size)]
+        head = (self._next_seq - 1) % self.capacity
+        return [slice(head, self.capacity), slice(0, head)]
+
+    def since(self, start: Optional[int] = None) -> EventView:
+        """timestamp >= start のイベントを含み得る範囲（start が None なら全件）。
+        watermark は受信順に単調増加するので、範囲の先頭は二分探索（searchsorted）で求まる。
+        範囲には遅れて届いた start より前のイベントも含まれるため、集計では時刻でも絞ること。"""
+        segments = self._segments()
+        if start is not None:
+            for i, seg in enumerate(segments):
+                offset = int(np.searchsorted(self.watermark[seg], start, side="left"))
+                if seg.start + offset < seg.stop:
+                    segments = [slice(seg.start + offset, seg.stop)] + segments[i + 1:]
+                    break
+            else:
+                segments = []
+        if len(segments) == 1:
+            columns = {name: getattr(self, name)[segments[0]] for name in COLUMNS}
+        else:
+            columns = {name: np.concatenate([getattr(self, name)[seg] for seg in segments])
+                       if segments else getattr(self, name)[:0]
+                       for name in COLUMNS}
+        return EventView(self, columns)
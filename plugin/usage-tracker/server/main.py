@@ -3,20 +3,27 @@ Claude Code Usage Tracker - API Server
 チームの利用状況を収集・保存・提供するバックエンドAPI
 """
 
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, TypeAdapter, ValidationError, field_validator
 from typing import Optional, List, Dict, Any
 from datetime import datetime, timedelta, timezone
-from collections import defaultdict
+from collections import OrderedDict
 import json
 import os
+import zlib
+
+import numpy as np
+
+from event_store import EventRing, FLAG_COMMAND, FLAG_MCP, FLAG_SKILL, parse_timestamp
 
 # ==============================================================================
 # Models
 # ==============================================================================
 
 class EventPayload(BaseModel):
+    event_id: Optional[str] = None
     event_type: str
     timestamp: str
     user_id: str
@@ -31,6 +38,18 @@ class EventPayload(BaseModel):
     error: Optional[str] = None
     metadata: Optional[Dict[str, Any]] = {}
 
+    @field_validator("timestamp")
+    @classmethod
+    def _check_timestamp(cls, value: str) -> str:
+        parse_timestamp(value)  # 解釈できない時刻は 422 にする（ストアは受信時に epoch 秒へ変換する）
+        return value
+
+
+class EventBatch(BaseModel):
+    """JSON 配列でのバッチ送信（batch_id で重複排除）。各イベントは ingest_lines で1件ずつ検証する"""
+    batch_id: str
+    events: List[Dict[str, Any]]
+
 
 class DashboardStats(BaseModel):
     skill_count: int
@@ -66,9 +85,205 @@ class UserStats(BaseModel):
 # Storage (本番ではFirestore/PostgreSQLに置き換え)
 # ==============================================================================
 
-events_store: List[Dict] = []
+# 固定容量・列指向のリングバッファ（容量は USAGE_TRACKER_MAX_EVENTS。超えた分は古いものから上書き）
+events_store = EventRing()
 API_KEY = os.environ.get("USAGE_TRACKER_API_KEY", "")
 
+# 受信済みバッチID（再送の重複排除用。古いものから捨てる）
+recent_batches: "OrderedDict[str, int]" = OrderedDict()
+MAX_RECENT_BATCHES = 10000
+
+
+def store_event(payload: EventPayload) -> int:
+    """イベントを保存して連番（古いイベントが捨てられても再利用しない）を返す"""
+    return events_store.append(
+        timestamp=payload.timestamp,
+        team_id=payload.team_id,
+        user_id=payload.user_id,
+        event_type=payload.event_type,
+        tool_name=payload.tool_name,
+        categories=payload.categories,
+    )
+
+
+# ==============================================================================
+# Bulk NDJSON（/api/events/bulk）
+# ==============================================================================
+
+# 1回の検証でまとめて扱う行数
+BULK_BATCH_LINES = int(os.environ.get("USAGE_TRACKER_BULK_BATCH_LINES", "500"))
+# 受信チャンク1つから一度に展開する上限（高圧縮率の gzip でもメモリを抑える）
+BULK_INFLATE_CHUNK = 1024 * 1024
+# 1行の上限バイト数（超えた行は次の改行まで読み捨てて拒否する。改行の無い本文でメモリを使い切らない）
+BULK_MAX_LINE_BYTES = int(os.environ.get("USAGE_TRACKER_BULK_MAX_LINE_BYTES", str(1024 * 1024)))
+
+_events_adapter = TypeAdapter(List[EventPayload])
+_event_adapter = TypeAdapter(EventPayload)
+
+
+def describe_error(error: ValidationError) -> str:
+    """行ごとの拒否理由（先頭3件まで）"""
+    parts = []
+    for err in error.errors(include_url=False)[:3]:
+        loc = ".".join(str(x) for x in err["loc"])
+        parts.append(f"{loc}: {err['msg']}" if loc else err["msg"])
+    return "; ".join(parts)
+
+
+def validate_lines(lines: List[bytes]) -> List[Any]:
+    """NDJSON の行をまとめて検証する。各行は EventPayload か拒否理由の文字列になる。
+
+    まず全行を1つの JSON 配列として TypeAdapter(List[EventPayload]) で一度に検証し、
+    失敗した場合（壊れた行・不正な行を含む）だけ1行ずつ検証し直す。
+    1行に複数の値が書かれていると配列の要素数が行数とずれるため、その場合も1行ずつに戻す。
+    """
+    try:
+        payloads = _events_adapter.validate_json(b"[" + b",".join(lines) + b"]")
+        if len(payloads) == len(lines):
+            return payloads
+    except ValidationError:
+        pass
+    
+    results = []
+    for line in lines:
+        try:
+            results.append(_event_adapter.validate_json(line))
+        except ValidationError as e:
+            results.append(describe_error(e))
+    return results
+
+
+class BulkBodyError(Exception):
+    """本文の gzip が壊れている・途中で切れている（line_no はそれまでに読み終えた行番号）"""
+
+    def __init__(self, detail: str, line_no: int):
+        super().__init__(detail)
+        self.detail = detail
+        self.line_no = line_no
+
+
+async def iter_ndjson(request: Request, gzipped: bool):
+    """リクエストボディを受信しながら展開し、空行を除いた行を (行番号, 行) で返す。
+    本文全体をメモリに載せない。連結された gzip（複数メンバー）にも対応する。
+    BULK_MAX_LINE_BYTES を超える行は読み捨てて (行番号, None) を返す。
+    gzip が壊れていれば、それまでの行を返した後に BulkBodyError を送出する。"""
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+    received = False
+    pending = b""
+    skipping = False  # 長すぎる行の残りを読み捨てている途中
+    line_no = 0
+    
+    def inflate(data: bytes):
+        nonlocal decoder
+        while data:
+            if decoder.eof:
+                decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)  # 次の gzip メンバー
+            yield decoder.decompress(data, BULK_INFLATE_CHUNK)
+            data = decoder.unconsumed_tail or decoder.unused_data
+    
+    try:
+        async for chunk in request.stream():
+            received = received or bool(chunk)
+            for data in (inflate(chunk) if decoder else (chunk,)):
+                pending += data
+                *lines, pending = pending.split(b"\n")
+                for line in lines:
+                    line_no += 1
+                    if skipping or len(line) > BULK_MAX_LINE_BYTES:
+                        skipping = False
+                        yield line_no, None
+                    elif line.strip():
+                        yield line_no, line
+                if len(pending) > BULK_MAX_LINE_BYTES:
+                    skipping = True
+                    pending = b""
+    except zlib.error as e:
+        raise BulkBodyError(f"Invalid gzip body after line {line_no}: {e}", line_no)
+    
+    if decoder and received and not decoder.eof:
+        raise BulkBodyError(f"Truncated gzip body after line {line_no}", line_no)
+    if skipping:
+        yield line_no + 1, None
+    elif pending.strip():
+        yield line_no + 1, pending
+
+
+def reserve_batch(batch_id: Optional[str]) -> bool:
+    """batch_id を受信済みとして記録する。既に受信済みなら False（batch_id が無ければ常に True）。
+    await を挟まずに確認と記録を行うため、同じ batch_id の同時送信も一方だけが通る。"""
+    if batch_id is None:
+        return True
+    if batch_id in recent_batches:
+        return False
+    recent_batches[batch_id] = 0
+    while len(recent_batches) > MAX_RECENT_BATCHES:
+        recent_batches.popitem(last=False)
+    return True
+
+
+async def ingest_lines(lines, batch_id: Optional[str]):
+    """(行番号, 行) を BULK_BATCH_LINES 行ずつまとめて検証し、通った行から保存する。
+    /api/events/bulk と /api/events/batch の共通処理で、重複排除と受理・拒否の扱いはここにだけある。
+
+    - 行が None（BULK_MAX_LINE_BYTES 超過）・不正な行は results で行ごとに拒否する（他の行に影響しない）
+    - 同じ batch_id の再送は保存せず duplicate: true を返す
+    - 本文が壊れていた場合（BulkBodyError）はそれまでの行を保存し、400 で results と last_line を返す
+    """
+    if not reserve_batch(batch_id):
+        return {"status": "ok", "accepted": 0, "rejected": 0, "duplicate": True, "results": []}
+    
+    results = []
+    accepted = 0
+    
+    def flush(numbers: List[int], chunk: List[Optional[bytes]]):
+        nonlocal accepted
+        validated = iter(validate_lines([line for line in chunk if line is not None]))
+        for line_no, line in zip(numbers, chunk):
+            payload = "line too long" if line is None else next(validated)
+            if isinstance(payload, EventPayload):
+                results.append({"line": line_no, "status": "accepted", "event_id": store_event(payload)})
+                accepted += 1
+            else:
+                results.append({"line": line_no, "status": "rejected", "error": payload})
+        if batch_id is not None and batch_id in recent_batches:
+            recent_batches[batch_id] = accepted
+    
+    numbers: List[int] = []
+    chunk: List[Optional[bytes]] = []
+    try:
+        async for line_no, line in lines:
+            numbers.append(line_no)
+            chunk.append(line)
+            if len(chunk) >= BULK_BATCH_LINES:
+                flush(numbers, chunk)
+                numbers, chunk = [], []
+    except BulkBodyError as e:
+        if chunk:
+            flush(numbers, chunk)
+        return JSONResponse(status_code=400, content={
+            "status": "error",
+            "detail": e.detail,
+            "accepted": accepted,
+            "rejected": len(results) - accepted,
+            "duplicate": False,
+            "last_line": e.line_no,
+            "results": results,
+        })
+    if chunk:
+        flush(numbers, chunk)
+    
+    return {
+        "status": "ok",
+        "accepted": accepted,
+        "rejected": len(results) - accepted,
+        "duplicate": False,
+        "results": results,
+    }
+
+
+def iso_from_epoch(ts: int) -> str:
+    return datetime.fromtimestamp(int(ts), timezone.utc).isoformat()
+
 
 # ==============================================================================
 # FastAPI App
@@ -118,21 +333,50 @@ async def root():
 
 @app.get("/health")
 async def health():
-    return {"status": "healthy", "events_count": len(events_store)}
+    return {
+        "status": "healthy",
+        "events_count": len(events_store),
+        "capacity": events_store.capacity,
+        "evicted": events_store.evicted,
+    }
 
 
 @app.post("/api/events")
 async def receive_event(payload: EventPayload, _: bool = Depends(verify_api_key)):
     """イベントを受信して保存"""
-    event = payload.dict()
-    event["received_at"] = datetime.now(timezone.utc).isoformat()
-    events_store.append(event)
-    
-    # メモリ制限
-    if len(events_store) > 50000:
-        events_store.pop(0)
+    return {"status": "ok", "event_id": store_event(payload)}
+
+
+@app.post("/api/events/batch")
+async def receive_batch(batch: EventBatch, _: bool = Depends(verify_api_key)):
+    """イベントを JSON 配列でまとめて受信して保存（同じ batch_id の再送は無視）。
+    扱いは /api/events/bulk と同じで、不正なイベントは results で1件ずつ拒否する（line は 1 始まりの位置）"""
+    async def lines():
+        for i, event in enumerate(batch.events, start=1):
+            yield i, json.dumps(event).encode()
     
-    return {"status": "ok", "event_id": len(events_store)}
+    return await ingest_lines(lines(), batch.batch_id)
+
+
+@app.post("/api/events/bulk")
+async def receive_bulk(
+    request: Request,
+    batch_id: Optional[str] = None,
+    content_encoding: Optional[str] = Header(None),
+    _: bool = Depends(verify_api_key)
+):
+    """gzip 圧縮した NDJSON（1行1イベント）を受信して保存し、行ごとの受理・拒否を返す（シッパーの送信先）
+
+    - Content-Encoding: gzip なら展開しながら、無ければそのまま1行ずつ読む
+    - 検証・保存・batch_id の重複排除は ingest_lines（/api/events/batch と共通）
+    - BULK_MAX_LINE_BYTES を超える行は "line too long" で拒否する
+    - gzip が途中で壊れている場合は 400。それまでに読めた行は保存し、results と
+      読み終えた最後の行番号（last_line）を返す。batch_id も記録済みなので、残りの行は別の batch_id で送る
+    """
+    encoding = (content_encoding or "identity").strip().lower()
+    if encoding not in ("gzip", "identity"):
+        raise HTTPException(status_code=415, detail=f"Unsupported Content-Encoding: {encoding}")
+    return await ingest_lines(iter_ndjson(request, encoding == "gzip"), batch_id)
 
 
 @app.get("/api/stats", response_model=DashboardStats)
@@ -146,49 +390,33 @@ async def get_stats(
     period_start = now - timedelta(days=days)
     prev_period_start = period_start - timedelta(days=days)
     
-    def parse_ts(ts_str):
-        return datetime.fromisoformat(ts_str.replace("Z", "+00:00"))
-    
-    current_events = [
-        e for e in events_store
-        if e.get("team_id") == team_id
-        and parse_ts(e["timestamp"]) >= period_start
-    ]
-    
-    prev_events = [
-        e for e in events_store
-        if e.get("team_id") == team_id
-        and prev_period_start <= parse_ts(e["timestamp"]) < period_start
-    ]
-    
-    def count_category(events, category):
-        return sum(1 for e in events if e.get("categories", {}).get(category, False))
-    
-    def count_event_type(events, event_type):
-        return sum(1 for e in events if e.get("event_type") == event_type)
+    # 受信時に更新している1分・1日バケットを合計する（イベントの行は読まない）
+    counters = events_store.counters
+    current = counters.window(team_id, int(period_start.timestamp()))
+    prev = counters.window(team_id, int(prev_period_start.timestamp()), int(period_start.timestamp()))
     
     # 現在期間
-    skill_count = count_category(current_events, "skill")
-    subagent_count = count_event_type(current_events, "SubagentStop")
-    mcp_count = count_category(current_events, "mcp")
-    message_count = count_event_type(current_events, "UserPromptSubmit")
-    session_count = count_event_type(current_events, "SessionStart")
-    command_count = count_category(current_events, "command")
+    skill_count = current.count("skill")
+    subagent_count = current.count("subagent")
+    mcp_count = current.count("mcp")
+    message_count = current.count("messages")
+    session_count = current.count("sessions")
+    command_count = current.count("command")
     
     # 前期間
-    prev_skill = count_category(prev_events, "skill")
-    prev_subagent = count_event_type(prev_events, "SubagentStop")
-    prev_mcp = count_category(prev_events, "mcp")
-    prev_message = count_event_type(prev_events, "UserPromptSubmit")
-    prev_session = count_event_type(prev_events, "SessionStart")
+    prev_skill = prev.count("skill")
+    prev_subagent = prev.count("subagent")
+    prev_mcp = prev.count("mcp")
+    prev_message = prev.count("messages")
+    prev_session = prev.count("sessions")
     
     def calc_change(current, prev):
         if prev == 0:
             return 100.0 if current > 0 else 0.0
         return round((current - prev) / prev * 100, 1)
     
-    active_users = len(set(e.get("user_id") for e in current_events))
-    total_users = len(set(e.get("user_id") for e in events_store if e.get("team_id") == team_id))
+    active_users = len(current.users)
+    total_users = counters.total_users(team_id)
     
     return DashboardStats(
         skill_count=skill_count,
@@ -220,46 +448,46 @@ async def get_user_stats(
     now = datetime.now(timezone.utc)
     period_start = now - timedelta(days=days)
     
-    filtered_events = [
-        e for e in events_store
-        if e.get("team_id") == team_id
-        and datetime.fromisoformat(e["timestamp"].replace("Z", "+00:00")) >= period_start
-    ]
+    start = int(period_start.timestamp())
+    view = events_store.since(start)
+    mask = view.window(team_id, start)
+    users = view.user[mask]
+    if users.size == 0:
+        return []
     
-    user_stats: Dict[str, Dict] = defaultdict(lambda: {
-        "skill_count": 0, "subagent_count": 0, "mcp_count": 0,
-        "command_count": 0, "message_count": 0, "total_count": 0, "last_active": ""
-    })
+    # ユーザーコードごとの件数（bincount の添字がユーザーコード）
+    n = len(events_store.users)
     
-    for e in filtered_events:
-        user_id = e.get("user_id", "unknown")
-        stats = user_stats[user_id]
-        stats["total_count"] += 1
-        
-        categories = e.get("categories", {})
-        if categories.get("skill"):
-            stats["skill_count"] += 1
-        if categories.get("mcp"):
-            stats["mcp_count"] += 1
-        if categories.get("command"):
-            stats["command_count"] += 1
-        
-        if e.get("event_type") == "SubagentStop":
-            stats["subagent_count"] += 1
-        if e.get("event_type") == "UserPromptSubmit":
-            stats["message_count"] += 1
-        
-        ts = e.get("timestamp", "")
-        if ts > stats["last_active"]:
-            stats["last_active"] = ts
+    def per_user(condition=None):
+        codes = users if condition is None else view.user[mask & condition]
+        return np.bincount(codes, minlength=n)
     
+    total = per_user()
+    skill = per_user(view.has_flag(FLAG_SKILL))
+    mcp = per_user(view.has_flag(FLAG_MCP))
+    command = per_user(view.has_flag(FLAG_COMMAND))
+    subagent = per_user(view.is_type("SubagentStop"))
+    message = per_user(view.is_type("UserPromptSubmit"))
+    last_active = np.zeros(n, dtype=np.int64)
+    np.maximum.at(last_active, users, view.timestamp[mask])
+    
+    top = [code for code in np.argsort(-total, kind="stable")[:limit] if total[code] > 0]
     result = []
-    for user_id, stats in user_stats.items():
+    for code in top:
+        user_id = events_store.users.values[code]
         display_name = user_id.split("@")[0] if "@" in user_id else user_id
-        result.append(UserStats(user_id=user_id, display_name=display_name, **stats))
-    
-    result.sort(key=lambda x: x.total_count, reverse=True)
-    return result[:limit]
+        result.append(UserStats(
+            user_id=user_id,
+            display_name=display_name,
+            skill_count=int(skill[code]),
+            subagent_count=int(subagent[code]),
+            mcp_count=int(mcp[code]),
+            command_count=int(command[code]),
+            message_count=int(message[code]),
+            total_count=int(total[code]),
+            last_active=iso_from_epoch(last_active[code]),
+        ))
+    return result
 
 
 @app.get("/api/tools")
@@ -272,21 +500,11 @@ async def get_tool_stats(
     now = datetime.now(timezone.utc)
     period_start = now - timedelta(days=days)
     
-    filtered_events = [
-        e for e in events_store
-        if e.get("team_id") == team_id
-        and e.get("event_type") in ["PostToolUse", "PreToolUse"]
-        and datetime.fromisoformat(e["timestamp"].replace("Z", "+00:00")) >= period_start
-    ]
-    
-    tool_counts: Dict[str, int] = defaultdict(int)
-    for e in filtered_events:
-        tool_counts[e.get("tool_name", "unknown")] += 1
-    
+    tool_counts = events_store.counters.window(team_id, int(period_start.timestamp())).tools
     sorted_tools = sorted(tool_counts.items(), key=lambda x: x[1], reverse=True)
     
     return {
-        "tools": [{"name": name, "count": count} for name, count in sorted_tools],
+        "tools": [{"name": events_store.tools.values[code], "count": count} for code, count in sorted_tools],
         "total": sum(tool_counts.values()),
     }
 
@@ -297,32 +515,18 @@ async def get_timeline(
     days: int = 7,
     _: bool = Depends(verify_api_key)
 ):
-    """時系列データを取得"""
+    """時系列データを取得（日付は UTC）"""
     now = datetime.now(timezone.utc)
     period_start = now - timedelta(days=days)
     
-    filtered_events = [
-        e for e in events_store
-        if e.get("team_id") == team_id
-        and datetime.fromisoformat(e["timestamp"].replace("Z", "+00:00")) >= period_start
-    ]
-    
-    daily_counts: Dict[str, Dict[str, int]] = defaultdict(lambda: {
-        "messages": 0, "tools": 0, "sessions": 0
-    })
-    
-    for e in filtered_events:
-        date = e.get("timestamp", "")[:10]
-        event_type = e.get("event_type", "")
-        
-        if event_type == "UserPromptSubmit":
-            daily_counts[date]["messages"] += 1
-        elif event_type in ["PostToolUse", "PreToolUse"]:
-            daily_counts[date]["tools"] += 1
-        elif event_type == "SessionStart":
-            daily_counts[date]["sessions"] += 1
+    daily = events_store.counters.daily(team_id, int(period_start.timestamp()))
     
-    timeline = [{"date": date, **counts} for date, counts in sorted(daily_counts.items())]
+    timeline = []
+    for day, bucket in sorted(daily.items()):
+        counts = {"messages": bucket.count("messages"), "tools": bucket.count("tools"),
+                  "sessions": bucket.count("sessions")}
+        if any(counts.values()):
+            timeline.append({"date": iso_from_epoch(day * 86400)[:10], **counts})
     return {"timeline": timeline}
 
 
@@ -254,7 +254,7 @@ function Show-LogFiles {
         return
     }
     
-    $logFiles = Get-ChildItem -Path $LogDir -Filter "events-*.jsonl" | Sort-Object Name
+    $logFiles = Get-ChildItem -Path $LogDir -Filter "events-*.jsonl*" | Where-Object { $_.Name -notlike "*.tmp" } | Sort-Object Name
     
     if ($logFiles.Count -eq 0) {
         Write-Info "No log files found"
@@ -272,10 +272,16 @@ function Show-LogFiles {
         $size = $file.Length
         $totalSize += $size
         
+        $sizeKB = [math]::Round($size / 1024, 1)
+        if ($file.Extension -ne ".jsonl") {
+            # Compressed segment (.jsonl.gz / .jsonl.zst): size only
+            Write-Host "  $($file.Name) ($sizeKB KB, compressed)"
+            continue
+        }
+        
         $eventCount = (Get-Content $file.FullName | Measure-Object -Line).Lines
         $totalEvents += $eventCount
         
-        $sizeKB = [math]::Round($size / 1024, 1)
         Write-Host "  $($file.Name) ($sizeKB KB, $eventCount events)"
     }
     
@@ -374,7 +380,7 @@ function Upload-ToS3 {
         return
     }
     
-    $logFiles = Get-ChildItem -Path $LogDir -Filter "events-*.jsonl" | Sort-Object Name
+    $logFiles = Get-ChildItem -Path $LogDir -Filter "events-*.jsonl*" | Where-Object { $_.Name -notlike "*.tmp" } | Sort-Object Name
     
     if ($logFiles.Count -eq 0) {
         Write-Info "No log files to upload"
@@ -7,12 +7,15 @@
     Action to perform: setup, upload, register-task, unregister-task
 .PARAMETER Force
     Force upload even if already uploaded
+.PARAMETER PutOnly
+    PUT only; loading is done by the server-side tasks (05_create_tasks.sql)
 #>
 
 param(
     [ValidateSet("setup", "upload", "register-task", "unregister-task")]
     [string]$Action = "setup",
-    [switch]$Force
+    [switch]$Force,
+    [switch]$PutOnly
 )
 
 $ErrorActionPreference = "Stop"
@@ -21,7 +24,8 @@ $ErrorActionPreference = "Stop"
 foreach ($varName in @(
     "SNOWFLAKE_ACCOUNT", "SNOWFLAKE_USER", "SNOWFLAKE_PRIVATE_KEY_PATH",
     "SNOWFLAKE_PRIVATE_KEY_PASSPHRASE", "SNOWFLAKE_WAREHOUSE",
-    "SNOWFLAKE_DATABASE", "SNOWFLAKE_SCHEMA", "USAGE_TRACKER_USER_ID"
+    "SNOWFLAKE_DATABASE", "SNOWFLAKE_SCHEMA", "USAGE_TRACKER_USER_ID",
+    "USAGE_TRACKER_PUT_ONLY"
 )) {
     if (-not [Environment]::GetEnvironmentVariable($varName, "Process")) {
         $userVal = [Environment]::GetEnvironmentVariable($varName, "User")
@@ -200,6 +204,7 @@ function Invoke-Upload {
 
     $args_list = @("run", $PythonScript, "--action", "upload")
     if ($Force) { $args_list += "--force" }
+    if ($PutOnly) { $args_list += "--put-only" }
 
     & $uvPath @args_list
 }
@@ -247,7 +252,7 @@ function Invoke-RegisterTask {
 
     $taskAction = New-ScheduledTaskAction `
         -Execute "powershell.exe" `
-        -Argument "-ExecutionPolicy Bypass -WindowStyle Hidden -File `"$wrapperPath`" -Action upload"
+        -Argument "-ExecutionPolicy Bypass -WindowStyle Hidden -File `"$wrapperPath`" -Action upload$(if ($PutOnly) { ' -PutOnly' })"
     $trigger = New-ScheduledTaskTrigger -Daily -At 3am
     $settings = New-ScheduledTaskSettingsSet -StartWhenAvailable -DontStopIfGoingOnBatteries
 
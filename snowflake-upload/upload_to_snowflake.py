@@ -13,28 +13,55 @@ LAYER1 → LAYER2 → LAYER3 のパイプラインでテーブルを更新する
 
 パイプライン:
   PUT → @LAYER1.STAGE
-  COPY INTO → LAYER1.RAW_EVENTS (VARIANT そのまま)
-  MERGE INTO → LAYER2.EVENTS (カラム展開・重複排除)
-  MERGE INTO → LAYER3.DAILY/USER/TOOL_SUMMARY
+  COPY INTO → LAYER1.RAW_EVENTS (VARIANT そのまま。RAW_RETENTION_DAYS を過ぎたら削除)
+  MERGE INTO → LAYER2.EVENTS (カラム展開・重複排除。RAW_EVENTS_STREAM の新しい行だけ)
+  MERGE INTO → LAYER3.DAILY/USER/TOOL/HOURLY/PROJECT/USER_TOOL_SUMMARY
+               (今回追加されたイベントの日・キーだけ再集計)
+  MERGE INTO → LAYER3.SESSION_SUMMARY (今回イベントが追加されたセッションだけ再集計)
+
+アップロードは差分のみ:
+  .upload_manifest.json にファイルごとの送信済みバイトオフセットと先頭部分のハッシュを記録し、
+  毎回オフセット以降の新しい行だけをチャンクファイル（events-DATE.cSTART-END.jsonl.gz）として PUT する。
+  ローテーション・圧縮で名前が変わったセグメントは先頭ハッシュで同じファイルと判定して引き継ぐ。
 
 Usage:
-    uv run upload_to_snowflake.py --action upload [--force]
+    uv run upload_to_snowflake.py --action upload [--force] [--workers 4] [--put-parallel 4] [--put-only]
     uv run upload_to_snowflake.py --action list
     uv run upload_to_snowflake.py --action config
     uv run upload_to_snowflake.py --action generate-key
+    uv run upload_to_snowflake.py --action task-sql     # 05_create_tasks.sql を再生成
+    uv run upload_to_snowflake.py --action lint-tasks   # タスク DAG の SQL を接続せずに検査
+    uv run upload_to_snowflake.py --action storage-report  # テーブルごとのストレージ使用量
 """
 
 import argparse
+import gzip
+import hashlib
 import json
 import os
+import re
 import sys
+import tempfile
+import time
 from pathlib import Path
 
 # ---------------------------------------------------------------------------
 # 定数
 # ---------------------------------------------------------------------------
 LOG_DIR = Path.home() / ".claude" / "usage-tracker-logs"
+# 旧形式のアップロード記録（ファイル名の一覧）。マニフェストが無いときだけ移行用に読む
 UPLOADED_FILE = LOG_DIR / ".uploaded_files.json"
+# ファイルごとの送信済みオフセット・先頭ハッシュ
+MANIFEST_FILE = LOG_DIR / ".upload_manifest.json"
+# 同じファイルかどうかの判定に使う先頭部分の長さ
+PREFIX_HASH_BYTES = 64 * 1024
+# 同時に PUT するファイル数（スレッド数）と、PUT 1回あたりの分割アップロード数（PARALLEL）
+DEFAULT_PUT_WORKERS = 4
+DEFAULT_PUT_PARALLEL = 4
+# プラグインが圧縮済みセグメントのイベント数を記録する索引（log_segments.py）
+SEGMENT_INDEX_FILE = LOG_DIR / ".segments.json"
+# 圧縮済みセグメントの拡張子（AUTO_COMPRESS=FALSE でそのまま PUT する）
+COMPRESSED_SUFFIXES = (".gz", ".zst")
 KEY_DIR = Path.home() / ".snowflake"
 
 STAGE = "CLAUDE_USAGE_DB.LAYER1.CLAUDE_USAGE_INTERNAL_STAGE"
@@ -49,22 +76,34 @@ _L3 = "CLAUDE_USAGE_DB.LAYER3"
 
 # STEP 1: Stage → LAYER1.RAW_EVENTS
 COPY_INTO_RAW_SQL = f"""
-COPY INTO {_L1}.RAW_EVENTS (RAW_DATA, SOURCE_FILE)
+COPY INTO {_L1}.RAW_EVENTS (RAW_DATA, SOURCE_FILE, SOURCE_ROW)
 FROM (
     SELECT
         $1,
-        METADATA$FILENAME
+        METADATA$FILENAME,
+        METADATA$FILE_ROW_NUMBER
     FROM @{STAGE}
 )
 ON_ERROR = 'CONTINUE';
 """.strip()
 
 # STEP 2: LAYER1.RAW_EVENTS → LAYER2.EVENTS (重複排除 MERGE)
-MERGE_EVENTS_SQL = f"""
-MERGE INTO {_L2}.EVENTS AS tgt
+# RAW_EVENTS 全体ではなく、APPEND_ONLY ストリーム RAW_EVENTS_STREAM（前回の MERGE 以降に
+# COPY された行だけ）を読む。ストリームは MERGE のコミットで消費される。
+RAW_EVENTS_STREAM = f"{_L1}.RAW_EVENTS_STREAM"
+
+
+def build_merge_events_sql(source: str, target: str = f"{_L2}.EVENTS") -> str:
+    """source（RAW_EVENTS またはそのストリーム）から target へ未登録のイベントだけを追加する MERGE。
+    同じ回に同じイベントが複数行含まれても1行だけ挿入されるよう QUALIFY で絞る。
+    重複排除キーは Hook が生成した event_id（32桁）。event_id の無い旧データだけ
+    RAW_DATA 全体の SHA2 を使う。
+    RAW_DATA 自体は LAYER2 に持たず、ステージ上の元ファイルと行番号（SOURCE_FILE, SOURCE_ROW）だけを残す。"""
+    return f"""
+MERGE INTO {target} AS tgt
 USING (
     SELECT
-        SHA2(RAW_DATA::VARCHAR)                                       AS EVENT_HASH,
+        COALESCE(RAW_DATA:event_id::VARCHAR, SHA2(RAW_DATA::VARCHAR)) AS EVENT_HASH,
         RAW_DATA:event_type::VARCHAR                                  AS EVENT_TYPE,
         CONVERT_TIMEZONE('UTC', 'Asia/Tokyo',
             TRY_TO_TIMESTAMP_NTZ(RAW_DATA:timestamp::VARCHAR))        AS EVENT_TIMESTAMP,
@@ -84,45 +123,180 @@ USING (
         COALESCE(RAW_DATA:categories:file_operation::BOOLEAN, FALSE)  AS IS_FILE_OPERATION,
         COALESCE(RAW_DATA:is_usage_limit::BOOLEAN,            FALSE)  AS IS_USAGE_LIMIT,
         RAW_DATA:stop_reason::VARCHAR                                 AS STOP_REASON,
-        RAW_DATA                                                      AS RAW_DATA
-    FROM {_L1}.RAW_EVENTS
+        SOURCE_FILE                                                   AS SOURCE_FILE,
+        SOURCE_ROW                                                    AS SOURCE_ROW
+    FROM {source}
     WHERE RAW_DATA:event_type IS NOT NULL
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY EVENT_HASH ORDER BY RECEIVED_AT) = 1
 ) AS src
 ON tgt.EVENT_HASH = src.EVENT_HASH
 WHEN NOT MATCHED THEN INSERT (
     EVENT_HASH, EVENT_TYPE, EVENT_TIMESTAMP, USER_ID, TEAM_ID,
     SESSION_ID, PROJECT_NAME, TOOL_NAME, TOOL_SUCCESS, OUTPUT_LENGTH,
     ERROR_MESSAGE, PROMPT_LENGTH, IS_SKILL, IS_SUBAGENT, IS_MCP,
-    IS_COMMAND, IS_FILE_OPERATION, IS_USAGE_LIMIT, STOP_REASON, RAW_DATA
+    IS_COMMAND, IS_FILE_OPERATION, IS_USAGE_LIMIT, STOP_REASON, SOURCE_FILE, SOURCE_ROW
 ) VALUES (
     src.EVENT_HASH, src.EVENT_TYPE, src.EVENT_TIMESTAMP, src.USER_ID, src.TEAM_ID,
     src.SESSION_ID, src.PROJECT_NAME, src.TOOL_NAME, src.TOOL_SUCCESS, src.OUTPUT_LENGTH,
     src.ERROR_MESSAGE, src.PROMPT_LENGTH, src.IS_SKILL, src.IS_SUBAGENT, src.IS_MCP,
-    src.IS_COMMAND, src.IS_FILE_OPERATION, src.IS_USAGE_LIMIT, src.STOP_REASON, src.RAW_DATA
+    src.IS_COMMAND, src.IS_FILE_OPERATION, src.IS_USAGE_LIMIT, src.STOP_REASON,
+    src.SOURCE_FILE, src.SOURCE_ROW
 );
 """.strip()
 
+
+# 通常はストリームの差分だけを MERGE する
+MERGE_EVENTS_SQL = build_merge_events_sql(RAW_EVENTS_STREAM)
+# ストリームが無い・stale になった場合の全件 MERGE（従来の動作）
+MERGE_EVENTS_FULL_SQL = build_merge_events_sql(f"{_L1}.RAW_EVENTS")
+# ストリームの作り直し（全件 MERGE の直前に実行し、以降を差分に戻す）
+CREATE_STREAM_SQL = (
+    f"CREATE OR REPLACE STREAM {RAW_EVENTS_STREAM} "
+    f"ON TABLE {_L1}.RAW_EVENTS APPEND_ONLY = TRUE"
+)
+
+# STEP 2 の後: LAYER2 に取り込み済みの RAW_EVENTS を保持期間で削除する。
+# MERGE がストリームを消費した直後に実行するため、削除対象はすべて LAYER2 に取り込み済み。
+# 生データはステージの元ファイルに残る（LAYER2.EVENTS の SOURCE_FILE / SOURCE_ROW から参照）。
+RAW_RETENTION_DAYS = 14
+PURGE_RAW_EVENTS_SQL = f"""
+DELETE FROM {_L1}.RAW_EVENTS
+WHERE RECEIVED_AT < DATEADD('DAY', -{RAW_RETENTION_DAYS}, CURRENT_TIMESTAMP()::TIMESTAMP_NTZ)
+""".strip()
+
 # STEP 3: LAYER2.EVENTS → LAYER3 サマリーテーブル
+# 前回の更新（SUMMARY_REFRESH_STATE.WATERMARK）以降に LAYER2 に追加された行（RECEIVED_AT >= $REFRESH_FROM）の
+# (日付, チーム) を touched とし、そのパーティションの LAYER2.EVENTS を1回だけ読んで最も細かい粒度
+# (日付, 時, チーム, ユーザー, プロジェクト, ツール) で作業用テーブル SUMMARY_GRAIN に集計する。
+# DAILY / USER / TOOL / HOURLY / PROJECT / USER_TOOL_SUMMARY はこのテーブルから
+# ロールアップして MERGE する（SUMMARY_MERGES）。
+# コストは履歴全体ではなく新しいイベントがあった日数に比例し、EVENTS のスキャンは1回で済む。
+# DAILY / TOOL / PROJECT_SUMMARY の USERS_HLL はユーザーの HyperLogLog 状態（HLL_ACCUMULATE）。
+# 日ごとの ACTIVE_USERS は足し合わせられないが、状態は HLL_COMBINE で任意の期間に合算できるため、
+# ダッシュボードは期間内のアクティブユーザー数を USER_SUMMARY を読まずに日単位の行から推定する。
+#
+# 更新全体を1つのトランザクションで行い、先頭で SUMMARY_REFRESH_STATE の行を UPDATE してロックを取る。
+# 同時に動くアップローダー・タスクは COMMIT まで待ってから WATERMARK を読むため、
+# 古い SUMMARY_GRAIN で他の更新結果を上書きすることはない（SUMMARY_GRAIN がトランザクション内で
+# 作り直せる通常のテーブルなのはこのため。CREATE TABLE はトランザクションを暗黙にコミットする）。
+# 失敗時はロールバックして WATERMARK を進めないので、次回同じ範囲を集計し直す。
+# REFRESH_FROM は WATERMARK の REFRESH_OVERLAP_DAYS 日前から: STEP 2 の MERGE の開始（RECEIVED_AT）から
+# コミットまでの遅れと、タスクとクライアントのセッション TIMEZONE の違いを吸収する（集計し直しても結果は同じ）。
+
+REFRESH_STATE = f"{_L3}.SUMMARY_REFRESH_STATE"
+REFRESH_OVERLAP_DAYS = 1
+
+# 状態の行が無ければ作る（WATERMARK 1970-01-01 = 初回は全期間を集計）
+ENSURE_REFRESH_STATE_SQL = f"""
+MERGE INTO {REFRESH_STATE} AS tgt
+USING (SELECT 'LAYER3' AS NAME) AS src
+ON tgt.NAME = src.NAME
+WHEN NOT MATCHED THEN INSERT (NAME, WATERMARK) VALUES (src.NAME, '1970-01-01'::TIMESTAMP_NTZ)
+""".strip()
+
+BEGIN_REFRESH_SQL = "BEGIN TRANSACTION"
+
+# 行ロック代わりの UPDATE（他の更新のトランザクションが終わるまで待つ）
+LOCK_REFRESH_STATE_SQL = f"""
+UPDATE {REFRESH_STATE}
+SET LOCKED_AT = CURRENT_TIMESTAMP()::TIMESTAMP_NTZ
+WHERE NAME = 'LAYER3'
+""".strip()
+
+_REFRESH_FROM_SELECT = (
+    f"SELECT DATEADD('DAY', -{REFRESH_OVERLAP_DAYS}, WATERMARK), CURRENT_TIMESTAMP()::TIMESTAMP_NTZ"
+)
+SET_REFRESH_FROM_SQL = f"""
+SET (REFRESH_FROM, REFRESH_STARTED_AT) = (
+    {_REFRESH_FROM_SELECT}
+    FROM {REFRESH_STATE}
+    WHERE NAME = 'LAYER3'
+)
+""".strip()
+# タスク本体（Snowflake Scripting）ではローカル変数に読み込む
+SELECT_REFRESH_FROM_TASK_SQL = f"""
+{_REFRESH_FROM_SELECT}
+INTO :refresh_from, :refresh_started_at
+FROM {REFRESH_STATE}
+WHERE NAME = 'LAYER3'
+""".strip()
+# --force: 全期間を対象にする（サマリーの全件再集計）
+SET_REFRESH_FROM_ALL_SQL = (
+    "SET (REFRESH_FROM, REFRESH_STARTED_AT) = "
+    "('1970-01-01'::TIMESTAMP_NTZ, CURRENT_TIMESTAMP()::TIMESTAMP_NTZ)"
+)
+
+ADVANCE_WATERMARK_SQL = f"""
+UPDATE {REFRESH_STATE}
+SET WATERMARK  = $REFRESH_STARTED_AT,
+    LOCKED_AT  = NULL,
+    UPDATED_AT = CURRENT_TIMESTAMP()
+WHERE NAME = 'LAYER3'
+""".strip()
+
+SUMMARY_GRAIN = f"{_L3}.SUMMARY_GRAIN"
+
+CLEAR_SUMMARY_GRAIN_SQL = f"DELETE FROM {SUMMARY_GRAIN}"
+
+BUILD_SUMMARY_GRAIN_SQL = f"""
+INSERT INTO {SUMMARY_GRAIN}
+WITH touched AS (
+    -- 前回の更新以降に LAYER2 に追加された行のキー（RECEIVED_AT で新しいマイクロパーティションだけを読む）
+    SELECT DISTINCT
+        DATE_TRUNC('DAY', EVENT_TIMESTAMP)::DATE AS SUMMARY_DATE,
+        TEAM_ID
+    FROM {_L2}.EVENTS
+    WHERE RECEIVED_AT >= $REFRESH_FROM
+)
+SELECT
+    DATE_TRUNC('DAY', EVENT_TIMESTAMP)::DATE AS SUMMARY_DATE,
+    HOUR(EVENT_TIMESTAMP)                    AS HOUR_OF_DAY,
+    TEAM_ID,
+    USER_ID,
+    COALESCE(PROJECT_NAME, '(no project)')   AS PROJECT_NAME,
+    TOOL_NAME,
+    COUNT(*)                                               AS TOTAL_EVENTS,
+    COUNT(CASE WHEN EVENT_TYPE = 'UserPromptSubmit' THEN 1 END) AS MESSAGE_COUNT,
+    COUNT(CASE WHEN EVENT_TYPE = 'SessionStart'     THEN 1 END) AS SESSION_COUNT,
+    COUNT(CASE WHEN TOOL_NAME IS NOT NULL           THEN 1 END) AS TOOL_EXECUTION_COUNT,
+    COUNT(CASE WHEN IS_MCP      = TRUE THEN 1 END)  AS MCP_COUNT,
+    COUNT(CASE WHEN IS_SUBAGENT = TRUE THEN 1 END)  AS SUBAGENT_COUNT,
+    COUNT(CASE WHEN IS_COMMAND  = TRUE THEN 1 END)  AS COMMAND_COUNT,
+    COUNT(CASE WHEN IS_SKILL    = TRUE THEN 1 END)  AS SKILL_COUNT,
+    COUNT(CASE WHEN IS_USAGE_LIMIT = TRUE THEN 1 END) AS LIMIT_HIT_COUNT,
+    COUNT(CASE WHEN TOOL_SUCCESS = TRUE  THEN 1 END)  AS SUCCESS_COUNT,
+    COUNT(CASE WHEN TOOL_SUCCESS = FALSE THEN 1 END)  AS FAILURE_COUNT,
+    MAX(EVENT_TIMESTAMP)                             AS LAST_ACTIVE_AT
+FROM {_L2}.EVENTS
+WHERE EVENT_TIMESTAMP >= (SELECT MIN(SUMMARY_DATE) FROM touched)
+  AND EVENT_TIMESTAMP <  (SELECT DATEADD('DAY', 1, MAX(SUMMARY_DATE)) FROM touched)
+  AND (DATE_TRUNC('DAY', EVENT_TIMESTAMP)::DATE, TEAM_ID) IN
+      (SELECT SUMMARY_DATE, TEAM_ID FROM touched)
+GROUP BY DATE_TRUNC('DAY', EVENT_TIMESTAMP), HOUR(EVENT_TIMESTAMP), TEAM_ID, USER_ID,
+         COALESCE(PROJECT_NAME, '(no project)'), TOOL_NAME
+""".strip()
+
 MERGE_DAILY_SQL = f"""
 MERGE INTO {_L3}.DAILY_SUMMARY AS tgt
 USING (
     SELECT
-        DATE_TRUNC('DAY', EVENT_TIMESTAMP)::DATE AS SUMMARY_DATE,
+        SUMMARY_DATE,
         TEAM_ID,
-        COUNT(*)                                               AS TOTAL_EVENTS,
-        COUNT(CASE WHEN EVENT_TYPE = 'UserPromptSubmit' THEN 1 END) AS MESSAGE_COUNT,
-        COUNT(CASE WHEN EVENT_TYPE = 'SessionStart'     THEN 1 END) AS SESSION_COUNT,
-        COUNT(CASE WHEN TOOL_NAME IS NOT NULL           THEN 1 END) AS TOOL_EXECUTION_COUNT,
-        COUNT(CASE WHEN IS_MCP      = TRUE THEN 1 END)  AS MCP_COUNT,
-        COUNT(CASE WHEN IS_SUBAGENT = TRUE THEN 1 END)  AS SUBAGENT_COUNT,
-        COUNT(CASE WHEN IS_COMMAND  = TRUE THEN 1 END)  AS COMMAND_COUNT,
-        COUNT(CASE WHEN IS_SKILL    = TRUE THEN 1 END)  AS SKILL_COUNT,
-        COUNT(CASE WHEN IS_USAGE_LIMIT = TRUE THEN 1 END) AS LIMIT_HIT_COUNT,
-        COUNT(DISTINCT USER_ID)                          AS ACTIVE_USERS,
-        ROUND(AVG(CASE WHEN TOOL_SUCCESS IS NOT NULL
-            THEN CASE WHEN TOOL_SUCCESS THEN 1.0 ELSE 0.0 END END) * 100, 1) AS SUCCESS_RATE
-    FROM {_L2}.EVENTS
-    GROUP BY DATE_TRUNC('DAY', EVENT_TIMESTAMP), TEAM_ID
+        SUM(TOTAL_EVENTS)          AS TOTAL_EVENTS,
+        SUM(MESSAGE_COUNT)         AS MESSAGE_COUNT,
+        SUM(SESSION_COUNT)         AS SESSION_COUNT,
+        SUM(TOOL_EXECUTION_COUNT)  AS TOOL_EXECUTION_COUNT,
+        SUM(MCP_COUNT)             AS MCP_COUNT,
+        SUM(SUBAGENT_COUNT)        AS SUBAGENT_COUNT,
+        SUM(COMMAND_COUNT)         AS COMMAND_COUNT,
+        SUM(SKILL_COUNT)           AS SKILL_COUNT,
+        SUM(LIMIT_HIT_COUNT)       AS LIMIT_HIT_COUNT,
+        COUNT(DISTINCT USER_ID)    AS ACTIVE_USERS,
+        HLL_ACCUMULATE(USER_ID)    AS USERS_HLL,
+        ROUND(SUM(SUCCESS_COUNT)
+            / NULLIF(SUM(SUCCESS_COUNT) + SUM(FAILURE_COUNT), 0) * 100, 1) AS SUCCESS_RATE
+    FROM {SUMMARY_GRAIN}
+    GROUP BY SUMMARY_DATE, TEAM_ID
 ) AS src
 ON tgt.SUMMARY_DATE = src.SUMMARY_DATE AND tgt.TEAM_ID = src.TEAM_ID
 WHEN MATCHED THEN UPDATE SET
@@ -136,16 +310,17 @@ WHEN MATCHED THEN UPDATE SET
     SKILL_COUNT          = src.SKILL_COUNT,
     LIMIT_HIT_COUNT      = src.LIMIT_HIT_COUNT,
     ACTIVE_USERS         = src.ACTIVE_USERS,
+    USERS_HLL            = src.USERS_HLL,
     SUCCESS_RATE         = src.SUCCESS_RATE,
     UPDATED_AT           = CURRENT_TIMESTAMP()
 WHEN NOT MATCHED THEN INSERT (
     SUMMARY_DATE, TEAM_ID, TOTAL_EVENTS, MESSAGE_COUNT, SESSION_COUNT,
     TOOL_EXECUTION_COUNT, MCP_COUNT, SUBAGENT_COUNT, COMMAND_COUNT, SKILL_COUNT,
-    LIMIT_HIT_COUNT, ACTIVE_USERS, SUCCESS_RATE
+    LIMIT_HIT_COUNT, ACTIVE_USERS, USERS_HLL, SUCCESS_RATE
 ) VALUES (
     src.SUMMARY_DATE, src.TEAM_ID, src.TOTAL_EVENTS, src.MESSAGE_COUNT, src.SESSION_COUNT,
     src.TOOL_EXECUTION_COUNT, src.MCP_COUNT, src.SUBAGENT_COUNT, src.COMMAND_COUNT, src.SKILL_COUNT,
-    src.LIMIT_HIT_COUNT, src.ACTIVE_USERS, src.SUCCESS_RATE
+    src.LIMIT_HIT_COUNT, src.ACTIVE_USERS, src.USERS_HLL, src.SUCCESS_RATE
 );
 """.strip()
 
@@ -153,21 +328,21 @@ MERGE_USER_SQL = f"""
 MERGE INTO {_L3}.USER_SUMMARY AS tgt
 USING (
     SELECT
-        DATE_TRUNC('DAY', EVENT_TIMESTAMP)::DATE AS SUMMARY_DATE,
+        SUMMARY_DATE,
         USER_ID,
         TEAM_ID,
-        COUNT(*)                                               AS TOTAL_EVENTS,
-        COUNT(CASE WHEN EVENT_TYPE = 'UserPromptSubmit' THEN 1 END) AS MESSAGE_COUNT,
-        COUNT(CASE WHEN EVENT_TYPE = 'SessionStart'     THEN 1 END) AS SESSION_COUNT,
-        COUNT(CASE WHEN TOOL_NAME IS NOT NULL           THEN 1 END) AS TOOL_EXECUTION_COUNT,
-        COUNT(CASE WHEN IS_MCP      = TRUE THEN 1 END)  AS MCP_COUNT,
-        COUNT(CASE WHEN IS_SUBAGENT = TRUE THEN 1 END)  AS SUBAGENT_COUNT,
-        COUNT(CASE WHEN IS_COMMAND  = TRUE THEN 1 END)  AS COMMAND_COUNT,
-        COUNT(CASE WHEN IS_SKILL    = TRUE THEN 1 END)  AS SKILL_COUNT,
-        COUNT(CASE WHEN IS_USAGE_LIMIT = TRUE THEN 1 END) AS LIMIT_HIT_COUNT,
-        MAX(EVENT_TIMESTAMP)                             AS LAST_ACTIVE_AT
-    FROM {_L2}.EVENTS
-    GROUP BY DATE_TRUNC('DAY', EVENT_TIMESTAMP), USER_ID, TEAM_ID
+        SUM(TOTAL_EVENTS)          AS TOTAL_EVENTS,
+        SUM(MESSAGE_COUNT)         AS MESSAGE_COUNT,
+        SUM(SESSION_COUNT)         AS SESSION_COUNT,
+        SUM(TOOL_EXECUTION_COUNT)  AS TOOL_EXECUTION_COUNT,
+        SUM(MCP_COUNT)             AS MCP_COUNT,
+        SUM(SUBAGENT_COUNT)        AS SUBAGENT_COUNT,
+        SUM(COMMAND_COUNT)         AS COMMAND_COUNT,
+        SUM(SKILL_COUNT)           AS SKILL_COUNT,
+        SUM(LIMIT_HIT_COUNT)       AS LIMIT_HIT_COUNT,
+        MAX(LAST_ACTIVE_AT)        AS LAST_ACTIVE_AT
+    FROM {SUMMARY_GRAIN}
+    GROUP BY SUMMARY_DATE, USER_ID, TEAM_ID
 ) AS src
 ON  tgt.SUMMARY_DATE = src.SUMMARY_DATE
 AND tgt.USER_ID      = src.USER_ID
@@ -199,15 +374,16 @@ MERGE_TOOL_SQL = f"""
 MERGE INTO {_L3}.TOOL_SUMMARY AS tgt
 USING (
     SELECT
-        DATE_TRUNC('DAY', EVENT_TIMESTAMP)::DATE AS SUMMARY_DATE,
+        SUMMARY_DATE,
         TEAM_ID,
         TOOL_NAME,
-        COUNT(*)                                           AS EXECUTION_COUNT,
-        COUNT(CASE WHEN TOOL_SUCCESS = TRUE  THEN 1 END)  AS SUCCESS_COUNT,
-        COUNT(CASE WHEN TOOL_SUCCESS = FALSE THEN 1 END)  AS FAILURE_COUNT
-    FROM {_L2}.EVENTS
+        SUM(TOTAL_EVENTS)   AS EXECUTION_COUNT,
+        SUM(SUCCESS_COUNT)  AS SUCCESS_COUNT,
+        SUM(FAILURE_COUNT)  AS FAILURE_COUNT,
+        HLL_ACCUMULATE(USER_ID) AS USERS_HLL
+    FROM {SUMMARY_GRAIN}
     WHERE TOOL_NAME IS NOT NULL
-    GROUP BY DATE_TRUNC('DAY', EVENT_TIMESTAMP), TEAM_ID, TOOL_NAME
+    GROUP BY SUMMARY_DATE, TEAM_ID, TOOL_NAME
 ) AS src
 ON  tgt.SUMMARY_DATE = src.SUMMARY_DATE
 AND tgt.TEAM_ID      = src.TEAM_ID
@@ -216,15 +392,507 @@ WHEN MATCHED THEN UPDATE SET
     EXECUTION_COUNT = src.EXECUTION_COUNT,
     SUCCESS_COUNT   = src.SUCCESS_COUNT,
     FAILURE_COUNT   = src.FAILURE_COUNT,
+    USERS_HLL       = src.USERS_HLL,
     UPDATED_AT      = CURRENT_TIMESTAMP()
 WHEN NOT MATCHED THEN INSERT (
-    SUMMARY_DATE, TEAM_ID, TOOL_NAME, EXECUTION_COUNT, SUCCESS_COUNT, FAILURE_COUNT
+    SUMMARY_DATE, TEAM_ID, TOOL_NAME, EXECUTION_COUNT, SUCCESS_COUNT, FAILURE_COUNT, USERS_HLL
 ) VALUES (
     src.SUMMARY_DATE, src.TEAM_ID, src.TOOL_NAME,
+    src.EXECUTION_COUNT, src.SUCCESS_COUNT, src.FAILURE_COUNT, src.USERS_HLL
+);
+""".strip()
+
+# 時間帯ヒートマップ・時間帯別の制限ヒット用（ダッシュボードが EVENTS を HOUR() で読まないように）
+MERGE_HOURLY_SQL = f"""
+MERGE INTO {_L3}.HOURLY_SUMMARY AS tgt
+USING (
+    SELECT
+        SUMMARY_DATE,
+        HOUR_OF_DAY,
+        TEAM_ID,
+        SUM(TOTAL_EVENTS)          AS TOTAL_EVENTS,
+        SUM(MESSAGE_COUNT)         AS MESSAGE_COUNT,
+        SUM(TOOL_EXECUTION_COUNT)  AS TOOL_EXECUTION_COUNT,
+        SUM(LIMIT_HIT_COUNT)       AS LIMIT_HIT_COUNT,
+        COUNT(DISTINCT USER_ID)    AS ACTIVE_USERS
+    FROM {SUMMARY_GRAIN}
+    GROUP BY SUMMARY_DATE, HOUR_OF_DAY, TEAM_ID
+) AS src
+ON  tgt.SUMMARY_DATE = src.SUMMARY_DATE
+AND tgt.HOUR_OF_DAY  = src.HOUR_OF_DAY
+AND tgt.TEAM_ID      = src.TEAM_ID
+WHEN MATCHED THEN UPDATE SET
+    TOTAL_EVENTS         = src.TOTAL_EVENTS,
+    MESSAGE_COUNT        = src.MESSAGE_COUNT,
+    TOOL_EXECUTION_COUNT = src.TOOL_EXECUTION_COUNT,
+    LIMIT_HIT_COUNT      = src.LIMIT_HIT_COUNT,
+    ACTIVE_USERS         = src.ACTIVE_USERS,
+    UPDATED_AT           = CURRENT_TIMESTAMP()
+WHEN NOT MATCHED THEN INSERT (
+    SUMMARY_DATE, HOUR_OF_DAY, TEAM_ID, TOTAL_EVENTS, MESSAGE_COUNT,
+    TOOL_EXECUTION_COUNT, LIMIT_HIT_COUNT, ACTIVE_USERS
+) VALUES (
+    src.SUMMARY_DATE, src.HOUR_OF_DAY, src.TEAM_ID, src.TOTAL_EVENTS, src.MESSAGE_COUNT,
+    src.TOOL_EXECUTION_COUNT, src.LIMIT_HIT_COUNT, src.ACTIVE_USERS
+);
+""".strip()
+
+# プロジェクト別日次サマリー（プロジェクトタブ用）
+MERGE_PROJECT_SQL = f"""
+MERGE INTO {_L3}.PROJECT_SUMMARY AS tgt
+USING (
+    SELECT
+        SUMMARY_DATE,
+        TEAM_ID,
+        PROJECT_NAME,
+        SUM(TOTAL_EVENTS)          AS TOTAL_EVENTS,
+        SUM(MESSAGE_COUNT)         AS MESSAGE_COUNT,
+        SUM(SESSION_COUNT)         AS SESSION_COUNT,
+        SUM(TOOL_EXECUTION_COUNT)  AS TOOL_EXECUTION_COUNT,
+        SUM(SUCCESS_COUNT)         AS SUCCESS_COUNT,
+        SUM(FAILURE_COUNT)         AS FAILURE_COUNT,
+        SUM(SKILL_COUNT)           AS SKILL_COUNT,
+        SUM(MCP_COUNT)             AS MCP_COUNT,
+        COUNT(DISTINCT USER_ID)    AS ACTIVE_USERS,
+        HLL_ACCUMULATE(USER_ID)    AS USERS_HLL
+    FROM {SUMMARY_GRAIN}
+    GROUP BY SUMMARY_DATE, TEAM_ID, PROJECT_NAME
+) AS src
+ON  tgt.SUMMARY_DATE = src.SUMMARY_DATE
+AND tgt.TEAM_ID      = src.TEAM_ID
+AND tgt.PROJECT_NAME = src.PROJECT_NAME
+WHEN MATCHED THEN UPDATE SET
+    TOTAL_EVENTS         = src.TOTAL_EVENTS,
+    MESSAGE_COUNT        = src.MESSAGE_COUNT,
+    SESSION_COUNT        = src.SESSION_COUNT,
+    TOOL_EXECUTION_COUNT = src.TOOL_EXECUTION_COUNT,
+    SUCCESS_COUNT        = src.SUCCESS_COUNT,
+    FAILURE_COUNT        = src.FAILURE_COUNT,
+    SKILL_COUNT          = src.SKILL_COUNT,
+    MCP_COUNT            = src.MCP_COUNT,
+    ACTIVE_USERS         = src.ACTIVE_USERS,
+    USERS_HLL            = src.USERS_HLL,
+    UPDATED_AT           = CURRENT_TIMESTAMP()
+WHEN NOT MATCHED THEN INSERT (
+    SUMMARY_DATE, TEAM_ID, PROJECT_NAME, TOTAL_EVENTS, MESSAGE_COUNT, SESSION_COUNT,
+    TOOL_EXECUTION_COUNT, SUCCESS_COUNT, FAILURE_COUNT, SKILL_COUNT, MCP_COUNT, ACTIVE_USERS,
+    USERS_HLL
+) VALUES (
+    src.SUMMARY_DATE, src.TEAM_ID, src.PROJECT_NAME, src.TOTAL_EVENTS, src.MESSAGE_COUNT, src.SESSION_COUNT,
+    src.TOOL_EXECUTION_COUNT, src.SUCCESS_COUNT, src.FAILURE_COUNT, src.SKILL_COUNT, src.MCP_COUNT,
+    src.ACTIVE_USERS, src.USERS_HLL
+);
+""".strip()
+
+# ユーザー×ツール別日次サマリー（ユーザータブの Top ツール用）
+MERGE_USER_TOOL_SQL = f"""
+MERGE INTO {_L3}.USER_TOOL_SUMMARY AS tgt
+USING (
+    SELECT
+        SUMMARY_DATE,
+        TEAM_ID,
+        USER_ID,
+        TOOL_NAME,
+        SUM(TOTAL_EVENTS)   AS EXECUTION_COUNT,
+        SUM(SUCCESS_COUNT)  AS SUCCESS_COUNT,
+        SUM(FAILURE_COUNT)  AS FAILURE_COUNT
+    FROM {SUMMARY_GRAIN}
+    WHERE TOOL_NAME IS NOT NULL
+    GROUP BY SUMMARY_DATE, TEAM_ID, USER_ID, TOOL_NAME
+) AS src
+ON  tgt.SUMMARY_DATE = src.SUMMARY_DATE
+AND tgt.TEAM_ID      = src.TEAM_ID
+AND tgt.USER_ID      = src.USER_ID
+AND tgt.TOOL_NAME    = src.TOOL_NAME
+WHEN MATCHED THEN UPDATE SET
+    EXECUTION_COUNT = src.EXECUTION_COUNT,
+    SUCCESS_COUNT   = src.SUCCESS_COUNT,
+    FAILURE_COUNT   = src.FAILURE_COUNT,
+    UPDATED_AT      = CURRENT_TIMESTAMP()
+WHEN NOT MATCHED THEN INSERT (
+    SUMMARY_DATE, TEAM_ID, USER_ID, TOOL_NAME, EXECUTION_COUNT, SUCCESS_COUNT, FAILURE_COUNT
+) VALUES (
+    src.SUMMARY_DATE, src.TEAM_ID, src.USER_ID, src.TOOL_NAME,
     src.EXECUTION_COUNT, src.SUCCESS_COUNT, src.FAILURE_COUNT
 );
 """.strip()
 
+# セッション単位のサマリー（セッションタブ用）。SUMMARY_GRAIN ではなくセッション粒度が必要なため、
+# 前回の更新以降にイベントが追加されたセッションだけを EVENTS から集計し直す。
+# 対象セッションは途中からではなく全行を読み直す（既存の行と合算すると古い行の分がずれるため）。
+# STOP_REASON は最後の Stop イベントの理由（Stop 以外のイベントは NULL なので、キーを NULL にして除く）。
+MERGE_SESSION_SQL = f"""
+MERGE INTO {_L3}.SESSION_SUMMARY AS tgt
+USING (
+    WITH touched AS (
+        -- 前回の更新以降に LAYER2 に追加された行のセッション
+        SELECT DISTINCT TEAM_ID, SESSION_ID
+        FROM {_L2}.EVENTS
+        WHERE RECEIVED_AT >= $REFRESH_FROM
+          AND SESSION_ID IS NOT NULL
+          AND SESSION_ID <> ''
+    )
+    SELECT
+        TEAM_ID,
+        SESSION_ID,
+        USER_ID,
+        MAX(PROJECT_NAME)                                      AS PROJECT_NAME,
+        MIN(EVENT_TIMESTAMP)                                   AS START_AT,
+        MAX(EVENT_TIMESTAMP)                                   AS END_AT,
+        DATEDIFF('minute', MIN(EVENT_TIMESTAMP), MAX(EVENT_TIMESTAMP)) AS DURATION_MIN,
+        COUNT(*)                                               AS EVENT_COUNT,
+        COUNT(CASE WHEN EVENT_TYPE = 'UserPromptSubmit' THEN 1 END) AS MESSAGE_COUNT,
+        COUNT(CASE WHEN TOOL_NAME IS NOT NULL           THEN 1 END) AS TOOL_EXECUTION_COUNT,
+        COUNT(CASE WHEN TOOL_SUCCESS = FALSE            THEN 1 END) AS TOOL_FAILURE_COUNT,
+        COUNT(CASE WHEN IS_USAGE_LIMIT = TRUE           THEN 1 END) AS LIMIT_HIT_COUNT,
+        MAX_BY(STOP_REASON, CASE WHEN STOP_REASON IS NOT NULL THEN EVENT_TIMESTAMP END) AS STOP_REASON,
+        MAX(CASE WHEN STOP_REASON = 'usage_limit' THEN 1 ELSE 0 END) = 1 AS IS_LIMIT_STOPPED
+    FROM {_L2}.EVENTS
+    WHERE (TEAM_ID, SESSION_ID) IN (SELECT TEAM_ID, SESSION_ID FROM touched)
+    GROUP BY TEAM_ID, SESSION_ID, USER_ID
+) AS src
+ON  tgt.TEAM_ID    = src.TEAM_ID
+AND tgt.SESSION_ID = src.SESSION_ID
+AND tgt.USER_ID    = src.USER_ID
+WHEN MATCHED THEN UPDATE SET
+    PROJECT_NAME         = src.PROJECT_NAME,
+    START_AT             = src.START_AT,
+    END_AT               = src.END_AT,
+    DURATION_MIN         = src.DURATION_MIN,
+    EVENT_COUNT          = src.EVENT_COUNT,
+    MESSAGE_COUNT        = src.MESSAGE_COUNT,
+    TOOL_EXECUTION_COUNT = src.TOOL_EXECUTION_COUNT,
+    TOOL_FAILURE_COUNT   = src.TOOL_FAILURE_COUNT,
+    LIMIT_HIT_COUNT      = src.LIMIT_HIT_COUNT,
+    STOP_REASON          = src.STOP_REASON,
+    IS_LIMIT_STOPPED     = src.IS_LIMIT_STOPPED,
+    UPDATED_AT           = CURRENT_TIMESTAMP()
+WHEN NOT MATCHED THEN INSERT (
+    TEAM_ID, SESSION_ID, USER_ID, PROJECT_NAME, START_AT, END_AT, DURATION_MIN,
+    EVENT_COUNT, MESSAGE_COUNT, TOOL_EXECUTION_COUNT, TOOL_FAILURE_COUNT,
+    LIMIT_HIT_COUNT, STOP_REASON, IS_LIMIT_STOPPED
+) VALUES (
+    src.TEAM_ID, src.SESSION_ID, src.USER_ID, src.PROJECT_NAME, src.START_AT, src.END_AT, src.DURATION_MIN,
+    src.EVENT_COUNT, src.MESSAGE_COUNT, src.TOOL_EXECUTION_COUNT, src.TOOL_FAILURE_COUNT,
+    src.LIMIT_HIT_COUNT, src.STOP_REASON, src.IS_LIMIT_STOPPED
+);
+""".strip()
+
+# SUMMARY_GRAIN からロールアップするサマリー（refresh_summaries / タスク DAG が順に実行する）
+SUMMARY_MERGES = [
+    ("DAILY_SUMMARY", MERGE_DAILY_SQL),
+    ("USER_SUMMARY", MERGE_USER_SQL),
+    ("TOOL_SUMMARY", MERGE_TOOL_SQL),
+    ("HOURLY_SUMMARY", MERGE_HOURLY_SQL),
+    ("PROJECT_SUMMARY", MERGE_PROJECT_SQL),
+    ("USER_TOOL_SUMMARY", MERGE_USER_TOOL_SQL),
+]
+
+# SUMMARY_GRAIN 導入前に EVENTS を読んでいたサマリーの数（DAILY / USER / TOOL_SUMMARY）。
+# log_scan_savings の削減量はこの回数だけ EVENTS を読んでいた場合との比較による推定値
+LEGACY_EVENTS_SCANS = 3
+
+# 自セッションのクエリのスキャン量（last_query_id で取得したクエリIDを渡す）
+QUERY_BYTES_SCANNED_SQL = """
+SELECT QUERY_ID, BYTES_SCANNED
+FROM TABLE(CLAUDE_USAGE_DB.INFORMATION_SCHEMA.QUERY_HISTORY_BY_SESSION(RESULT_LIMIT => 100))
+WHERE QUERY_ID IN ({ids})
+""".strip()
+
+# COPY / MERGE が使う列（06_migrate_slim_storage.sql で追加）。未移行の環境ではどちらも invalid identifier になる
+REQUIRED_COLUMNS = (
+    ("LAYER1", "RAW_EVENTS", "SOURCE_ROW"),
+    ("LAYER2", "EVENTS", "SOURCE_FILE"),
+    ("LAYER2", "EVENTS", "SOURCE_ROW"),
+)
+REQUIRED_COLUMNS_SQL = """
+SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME
+FROM CLAUDE_USAGE_DB.INFORMATION_SCHEMA.COLUMNS
+WHERE TABLE_SCHEMA IN ('LAYER1', 'LAYER2')
+  AND TABLE_NAME IN ('RAW_EVENTS', 'EVENTS')
+  AND COLUMN_NAME IN ('SOURCE_FILE', 'SOURCE_ROW')
+""".strip()
+
+# テーブルごとのストレージ使用量（--action storage-report / 06_migrate_slim_storage.sql）
+# DELETED = TRUE は削除・置き換え済みのテーブルで、Time Travel / Fail-safe の期間が過ぎると解放される
+STORAGE_METRICS_SQL = """
+SELECT
+    TABLE_SCHEMA,
+    TABLE_NAME,
+    DELETED,
+    ROUND(ACTIVE_BYTES              / POWER(1024, 2), 2) AS ACTIVE_MB,
+    ROUND(TIME_TRAVEL_BYTES         / POWER(1024, 2), 2) AS TIME_TRAVEL_MB,
+    ROUND(FAILSAFE_BYTES            / POWER(1024, 2), 2) AS FAILSAFE_MB,
+    ROUND(RETAINED_FOR_CLONE_BYTES  / POWER(1024, 2), 2) AS CLONE_MB
+FROM CLAUDE_USAGE_DB.INFORMATION_SCHEMA.TABLE_STORAGE_METRICS
+WHERE TABLE_SCHEMA IN ('LAYER1', 'LAYER2', 'LAYER3')
+ORDER BY TABLE_SCHEMA, TABLE_NAME, DELETED
+""".strip()
+
+
+# ---------------------------------------------------------------------------
+# サーバー側パイプライン（タスク DAG）
+# ---------------------------------------------------------------------------
+# COPY → LAYER2 MERGE → LAYER3 更新を Snowflake のタスクで直列に実行し、
+# クライアントは --put-only で PUT だけを行う構成にするための SQL。
+# snowflake/setup/05_create_tasks.sql は build_task_dag_sql() の出力（--action task-sql で再生成）。
+
+SETUP_DIR = Path(__file__).resolve().parent.parent / "snowflake" / "setup"
+TASK_DAG_FILE = SETUP_DIR / "05_create_tasks.sql"
+TASK_DEFINITION_FILES = ("01_create_tables.sql", "04_create_analytical_tables.sql")
+
+TASK_WAREHOUSE = "CLAUDE_USAGE_WH"
+TASK_SCHEDULE = "15 MINUTE"
+COPY_TASK = f"{_L1}.PIPELINE_COPY_TASK"
+MERGE_TASK = f"{_L2}.PIPELINE_MERGE_TASK"
+
+
+def _task_statement(sql: str) -> str:
+    """アップローダーの SQL をタスク本体（Snowflake Scripting）用に変換する。
+    タスクはセッション変数を共有しないため $REFRESH_FROM / $REFRESH_STARTED_AT はローカル変数にする。"""
+    sql = (sql.strip()
+           .replace("$REFRESH_STARTED_AT", ":refresh_started_at")
+           .replace("$REFRESH_FROM", ":refresh_from"))
+    if not sql.endswith(";"):
+        sql += ";"
+    return "\n".join(("    " + line) if line else line for line in sql.splitlines())
+
+
+def build_task_dag_sql() -> str:
+    """05_create_tasks.sql の内容"""
+    merge_body = "\n\n".join(_task_statement(sql) for sql in (
+        MERGE_EVENTS_SQL,
+        ENSURE_REFRESH_STATE_SQL,
+    ))
+    # LAYER3 の更新はアップローダーと同じロック・WATERMARK を使う（refresh_summaries と同じ順序）
+    refresh_body = "\n\n".join(_task_statement(sql) for sql in (
+        BEGIN_REFRESH_SQL,
+        LOCK_REFRESH_STATE_SQL,
+        SELECT_REFRESH_FROM_TASK_SQL,
+        CLEAR_SUMMARY_GRAIN_SQL,
+        BUILD_SUMMARY_GRAIN_SQL,
+        *(sql for _, sql in SUMMARY_MERGES),
+        MERGE_SESSION_SQL,
+        ADVANCE_WATERMARK_SQL,
+        "COMMIT",
+        PURGE_RAW_EVENTS_SQL,
+    ))
+    return f"""-- ============================================================================
+-- Claude Code Usage Tracker - サーバー側パイプライン（タスク DAG）
+-- 実行順序: 01_create_tables.sql → 05_create_tasks.sql
+--
+-- このファイルは upload_to_snowflake.py --action task-sql で生成しています。
+-- 直接編集せず、アップローダーの SQL を変更したら再生成し、
+-- upload_to_snowflake.py --action lint-tasks で確認してください。
+--
+-- {COPY_TASK.split(".")[-1]}（SCHEDULE = '{TASK_SCHEDULE}'）: ステージ → LAYER1.RAW_EVENTS
+--   └ {MERGE_TASK.split(".")[-1]}: RAW_EVENTS_STREAM → LAYER2.EVENTS → LAYER3 サマリー
+--                          → 保持期間（{RAW_RETENTION_DAYS}日）を過ぎた RAW_EVENTS の削除
+--
+-- タスクはサーバー側で直列に実行され（前回の実行中は次の実行をスキップ）、
+-- ウェアハウスの起動も1回にまとまる。クライアントは
+-- upload_to_snowflake.py --action upload --put-only で PUT だけを行う。
+-- ============================================================================
+
+USE WAREHOUSE {TASK_WAREHOUSE};
+
+-- 作り直す前にルートタスクを止める
+ALTER TASK IF EXISTS {COPY_TASK} SUSPEND;
+
+-- ルート: ステージの新しいファイルを RAW_EVENTS に COPY
+CREATE OR REPLACE TASK {COPY_TASK}
+    WAREHOUSE = {TASK_WAREHOUSE}
+    SCHEDULE = '{TASK_SCHEDULE}'
+    ALLOW_OVERLAPPING_EXECUTION = FALSE
+    COMMENT = 'Claude Usage: stage -> LAYER1.RAW_EVENTS'
+AS
+{_task_statement(COPY_INTO_RAW_SQL)}
+
+-- 子: ストリームに新しい行があれば LAYER2 → LAYER3 を更新
+CREATE OR REPLACE TASK {MERGE_TASK}
+    WAREHOUSE = {TASK_WAREHOUSE}
+    COMMENT = 'Claude Usage: RAW_EVENTS_STREAM -> LAYER2.EVENTS -> LAYER3'
+    AFTER {COPY_TASK}
+AS
+EXECUTE IMMEDIATE $$
+DECLARE
+    refresh_from TIMESTAMP_NTZ;
+    refresh_started_at TIMESTAMP_NTZ;
+BEGIN
+    IF (NOT SYSTEM$STREAM_HAS_DATA('{RAW_EVENTS_STREAM}')) THEN
+        RETURN 'no new rows';
+    END IF;
+
+{merge_body}
+
+{refresh_body}
+
+    RETURN 'ok';
+EXCEPTION
+    WHEN OTHER THEN
+        -- LAYER3 の更新を取り消す（WATERMARK は進めず、次回同じ範囲を集計し直す）
+        ROLLBACK;
+        RAISE;
+END;
+$$;
+
+-- 子タスク → ルートタスクの順に再開する
+ALTER TASK {MERGE_TASK} RESUME;
+ALTER TASK {COPY_TASK} RESUME;
+"""
+
+
+def _mask_quoted(text: str) -> str:
+    """文字列リテラルとコメントを空白に置き換える（位置は保つ）。$$ ブロックは残す。"""
+    out = list(text)
+    i = 0
+    while i < len(text):
+        if text.startswith("--", i):
+            end = text.find("\n", i)
+            end = len(text) if end < 0 else end
+        elif text[i] == "'":
+            end = i + 1
+            while end < len(text):
+                if text[end] == "'" and text[end + 1:end + 2] == "'":
+                    end += 2
+                    continue
+                if text[end] == "'":
+                    break
+                end += 1
+            end += 1
+        else:
+            i += 1
+            continue
+        for j in range(i, min(end, len(text))):
+            if out[j] != "\n":
+                out[j] = " "
+        i = end
+    return "".join(out)
+
+
+def split_sql_statements(text: str) -> list[tuple[str, str]]:
+    """SQL をトップレベルの ; で分割する。戻り値: [(原文, 文字列・コメントを伏せた文)]"""
+    masked = _mask_quoted(text)
+    statements = []
+    start = 0
+    in_dollar = False
+    i = 0
+    while i < len(masked):
+        if masked.startswith("$$", i):
+            in_dollar = not in_dollar
+            i += 2
+            continue
+        if masked[i] == ";" and not in_dollar:
+            if masked[start:i].strip():
+                statements.append((text[start:i].strip(), masked[start:i].strip()))
+            start = i + 1
+        i += 1
+    if masked[start:].strip():
+        statements.append((text[start:].strip(), masked[start:].strip()))
+    return statements
+
+
+_TASK_RE = re.compile(
+    r"^CREATE\s+(?:OR\s+REPLACE\s+)?TASK\s+(?:IF\s+NOT\s+EXISTS\s+)?(?P<name>[\w.$]+)"
+    r"(?P<options>.*?)\bAS\b(?P<body>.*)$",
+    re.IGNORECASE | re.DOTALL,
+)
+_OBJECT_REF_RE = re.compile(r"\bCLAUDE_USAGE_DB\.(LAYER\d)\.(\w+)", re.IGNORECASE)
+_CREATE_OBJECT_RE = re.compile(
+    r"^\s*CREATE\s+(?:OR\s+REPLACE\s+)?(?:TEMPORARY\s+|TRANSIENT\s+)?"
+    r"(?:TABLE|STREAM|STAGE|VIEW|TASK|FUNCTION|PROCEDURE)\s+(?:IF\s+NOT\s+EXISTS\s+)?([\w.]+)",
+    re.IGNORECASE | re.MULTILINE,
+)
+_USE_SCHEMA_RE = re.compile(r"^\s*USE\s+SCHEMA\s+([\w.]+)", re.IGNORECASE | re.MULTILINE)
+_SESSION_VAR_RE = re.compile(r"(?<![\w$])\$[A-Za-z_]\w*")
+_SCRIPT_END_RE = re.compile(r"\bEND\b(?!\s+(?:IF|LOOP|FOR|WHILE|CASE|REPEAT)\b)", re.IGNORECASE)
+
+
+def _defined_objects(paths) -> set[str]:
+    """セットアップ SQL で作成されるオブジェクトの完全修飾名（大文字）"""
+    defined = set()
+    for path in paths:
+        if not path.exists():
+            continue
+        text = _mask_quoted(path.read_text(encoding="utf-8"))
+        events = [(m.start(), "use", m.group(1)) for m in _USE_SCHEMA_RE.finditer(text)]
+        events += [(m.start(), "create", m.group(1)) for m in _CREATE_OBJECT_RE.finditer(text)]
+        schema = ""
+        for _, kind, name in sorted(events):
+            name = name.upper()
+            if kind == "use":
+                schema = name
+            elif name.count(".") == 2:
+                defined.add(name)
+            elif schema:
+                defined.add(f"{schema}.{name.split('.')[-1]}")
+    return defined
+
+
+def lint_task_dag(text: str) -> list[str]:
+    """タスク DAG の SQL を Snowflake に接続せずに検査する。戻り値: エラーの一覧"""
+    errors = []
+    statements = split_sql_statements(text)
+    defined = _defined_objects(SETUP_DIR / name for name in TASK_DEFINITION_FILES)
+    # タスク本体で作るオブジェクトも含める
+    defined |= {m.group(1).upper() for m in _CREATE_OBJECT_RE.finditer(_mask_quoted(text))}
+
+    tasks = {}
+    resumed = []
+    for original, masked in statements:
+        m = _TASK_RE.match(masked)
+        if m:
+            name = m.group("name").upper()
+            options = m.group("options").upper()
+            body = m.group("body")
+            has_schedule = "SCHEDULE" in options
+            after = re.search(r"\bAFTER\s+([\w.,\s]+)$", options.strip())
+            if "WAREHOUSE" not in options:
+                errors.append(f"{name}: WAREHOUSE（またはサーバーレス設定）がありません")
+            if has_schedule == bool(after):
+                errors.append(f"{name}: SCHEDULE（ルート）と AFTER（子）のどちらか一方だけを指定してください")
+            parents = [p.strip() for p in after.group(1).split(",")] if after else []
+            for parent in parents:
+                if parent not in tasks:
+                    errors.append(f"{name}: AFTER {parent} がこのファイル内で先に定義されていません")
+            tasks[name] = parents
+
+            if body.count("(") != body.count(")"):
+                errors.append(f"{name}: 括弧の対応が取れていません")
+            if body.count("$$") % 2:
+                errors.append(f"{name}: $$ ブロックが閉じていません")
+            if "$$" in body:
+                # BEGIN TRANSACTION はブロックではない
+                begins = len(re.findall(r"\bBEGIN\b(?!\s+TRANSACTION\b)", body, re.IGNORECASE))
+                # CASE ... END 式の END は除く
+                cases = (len(re.findall(r"\bCASE\b", body, re.IGNORECASE))
+                         - len(re.findall(r"\bEND\s+CASE\b", body, re.IGNORECASE)))
+                ends = len(_SCRIPT_END_RE.findall(body)) - cases
+                if begins != ends:
+                    errors.append(f"{name}: BEGIN と END の数が一致しません ({begins} / {ends})")
+            script = body.replace("$$", "")
+            for var in sorted(set(_SESSION_VAR_RE.findall(script))):
+                errors.append(f"{name}: セッション変数 {var} はタスクでは使えません（ローカル変数にしてください）")
+            refs = {f"CLAUDE_USAGE_DB.{layer}.{obj}".upper() for layer, obj in _OBJECT_REF_RE.findall(body)}
+            for ref in sorted(refs):
+                if ref not in defined:
+                    errors.append(f"{name}: {ref} はセットアップ SQL で作成されていません")
+            continue
+
+        r = re.match(r"^ALTER\s+TASK\s+([\w.]+)\s+RESUME$", masked, re.IGNORECASE)
+        if r:
+            resumed.append(r.group(1).upper())
+
+    roots = [name for name, parents in tasks.items() if not parents]
+    if len(roots) != 1:
+        errors.append(f"ルートタスクは1つである必要があります: {roots}")
+    for name in tasks:
+        if name not in resumed:
+            errors.append(f"{name}: ALTER TASK ... RESUME がありません")
+    if roots and resumed and resumed[-1] != roots[0]:
+        errors.append("ルートタスクは子タスクを RESUME した後に最後に RESUME してください")
+    return errors
+
 
 # ---------------------------------------------------------------------------
 # ヘルパー
@@ -281,7 +949,7 @@ def _set_user_env(name: str, value: str):
 
 
 def load_uploaded() -> list[str]:
-    """アップロード済みファイル一覧を読み込む。"""
+    """旧形式のアップロード済みファイル一覧を読み込む（マニフェストへの移行用）。"""
     if not UPLOADED_FILE.exists():
         return []
     try:
@@ -293,10 +961,269 @@ def load_uploaded() -> list[str]:
         return []
 
 
-def save_uploaded(files: list[str]):
-    """アップロード済みファイル一覧を保存。"""
-    UPLOADED_FILE.write_text(json.dumps(files, indent=2, ensure_ascii=False),
-                             encoding="utf-8")
+def list_log_files() -> list[Path]:
+    """アップロード対象のログセグメント（events-*.jsonl と圧縮済み *.jsonl.gz / .zst）"""
+    files = list(LOG_DIR.glob("events-*.jsonl"))
+    for suffix in COMPRESSED_SUFFIXES:
+        files.extend(LOG_DIR.glob(f"events-*.jsonl{suffix}"))
+    return sorted(files)
+
+
+def is_compressed(path: Path) -> bool:
+    return path.suffix in COMPRESSED_SUFFIXES
+
+
+def load_segment_index() -> dict:
+    """圧縮済みセグメントの {ファイル名: {"events": n, "raw_bytes": n}}"""
+    try:
+        return json.loads(SEGMENT_INDEX_FILE.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+# ---------------------------------------------------------------------------
+# アップロードマニフェスト（差分アップロード）
+# ---------------------------------------------------------------------------
+# {"version": 1, "files": {ファイル名: {
+#     "offset":        送信済みバイト数（非圧縮の内容に対するオフセット）,
+#     "prefix_len":    prefix_sha256 を計算した先頭バイト数,
+#     "prefix_sha256": 先頭 prefix_len バイトのハッシュ（ファイルの同一性判定）,
+#     "last_chunk":    最後に PUT したチャンク名,
+#     "last_chunk_sha256": そのチャンクの内容ハッシュ,
+#     "complete":      圧縮済みセグメントを最後まで送信済みなら true,
+# }}}
+
+_SEGMENT_NAME_RE = re.compile(
+    r"^events-(?P<date>\d{4}-\d{2}-\d{2})(?P<seq>\.\d{3,})?\.jsonl(?P<ext>\.gz|\.zst)?$"
+)
+
+
+def open_log(path: Path):
+    """ログセグメントを非圧縮のバイト列として読むファイルオブジェクト"""
+    if path.suffix == ".gz":
+        return gzip.open(path, "rb")
+    if path.suffix == ".zst":
+        import zstandard  # 無ければ ImportError（呼び出し側で丸ごと PUT に切り替える）
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    return open(path, "rb")
+
+
+def prefix_sha256(path: Path, length: int) -> str:
+    with open_log(path) as f:
+        return hashlib.sha256(f.read(length)).hexdigest()
+
+
+def load_manifest() -> dict:
+    """マニフェストを読み込む。無ければ旧形式の .uploaded_files.json から移行する。"""
+    try:
+        data = json.loads(MANIFEST_FILE.read_text(encoding="utf-8"))
+        if isinstance(data, dict) and isinstance(data.get("files"), dict):
+            return data
+    except (OSError, ValueError):
+        pass
+
+    manifest = {"version": 1, "files": {}}
+    legacy = [n for n in load_uploaded() if (LOG_DIR / n).exists()]
+    if legacy:
+        # 旧形式では当日分は初回アップロード後に追記された分が未送信のまま残っている。
+        # 最新のファイルだけは先頭から送り直し（重複は LAYER2 の MERGE で除外される）、
+        # それ以外は現在のサイズまで送信済みとみなす。
+        latest = max(legacy)
+        for name in legacy:
+            if name == latest:
+                continue
+            path = LOG_DIR / name
+            manifest["files"][name] = {
+                "offset": path.stat().st_size if not is_compressed(path) else 0,
+                "complete": is_compressed(path),
+            }
+    return manifest
+
+
+def save_manifest(manifest: dict):
+    tmp = MANIFEST_FILE.with_suffix(".tmp")
+    tmp.write_text(json.dumps(manifest, indent=2, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, MANIFEST_FILE)
+
+
+def _entry_matches(path: Path, entry: dict) -> bool:
+    """マニフェストのエントリがこのファイル（または rename 前の同じ内容）のものか"""
+    length = entry.get("prefix_len", 0)
+    if not length:
+        return True
+    try:
+        return prefix_sha256(path, length) == entry.get("prefix_sha256")
+    except (OSError, ImportError, EOFError):
+        return False
+
+
+def find_entry(path: Path, manifest: dict) -> dict | None:
+    """ファイルに対応する送信済みエントリを探す。
+    ローテーション（events-D.jsonl → events-D.001.jsonl）や圧縮（→ .jsonl.gz）で
+    名前が変わった場合も、先頭ハッシュが一致すれば同じファイルとして引き継ぐ。"""
+    files = manifest["files"]
+    entry = files.get(path.name)
+    if entry is not None:
+        return entry if _entry_matches(path, entry) else None
+
+    m = _SEGMENT_NAME_RE.match(path.name)
+    if not m:
+        return None
+    candidates = [f"events-{m.group('date')}{m.group('seq') or ''}.jsonl",
+                  f"events-{m.group('date')}.jsonl"]
+    for name in candidates:
+        entry = files.get(name)
+        if name != path.name and entry and entry.get("offset") and _entry_matches(path, entry):
+            return dict(entry)
+    return None
+
+
+def chunk_name(path: Path, start: int, end: int, sha256: str) -> str:
+    """PUT するチャンクのファイル名。範囲と内容ハッシュを名前に含めるため、
+    ローテーション後に同じ範囲を送っても COPY の読み込み履歴と衝突しない。"""
+    m = _SEGMENT_NAME_RE.match(path.name)
+    base = f"events-{m.group('date')}{m.group('seq') or ''}" if m else path.name.split(".jsonl")[0]
+    return f"{base}.c{start:012d}-{end:012d}.{sha256[:8]}.jsonl.gz"
+
+
+def write_delta_chunk(path: Path, start: int, out_dir: Path) -> tuple[Path, int, str] | None:
+    """start 以降の完結した行（末尾の改行まで）を gzip したチャンクファイルを作る。
+    戻り値: (チャンクのパス, 新しいオフセット, 内容ハッシュ)。新しい行が無ければ None。"""
+    with open_log(path) as f:
+        if start:
+            if path.suffix in COMPRESSED_SUFFIXES:
+                # 圧縮ストリームはシークできないため読み飛ばす
+                remaining = start
+                while remaining:
+                    skipped = len(f.read(min(remaining, 1024 * 1024)))
+                    if not skipped:
+                        return None
+                    remaining -= skipped
+            else:
+                f.seek(start)
+        data = f.read()
+
+    # 書き込み途中の最終行は次回に回す
+    data = data[:data.rfind(b"\n") + 1]
+    if not data:
+        return None
+
+    end = start + len(data)
+    sha256 = hashlib.sha256(data).hexdigest()
+    chunk = out_dir / chunk_name(path, start, end, sha256)
+    with gzip.open(chunk, "wb", compresslevel=6) as out:
+        out.write(data)
+    return chunk, end, sha256
+
+
+def plan_uploads(all_files: list[Path], manifest: dict, out_dir: Path) -> list[dict]:
+    """PUT する対象を決める。差分はチャンクファイルとして out_dir に書き出す。
+    戻り値: [{"name": ログファイル名, "local": PUT するファイル,
+              "auto_compress": bool, "entry": PUT 成功後のマニフェストエントリ}]
+    PUT が不要な更新（送信済み・新しい行なし）はここでマニフェストに反映する。"""
+    files = manifest["files"]
+    uploads = []
+    for f in all_files:
+        entry = find_entry(f, manifest)
+        if entry and entry.get("complete"):
+            files[f.name] = entry
+            continue
+        start = entry.get("offset", 0) if entry else 0
+        if entry:
+            # rename 前の名前から引き継いだ位置を新しい名前で保持する（PUT が失敗しても失わない）
+            files[f.name] = entry
+
+        if is_compressed(f) and start == 0:
+            # 一度も送っていない圧縮済みセグメントはそのまま PUT する
+            uploads.append({
+                "name": f.name, "local": f, "auto_compress": False,
+                "entry": {"offset": 0, "complete": True, "last_chunk": f.name},
+            })
+            continue
+
+        try:
+            delta = write_delta_chunk(f, start, out_dir)
+        except (ImportError, OSError, EOFError) as e:
+            write_fail(f"  {f.name}: 差分を読めません ({e})")
+            continue
+        if delta is None:
+            if is_compressed(f):
+                files[f.name] = dict(entry or {}, complete=True)
+            continue
+
+        chunk, end, chunk_sha = delta
+        prefix_len = min(end, PREFIX_HASH_BYTES)
+        uploads.append({
+            "name": f.name, "local": chunk, "auto_compress": False,
+            "entry": {
+                "offset": end,
+                "prefix_len": prefix_len,
+                "prefix_sha256": prefix_sha256(f, prefix_len),
+                "last_chunk": chunk.name,
+                "last_chunk_sha256": chunk_sha,
+                "complete": is_compressed(f),
+            },
+        })
+    return uploads
+
+
+def put_file(conn, local: Path, stage_path: str, auto_compress: bool,
+             put_parallel: int) -> tuple[bool, float]:
+    """1ファイルを PUT する（スレッドごとに専用のカーソルを使う）。戻り値: (成功, 秒)"""
+    local_path = str(local).replace("\\", "/")
+    put_sql = (
+        f"PUT 'file://{local_path}' '{stage_path}' "
+        f"AUTO_COMPRESS={'TRUE' if auto_compress else 'FALSE'} OVERWRITE=TRUE "
+        f"PARALLEL={put_parallel}"
+    )
+    start = time.perf_counter()
+    cur = conn.cursor()
+    try:
+        cur.execute(put_sql)
+        result = cur.fetchall()
+        status = result[0][6] if result and len(result[0]) > 6 else "UNKNOWN"
+        if status in ("UPLOADED", "SKIPPED"):
+            print(f"  [PUT] {local.name} -> {stage_path} {status}")
+            return True, time.perf_counter() - start
+        write_fail(f"  [PUT] {local.name}: PUT status: {status}")
+    except Exception as e:
+        write_fail(f"  [PUT] {local.name}: PUT失敗: {e}")
+    finally:
+        cur.close()
+    return False, time.perf_counter() - start
+
+
+def put_files(conn, uploads: list[dict], stage_path: str, workers: int, put_parallel: int):
+    """uploads をスレッドプールで並列に PUT し、終わった順に (item, 成功, 秒) を返す。"""
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {
+            pool.submit(put_file, conn, item["local"], stage_path,
+                        item["auto_compress"], put_parallel): item
+            for item in uploads
+        }
+        for future in as_completed(futures):
+            ok, elapsed = future.result()
+            yield futures[future], ok, elapsed
+
+
+def _format_throughput(size: int, seconds: float) -> str:
+    mb = size / (1024 * 1024)
+    rate = mb / seconds if seconds > 0 else 0.0
+    return f"{mb:.2f} MB in {seconds:.2f}s ({rate:.2f} MB/s)"
+
+
+def upload_status(path: Path, manifest: dict) -> str:
+    """list 表示用: [済] / [部分] / [未]"""
+    entry = manifest["files"].get(path.name)
+    if not entry:
+        return "[未]"
+    if entry.get("complete"):
+        return "[済]"
+    if not is_compressed(path) and entry.get("offset", 0) >= path.stat().st_size:
+        return "[済]"
+    return "[部分]" if entry.get("offset") else "[未]"
 
 
 def create_connection():
@@ -478,12 +1405,13 @@ def action_list():
         write_info("Claude Code プラグインを使用するとログが生成されます")
         return
 
-    files = sorted(LOG_DIR.glob("events-*.jsonl"))
+    files = list_log_files()
     if not files:
         write_info("ログファイルがありません")
         return
 
-    uploaded = load_uploaded()
+    manifest = load_manifest()
+    segment_index = load_segment_index()
     total_size = 0
     total_events = 0
 
@@ -493,11 +1421,15 @@ def action_list():
     for f in files:
         size = f.stat().st_size
         total_size += size
-        with open(f, encoding="utf-8", errors="ignore") as fh:
-            event_count = sum(1 for _ in fh)
+        if is_compressed(f):
+            # 圧縮済みセグメントは展開せず索引のイベント数を使う
+            event_count = segment_index.get(f.name, {}).get("events", 0)
+        else:
+            with open(f, "rb") as fh:
+                event_count = sum(1 for _ in fh)
         total_events += event_count
         size_kb = round(size / 1024, 1)
-        status = "[済]" if f.name in uploaded else "[未]"
+        status = upload_status(f, manifest)
         print(f"  {status} {f.name} ({size_kb} KB, {event_count} events)")
 
     print()
@@ -505,11 +1437,141 @@ def action_list():
     print(f"  合計: {len(files)} files, {total_kb} KB, {total_events} events")
 
 
+def missing_columns(cur) -> list[str]:
+    """REQUIRED_COLUMNS のうち存在しない列（"LAYER2.EVENTS.SOURCE_ROW" の形）。
+    INFORMATION_SCHEMA を読めない場合は確認を諦めて空を返す（COPY / MERGE のエラーに任せる）。"""
+    try:
+        cur.execute(REQUIRED_COLUMNS_SQL)
+        found = {tuple(row) for row in cur.fetchall()}
+    except Exception as e:
+        write_info(f"  テーブル定義を確認できません: {e}")
+        return []
+    return [".".join(col) for col in REQUIRED_COLUMNS if col not in found]
+
+
+def merge_events(cur) -> int:
+    """RAW_EVENTS_STREAM の差分を LAYER2.EVENTS に MERGE する。
+    ストリームが無い（未移行の環境）・stale（保持期間を超えて未消費）の場合は
+    ストリームを作り直してから全件 MERGE で取りこぼしを埋める。戻り値: 挿入行数"""
+    try:
+        cur.execute(MERGE_EVENTS_SQL)
+    except Exception as e:
+        message = str(e)
+        if "RAW_EVENTS_STREAM" not in message.upper() and "stale" not in message.lower():
+            raise
+        write_info(f"  ストリームを使えないため全件 MERGE します: {e}")
+        # 先にストリームを作ることで、作成後に COPY された行は次回の差分にも必ず含まれる
+        # （全件 MERGE と重複した分は NOT MATCHED で除外される）
+        try:
+            cur.execute(CREATE_STREAM_SQL)
+            write_ok(f"  {RAW_EVENTS_STREAM} を作成しました")
+        except Exception as stream_error:
+            write_info(f"  ストリームを作成できません（管理者に依頼してください）: {stream_error}")
+        cur.execute(MERGE_EVENTS_FULL_SQL)
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def purge_raw_events(cur):
+    """LAYER2 に取り込み済みで保持期間を過ぎた RAW_EVENTS を削除する（STEP 2 の成功後だけ呼ぶ）。"""
+    try:
+        cur.execute(PURGE_RAW_EVENTS_SQL)
+        row = cur.fetchone()
+        deleted = row[0] if row else 0
+        if deleted:
+            write_ok(f"LAYER1.RAW_EVENTS: {deleted} rows purged (> {RAW_RETENTION_DAYS} days)")
+    except Exception as e:
+        # 権限が無い場合はサーバー側タスク・管理者の削除に任せる
+        write_info(f"  RAW_EVENTS の保持期間削除をスキップ: {e}")
+
+
+def refresh_summaries(cur, full: bool = False):
+    """前回の更新以降に追加された行のパーティションについて SUMMARY_GRAIN を1回作り、
+    各サマリー（SUMMARY_MERGES）をそこからロールアップして MERGE する。
+    全体を1つのトランザクションで行い、SUMMARY_REFRESH_STATE のロックで他のアップローダー・タスクと直列にする。
+    どれかが失敗したらロールバックし、WATERMARK を進めない（次回同じ範囲を集計し直す）。
+    full=True（--force）のときは全期間を集計し直す。
+    最後に QUERY_HISTORY でサマリーごとに LAYER2.EVENTS を読んでいた場合との差分スキャン量を記録する。"""
+    try:
+        cur.execute(ENSURE_REFRESH_STATE_SQL)
+        cur.execute(BEGIN_REFRESH_SQL)
+        write_info("  SUMMARY_REFRESH_STATE のロックを取得 ...（他の更新が実行中なら待つ）")
+        cur.execute(LOCK_REFRESH_STATE_SQL)
+        cur.execute(SET_REFRESH_FROM_ALL_SQL if full else SET_REFRESH_FROM_SQL)
+        write_info(f"  INSERT INTO {SUMMARY_GRAIN} ...")
+        cur.execute(CLEAR_SUMMARY_GRAIN_SQL)
+        cur.execute(BUILD_SUMMARY_GRAIN_SQL)
+        grain_query_id = cur.sfqid
+
+        rollup_query_ids = []
+        for label, sql in SUMMARY_MERGES:
+            rollup_query_ids.append(_merge_summary(cur, label, sql))
+
+        # セッション粒度は SUMMARY_GRAIN から作れないため、対象セッションだけ EVENTS から集計する
+        _merge_summary(cur, "SESSION_SUMMARY", MERGE_SESSION_SQL)
+
+        cur.execute(ADVANCE_WATERMARK_SQL)
+        cur.execute("COMMIT")
+    except Exception as e:
+        write_fail(f"  LAYER3 更新失敗（ロールバックし、次回同じ範囲を集計し直します）: {e}")
+        try:
+            cur.execute("ROLLBACK")
+        except Exception:
+            pass
+        return
+
+    log_scan_savings(cur, grain_query_id, rollup_query_ids)
+
+
+def _merge_summary(cur, label: str, sql: str) -> str:
+    """サマリーの MERGE を1つ実行して結果を表示する。戻り値: クエリID（失敗時は例外）"""
+    write_info(f"  MERGE INTO {label} ...")
+    try:
+        cur.execute(sql)
+    except Exception as e:
+        write_fail(f"  {label} MERGE 失敗: {e}")
+        raise
+    query_id = cur.sfqid
+    row = cur.fetchone()
+    inserted = row[0] if row else 0
+    updated = row[1] if row and len(row) > 1 else 0
+    write_ok(f"  {label}: inserted={inserted}, updated={updated}")
+    return query_id
+
+
+def log_scan_savings(cur, grain_query_id: str, rollup_query_ids: list[str]):
+    """SUMMARY_GRAIN 作成（EVENTS のスキャン）とロールアップのスキャン量を QUERY_HISTORY から取得して表示する。
+    削減量は実測ではなく、以前の DAILY / USER / TOOL_SUMMARY が同じ範囲の EVENTS をそれぞれ読んでいた
+    （LEGACY_EVENTS_SCANS 回）と仮定した推定値。"""
+    ids = [grain_query_id, *rollup_query_ids]
+    try:
+        cur.execute(QUERY_BYTES_SCANNED_SQL.format(ids=", ".join(f"'{q}'" for q in ids)))
+        scanned = {row[0]: row[1] or 0 for row in cur.fetchall()}
+    except Exception as e:
+        write_info(f"  スキャン量を取得できません: {e}")
+        return
+    if grain_query_id not in scanned:
+        return
+
+    events_bytes = scanned[grain_query_id]
+    rollup_bytes = sum(scanned.get(q, 0) for q in rollup_query_ids)
+    estimated_saved = LEGACY_EVENTS_SCANS * events_bytes - (events_bytes + rollup_bytes)
+    mb = 1024 * 1024
+    write_info(
+        f"  スキャン量（実測）: EVENTS {events_bytes / mb:.2f} MB (1回) + ロールアップ {rollup_bytes / mb:.2f} MB"
+    )
+    write_info(
+        f"  削減量（推定）: EVENTS を {LEGACY_EVENTS_SCANS} 回読む以前の方式と比べて {estimated_saved / mb:.2f} MB"
+    )
+
+
 # ---------------------------------------------------------------------------
 # アクション: upload
 # ---------------------------------------------------------------------------
-def action_upload(force: bool = False):
-    """PUT → LAYER1 → LAYER2 → LAYER3 のフルパイプライン。"""
+def action_upload(force: bool = False, workers: int = DEFAULT_PUT_WORKERS,
+                  put_parallel: int = DEFAULT_PUT_PARALLEL, put_only: bool = False):
+    """PUT → LAYER1 → LAYER2 → LAYER3 のフルパイプライン。
+    put_only=True のときは PUT だけを行い、取り込みはサーバー側タスクに任せる。"""
     username = get_username()
     write_info(f"ユーザー: {username}")
 
@@ -521,21 +1583,14 @@ def action_upload(force: bool = False):
         write_fail(f"ログディレクトリが見つかりません: {LOG_DIR}")
         return
 
-    all_files = sorted(LOG_DIR.glob("events-*.jsonl"))
+    all_files = list_log_files()
     if not all_files:
         write_info("アップロードするログファイルがありません")
         return
 
-    # アップロード済みチェック
-    uploaded = load_uploaded() if not force else []
-    files_to_upload = [f for f in all_files if f.name not in uploaded]
-
-    if not files_to_upload:
-        write_info("新しいファイルはありません (--force で全ファイル再アップロード)")
-        return
-
-    write_info(f"対象ファイル: {len(files_to_upload)}/{len(all_files)}")
-    print()
+    manifest = load_manifest()
+    if force:
+        manifest["files"] = {}
 
     # Snowflake 接続
     try:
@@ -545,32 +1600,53 @@ def action_upload(force: bool = False):
         return
 
     cur = conn.cursor()
+    stage_path = f"@{STAGE}/{username}/"
     newly_uploaded = []
+    uploaded_bytes = 0
 
     try:
-        # --- PUT → @LAYER1.STAGE ---
-        for f in files_to_upload:
-            local_path = str(f).replace("\\", "/")
-            stage_path = f"@{STAGE}/{username}/"
-            put_sql = (
-                f"PUT 'file://{local_path}' '{stage_path}' "
-                f"AUTO_COMPRESS=TRUE OVERWRITE=TRUE"
-            )
-            try:
-                print(f"  [PUT] {f.name} -> {stage_path}")
-                cur.execute(put_sql)
-                result = cur.fetchall()
-                status = result[0][6] if result and len(result[0]) > 6 else "UNKNOWN"
-                if status in ("UPLOADED", "SKIPPED"):
-                    print(f"        {status}")
-                    newly_uploaded.append(f.name)
-                else:
-                    write_fail(f"        PUT status: {status}")
-            except Exception as e:
-                write_fail(f"        PUT失敗: {e}")
+        # 旧定義のままの環境では COPY / MERGE が失敗するため、PUT（マニフェストの更新）の前に止める
+        missing = missing_columns(cur)
+        if missing:
+            write_fail(f"テーブルが旧定義のままです（{', '.join(missing)} がありません）")
+            write_fail("管理者が snowflake/setup/06_migrate_slim_storage.sql を実行してからアップロードしてください")
+            return
 
+        # --- PUT → @LAYER1.STAGE（前回のオフセット以降の差分だけ、並列） ---
+        with tempfile.TemporaryDirectory() as tmp:
+            uploads = plan_uploads(all_files, manifest, Path(tmp))
+            save_manifest(manifest)
+            if uploads:
+                write_info(f"PUT: {len(uploads)} files (workers={workers}, PARALLEL={put_parallel})")
+            start_time = time.perf_counter()
+            for item, ok, elapsed in put_files(conn, uploads, stage_path, workers, put_parallel):
+                size = item["local"].stat().st_size
+                if not ok:
+                    continue
+                # 成功したファイルだけマニフェストを進める（失敗分は次回同じ範囲を再送）
+                manifest["files"][item["name"]] = item["entry"]
+                save_manifest(manifest)
+                newly_uploaded.append(item["local"].name)
+                uploaded_bytes += size
+                print(f"        {item['local'].name}: {_format_throughput(size, elapsed)}")
+            total_elapsed = time.perf_counter() - start_time
+
+        # 存在しないファイルのエントリを掃除
+        existing = {f.name for f in all_files}
+        for name in [n for n in manifest["files"] if n not in existing]:
+            manifest["files"].pop(name)
+        save_manifest(manifest)
+
+        if not uploads:
+            write_info("新しいデータはありません (--force で全ファイル再アップロード)")
+            return
         if not newly_uploaded:
-            write_info("アップロードされたファイルがありません。")
+            write_fail("PUT がすべて失敗しました。次回同じ範囲を再送します。")
+            return
+        write_ok(f"PUT: {len(newly_uploaded)}/{len(uploads)} files, "
+                 f"{_format_throughput(uploaded_bytes, total_elapsed)}")
+        if put_only:
+            write_info("--put-only: 取り込みはサーバー側タスク (PIPELINE_COPY_TASK) が行います")
             return
 
         # --- STEP 1: COPY INTO LAYER1.RAW_EVENTS ---
@@ -596,45 +1672,89 @@ def action_upload(force: bool = False):
 
         # --- STEP 2: MERGE INTO LAYER2.EVENTS ---
         print()
-        write_info("STEP 2: MERGE INTO LAYER2.EVENTS (重複排除) ...")
+        write_info("STEP 2: MERGE INTO LAYER2.EVENTS (重複排除・差分のみ) ...")
         try:
-            cur.execute(MERGE_EVENTS_SQL)
-            row = cur.fetchone()
-            inserted = row[0] if row else 0
+            inserted = merge_events(cur)
             write_ok(f"LAYER2.EVENTS: {inserted} new rows inserted")
         except Exception as e:
             write_fail(f"MERGE INTO LAYER2.EVENTS 失敗: {e}")
             return
+        purge_raw_events(cur)
 
         # --- STEP 3: MERGE INTO LAYER3 サマリーテーブル ---
         print()
-        write_info("STEP 3: LAYER3 サマリーテーブル更新 ...")
-        for label, sql in [
-            ("DAILY_SUMMARY", MERGE_DAILY_SQL),
-            ("USER_SUMMARY", MERGE_USER_SQL),
-            ("TOOL_SUMMARY", MERGE_TOOL_SQL),
-        ]:
-            try:
-                write_info(f"  MERGE INTO {label} ...")
-                cur.execute(sql)
-                row = cur.fetchone()
-                inserted = row[0] if row else 0
-                updated = row[1] if row and len(row) > 1 else 0
-                write_ok(f"  {label}: inserted={inserted}, updated={updated}")
-            except Exception as e:
-                write_fail(f"  {label} MERGE 失敗: {e}")
+        write_info("STEP 3: LAYER3 サマリーテーブル更新 (前回の更新以降に新しいイベントがあった日だけ) ...")
+        refresh_summaries(cur, full=force)
 
     finally:
         cur.close()
         conn.close()
 
-    # アップロード済み記録を更新
-    if newly_uploaded:
-        all_uploaded = list(set(uploaded + newly_uploaded))
-        save_uploaded(all_uploaded)
+    print()
+    write_ok(f"完了: {len(newly_uploaded)} チャンク/ファイルをアップロード")
+
+
+# ---------------------------------------------------------------------------
+# アクション: storage-report
+# ---------------------------------------------------------------------------
+def action_storage_report():
+    """LAYER1〜3 のテーブルごとのストレージ使用量を TABLE_STORAGE_METRICS から表示する。"""
+    try:
+        conn = create_connection()
+    except Exception as e:
+        write_fail(f"Snowflake 接続失敗: {e}")
+        return
+
+    cur = conn.cursor()
+    try:
+        cur.execute(STORAGE_METRICS_SQL)
+        rows = cur.fetchall()
+    except Exception as e:
+        write_fail(f"TABLE_STORAGE_METRICS を取得できません: {e}")
+        return
+    finally:
+        cur.close()
+        conn.close()
 
     print()
-    write_ok(f"完了: {len(newly_uploaded)} ファイルアップロード済み")
+    print(f"  {'TABLE':<32} {'ACTIVE':>10} {'TIME TRAVEL':>12} {'FAIL-SAFE':>10} {'CLONE':>8}  (MB)")
+    totals = [0.0, 0.0, 0.0, 0.0]
+    for schema, table, deleted, *sizes in rows:
+        name = f"{schema}.{table}" + (" (deleted)" if deleted else "")
+        sizes = [float(v or 0) for v in sizes]
+        totals = [t + v for t, v in zip(totals, sizes)]
+        print(f"  {name:<32} {sizes[0]:>10.2f} {sizes[1]:>12.2f} {sizes[2]:>10.2f} {sizes[3]:>8.2f}")
+    print(f"  {'合計':<30} {totals[0]:>10.2f} {totals[1]:>12.2f} {totals[2]:>10.2f} {totals[3]:>8.2f}")
+
+
+# ---------------------------------------------------------------------------
+# アクション: task-sql / lint-tasks
+# ---------------------------------------------------------------------------
+def action_task_sql():
+    """05_create_tasks.sql をアップローダーの SQL から再生成する。"""
+    TASK_DAG_FILE.write_text(build_task_dag_sql(), encoding="utf-8")
+    write_ok(f"生成しました: {TASK_DAG_FILE}")
+
+
+def action_lint_tasks() -> bool:
+    """05_create_tasks.sql を Snowflake に接続せずに検査する（ドライラン）。"""
+    if not TASK_DAG_FILE.exists():
+        write_fail(f"ファイルがありません: {TASK_DAG_FILE} (--action task-sql で生成)")
+        return False
+
+    text = TASK_DAG_FILE.read_text(encoding="utf-8")
+    errors = lint_task_dag(text)
+    if text != build_task_dag_sql():
+        errors.append("アップローダーの SQL と一致しません (--action task-sql で再生成してください)")
+
+    for error in errors:
+        write_fail(error)
+    if errors:
+        return False
+    tasks = [m.group("name") for _, masked in split_sql_statements(text)
+             for m in [_TASK_RE.match(masked)] if m]
+    write_ok(f"{TASK_DAG_FILE.name}: {len(tasks)} tasks OK ({' -> '.join(tasks)})")
+    return True
 
 
 # ---------------------------------------------------------------------------
@@ -645,13 +1765,27 @@ def main():
         description="Claude Code Usage Tracker - Snowflake Upload")
     parser.add_argument(
         "--action",
-        choices=["upload", "list", "config", "generate-key"],
+        choices=["upload", "list", "config", "generate-key", "task-sql", "lint-tasks",
+                 "storage-report"],
         default="upload",
         help="実行するアクション",
     )
     parser.add_argument(
         "--force", action="store_true",
-        help="アップロード済みファイルも再アップロード",
+        help="送信済みの範囲も含めて全ファイルを再アップロード",
+    )
+    parser.add_argument(
+        "--put-only", action="store_true",
+        default=get_env("USAGE_TRACKER_PUT_ONLY").lower() == "true",
+        help="PUT だけを行い、取り込みはサーバー側タスクに任せる (05_create_tasks.sql)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=DEFAULT_PUT_WORKERS,
+        help=f"同時に PUT するファイル数 (デフォルト: {DEFAULT_PUT_WORKERS})",
+    )
+    parser.add_argument(
+        "--put-parallel", type=int, default=DEFAULT_PUT_PARALLEL,
+        help=f"PUT の PARALLEL オプション (1-99, デフォルト: {DEFAULT_PUT_PARALLEL})",
     )
     parser.add_argument(
         "--no-input", action="store_true",
@@ -666,7 +1800,15 @@ def main():
     elif args.action == "list":
         action_list()
     elif args.action == "upload":
-        action_upload(force=args.force)
+        action_upload(force=args.force, workers=args.workers,
+                      put_parallel=min(max(args.put_parallel, 1), 99),
+                      put_only=args.put_only)
+    elif args.action == "storage-report":
+        action_storage_report()
+    elif args.action == "task-sql":
+        action_task_sql()
+    elif args.action == "lint-tasks":
+        sys.exit(0 if action_lint_tasks() else 1)
 
 
 if __name__ == "__main__":
@@ -2,15 +2,14 @@
 # queries.py - Snowflake SQL クエリ関数
 #
 # データソース:
-#   LAYER3 SUMMARY テーブル → 8 クエリ（高速・事前集計済み）
-#   LAYER2 EVENTS          → 6 クエリ（時間帯・セッション詳細など粒度が必要なもの）
+#   LAYER3 SUMMARY テーブル → 18 クエリ（高速・事前集計済み）
+#   LAYER2 EVENTS          → なし（ダッシュボードは LAYER2 を読まない）
 # =============================================================================
 
 import streamlit as st
 import pandas as pd
 from helpers import get_session
 
-_L2 = "CLAUDE_USAGE_DB.LAYER2"  # イベント詳細
 _L3 = "CLAUDE_USAGE_DB.LAYER3"  # サマリーテーブル
 
 # =============================================================================
@@ -19,7 +18,7 @@ _L3 = "CLAUDE_USAGE_DB.LAYER3"  # サマリーテーブル
 
 @st.cache_data(ttl=300)
 def get_kpi_overview(team_id: str, days: int) -> pd.DataFrame:
-    """概要KPI（DAILY_SUMMARY + USER_SUMMARY）"""
+    """概要KPI（DAILY_SUMMARY。ユーザー数は USERS_HLL を期間で合算した推定値）"""
     query = f"""
     WITH cur_daily AS (
         SELECT
@@ -33,8 +32,8 @@ def get_kpi_overview(team_id: str, days: int) -> pd.DataFrame:
           AND SUMMARY_DATE >= DATEADD('day', -{days}, CURRENT_DATE())
     ),
     cur_users AS (
-        SELECT COUNT(DISTINCT USER_ID) AS ACTIVE_USERS
-        FROM {_L3}.USER_SUMMARY
+        SELECT HLL_ESTIMATE(HLL_COMBINE(USERS_HLL)) AS ACTIVE_USERS
+        FROM {_L3}.DAILY_SUMMARY
         WHERE TEAM_ID = '{team_id}'
           AND SUMMARY_DATE >= DATEADD('day', -{days}, CURRENT_DATE())
     ),
@@ -50,15 +49,15 @@ def get_kpi_overview(team_id: str, days: int) -> pd.DataFrame:
           AND SUMMARY_DATE <  DATEADD('day', -{days},     CURRENT_DATE())
     ),
     prev_users AS (
-        SELECT COUNT(DISTINCT USER_ID) AS ACTIVE_USERS
-        FROM {_L3}.USER_SUMMARY
+        SELECT HLL_ESTIMATE(HLL_COMBINE(USERS_HLL)) AS ACTIVE_USERS
+        FROM {_L3}.DAILY_SUMMARY
         WHERE TEAM_ID = '{team_id}'
           AND SUMMARY_DATE >= DATEADD('day', -{days * 2}, CURRENT_DATE())
           AND SUMMARY_DATE <  DATEADD('day', -{days},     CURRENT_DATE())
     ),
     tot AS (
-        SELECT COUNT(DISTINCT USER_ID) AS TOTAL_USERS
-        FROM {_L3}.USER_SUMMARY
+        SELECT HLL_ESTIMATE(HLL_COMBINE(USERS_HLL)) AS TOTAL_USERS
+        FROM {_L3}.DAILY_SUMMARY
         WHERE TEAM_ID = '{team_id}'
     )
     SELECT
@@ -101,15 +100,15 @@ def get_timeline_data(team_id: str, days: int) -> pd.DataFrame:
 
 @st.cache_data(ttl=300)
 def get_heatmap_data(team_id: str, days: int) -> pd.DataFrame:
-    """時間帯×曜日ヒートマップ（USAGE_EVENTS — 時間粒度が必要）"""
+    """時間帯×曜日ヒートマップ（HOURLY_SUMMARY）"""
     query = f"""
     SELECT
-        DAYOFWEEK(EVENT_TIMESTAMP) AS DOW,
-        HOUR(EVENT_TIMESTAMP)      AS HOUR_OF_DAY,
-        COUNT(*)                   AS EVENT_COUNT
-    FROM {_L2}.EVENTS
+        DAYOFWEEK(SUMMARY_DATE) AS DOW,
+        HOUR_OF_DAY,
+        SUM(TOTAL_EVENTS)       AS EVENT_COUNT
+    FROM {_L3}.HOURLY_SUMMARY
     WHERE TEAM_ID = '{team_id}'
-      AND EVENT_TIMESTAMP >= DATEADD('day', -{days}, CURRENT_TIMESTAMP())
+      AND SUMMARY_DATE >= DATEADD('day', -{days}, CURRENT_DATE())
     GROUP BY 1, 2
     ORDER BY 1, 2
     """
@@ -176,15 +175,14 @@ def get_user_detail_timeline(team_id: str, user_id: str, days: int) -> pd.DataFr
 
 @st.cache_data(ttl=300)
 def get_user_top_tools(team_id: str, user_id: str, days: int) -> pd.DataFrame:
-    """ユーザー別Topツール（USAGE_EVENTS — ユーザー×ツール粒度が必要）"""
+    """ユーザー別Topツール（USER_TOOL_SUMMARY）"""
     safe_uid = user_id.replace("'", "''")
     query = f"""
-    SELECT TOOL_NAME, COUNT(*) AS CNT
-    FROM {_L2}.EVENTS
+    SELECT TOOL_NAME, SUM(EXECUTION_COUNT) AS CNT
+    FROM {_L3}.USER_TOOL_SUMMARY
     WHERE TEAM_ID = '{team_id}'
       AND USER_ID = '{safe_uid}'
-      AND TOOL_NAME IS NOT NULL
-      AND EVENT_TIMESTAMP >= DATEADD('day', -{days}, CURRENT_TIMESTAMP())
+      AND SUMMARY_DATE >= DATEADD('day', -{days}, CURRENT_DATE())
     GROUP BY TOOL_NAME
     ORDER BY CNT DESC
     LIMIT 10
@@ -209,7 +207,8 @@ def get_tool_stats(team_id: str, days: int, limit: int = 15) -> pd.DataFrame:
         ROUND(
             SUM(SUCCESS_COUNT)
             / NULLIF(SUM(EXECUTION_COUNT), 0) * 100, 1
-        ) AS SUCCESS_RATE
+        ) AS SUCCESS_RATE,
+        HLL_ESTIMATE(HLL_COMBINE(USERS_HLL)) AS USER_COUNT
     FROM {_L3}.TOOL_SUMMARY
     WHERE TEAM_ID = '{team_id}'
       AND SUMMARY_DATE >= DATEADD('day', -{days}, CURRENT_DATE())
@@ -252,32 +251,21 @@ def get_tool_trend(team_id: str, days: int) -> pd.DataFrame:
         return pd.DataFrame()
 
 # =============================================================================
-# Tab4 セッション（USAGE_EVENTS — SESSION_ID 単位の計算が必要）
+# Tab4 セッション（SESSION_SUMMARY — 期間内に活動のあったセッション）
 # =============================================================================
 
 @st.cache_data(ttl=300)
 def get_session_kpi(team_id: str, days: int) -> pd.DataFrame:
     query = f"""
-    WITH sessions AS (
-        SELECT
-            SESSION_ID,
-            USER_ID,
-            MIN(EVENT_TIMESTAMP) AS start_time,
-            MAX(EVENT_TIMESTAMP) AS end_time,
-            MAX(CASE WHEN STOP_REASON = 'usage_limit' THEN 1 ELSE 0 END) AS is_limit,
-            COALESCE(MAX(STOP_REASON), 'unknown') AS stop_reason
-        FROM {_L2}.EVENTS
-        WHERE TEAM_ID = '{team_id}'
-          AND EVENT_TIMESTAMP >= DATEADD('day', -{days}, CURRENT_TIMESTAMP())
-        GROUP BY SESSION_ID, USER_ID
-    )
     SELECT
-        COUNT(*)                                                 AS TOTAL_SESSIONS,
-        ROUND(AVG(DATEDIFF('minute', start_time, end_time)), 1) AS AVG_DURATION_MIN,
-        SUM(is_limit)                                            AS LIMIT_STOPPED,
-        COUNT(CASE WHEN stop_reason = 'normal' THEN 1 END)      AS NORMAL_STOPPED,
-        COUNT(DISTINCT USER_ID)                                  AS ACTIVE_USERS_SESS
-    FROM sessions
+        COUNT(*)                                            AS TOTAL_SESSIONS,
+        ROUND(AVG(DURATION_MIN), 1)                         AS AVG_DURATION_MIN,
+        COUNT(CASE WHEN IS_LIMIT_STOPPED THEN 1 END)        AS LIMIT_STOPPED,
+        COUNT(CASE WHEN STOP_REASON = 'normal' THEN 1 END)  AS NORMAL_STOPPED,
+        COUNT(DISTINCT USER_ID)                             AS ACTIVE_USERS_SESS
+    FROM {_L3}.SESSION_SUMMARY
+    WHERE TEAM_ID = '{team_id}'
+      AND END_AT >= DATEADD('day', -{days}, CURRENT_TIMESTAMP())
     """
     try:
         return get_session().sql(query).to_pandas()
@@ -287,14 +275,15 @@ def get_session_kpi(team_id: str, days: int) -> pd.DataFrame:
 
 @st.cache_data(ttl=300)
 def get_stop_reason_data(team_id: str, days: int) -> pd.DataFrame:
+    """停止理由別セッション数（SESSION_SUMMARY）。各セッションは最後の停止理由で1回だけ数え、
+    停止理由の無いセッションは 'unknown' にする（合計はセッション数の KPI と一致する）"""
     query = f"""
     SELECT
         COALESCE(STOP_REASON, 'unknown') AS STOP_REASON,
-        COUNT(DISTINCT SESSION_ID)       AS SESSION_COUNT
-    FROM {_L2}.EVENTS
+        COUNT(*)    AS SESSION_COUNT
+    FROM {_L3}.SESSION_SUMMARY
     WHERE TEAM_ID = '{team_id}'
-      AND EVENT_TYPE = 'Stop'
-      AND EVENT_TIMESTAMP >= DATEADD('day', -{days}, CURRENT_TIMESTAMP())
+      AND END_AT >= DATEADD('day', -{days}, CURRENT_TIMESTAMP())
     GROUP BY 1
     ORDER BY 2 DESC
     """
@@ -306,15 +295,15 @@ def get_stop_reason_data(team_id: str, days: int) -> pd.DataFrame:
 
 @st.cache_data(ttl=300)
 def get_limit_hit_by_hour(team_id: str, days: int) -> pd.DataFrame:
-    """時間帯別制限ヒット（USAGE_EVENTS — 時間粒度が必要）"""
+    """時間帯別制限ヒット（HOURLY_SUMMARY）"""
     query = f"""
     SELECT
-        HOUR(EVENT_TIMESTAMP) AS HOUR_OF_DAY,
-        COUNT(*)              AS LIMIT_HITS
-    FROM {_L2}.EVENTS
+        HOUR_OF_DAY,
+        SUM(LIMIT_HIT_COUNT) AS LIMIT_HITS
+    FROM {_L3}.HOURLY_SUMMARY
     WHERE TEAM_ID = '{team_id}'
-      AND IS_USAGE_LIMIT = TRUE
-      AND EVENT_TIMESTAMP >= DATEADD('day', -{days}, CURRENT_TIMESTAMP())
+      AND LIMIT_HIT_COUNT > 0
+      AND SUMMARY_DATE >= DATEADD('day', -{days}, CURRENT_DATE())
     GROUP BY 1
     ORDER BY 1
     """
@@ -324,22 +313,22 @@ def get_limit_hit_by_hour(team_id: str, days: int) -> pd.DataFrame:
         return pd.DataFrame()
 
 # =============================================================================
-# Tab5 プロジェクト（USAGE_EVENTS — PROJECT_NAME 粒度が必要）
+# Tab5 プロジェクト（PROJECT_SUMMARY）
 # =============================================================================
 
 @st.cache_data(ttl=300)
 def get_project_ranking(team_id: str, days: int, limit: int = 15) -> pd.DataFrame:
     query = f"""
     SELECT
-        COALESCE(PROJECT_NAME, '(no project)') AS PROJECT_NAME,
-        COUNT(*)                               AS EVENT_COUNT,
-        COUNT(DISTINCT USER_ID)               AS USER_COUNT,
-        COUNT(CASE WHEN EVENT_TYPE = 'UserPromptSubmit' THEN 1 END) AS MSG_COUNT,
-        COUNT(CASE WHEN IS_SKILL = TRUE THEN 1 END)                 AS SKILL_COUNT,
-        COUNT(CASE WHEN IS_MCP   = TRUE THEN 1 END)                 AS MCP_COUNT
-    FROM {_L2}.EVENTS
+        PROJECT_NAME,
+        SUM(TOTAL_EVENTS)   AS EVENT_COUNT,
+        HLL_ESTIMATE(HLL_COMBINE(USERS_HLL)) AS USER_COUNT,   -- 期間内のユーザー数（推定値）
+        SUM(MESSAGE_COUNT)  AS MSG_COUNT,
+        SUM(SKILL_COUNT)    AS SKILL_COUNT,
+        SUM(MCP_COUNT)      AS MCP_COUNT
+    FROM {_L3}.PROJECT_SUMMARY
     WHERE TEAM_ID = '{team_id}'
-      AND EVENT_TIMESTAMP >= DATEADD('day', -{days}, CURRENT_TIMESTAMP())
+      AND SUMMARY_DATE >= DATEADD('day', -{days}, CURRENT_DATE())
     GROUP BY 1
     ORDER BY EVENT_COUNT DESC
     LIMIT {limit}
@@ -355,32 +344,16 @@ def get_project_ranking(team_id: str, days: int, limit: int = 15) -> pd.DataFram
 
 @st.cache_data(ttl=300)
 def get_monthly_active(team_id: str) -> pd.DataFrame:
-    """月次アクティブ（DAILY_SUMMARY + USER_SUMMARY）"""
+    """月次アクティブ（DAILY_SUMMARY。ユーザー数は USERS_HLL を月で合算した推定値）"""
     query = f"""
-    WITH monthly_counts AS (
-        SELECT
-            DATE_TRUNC('month', SUMMARY_DATE)::DATE AS MONTH,
-            SUM(MESSAGE_COUNT)                      AS MESSAGES,
-            SUM(SESSION_COUNT)                      AS SESSIONS
-        FROM {_L3}.DAILY_SUMMARY
-        WHERE TEAM_ID = '{team_id}'
-        GROUP BY 1
-    ),
-    monthly_users AS (
-        SELECT
-            DATE_TRUNC('month', SUMMARY_DATE)::DATE AS MONTH,
-            COUNT(DISTINCT USER_ID)                 AS ACTIVE_USERS
-        FROM {_L3}.USER_SUMMARY
-        WHERE TEAM_ID = '{team_id}'
-        GROUP BY 1
-    )
     SELECT
-        u.MONTH,
-        u.ACTIVE_USERS,
-        c.SESSIONS,
-        c.MESSAGES
-    FROM monthly_users u
-    JOIN monthly_counts c ON u.MONTH = c.MONTH
+        DATE_TRUNC('month', SUMMARY_DATE)::DATE AS MONTH,
+        HLL_ESTIMATE(HLL_COMBINE(USERS_HLL))    AS ACTIVE_USERS,
+        SUM(SESSION_COUNT)                      AS SESSIONS,
+        SUM(MESSAGE_COUNT)                      AS MESSAGES
+    FROM {_L3}.DAILY_SUMMARY
+    WHERE TEAM_ID = '{team_id}'
+    GROUP BY 1
     ORDER BY 1
     """
     try:
@@ -424,7 +397,7 @@ def get_feature_adoption(team_id: str, days: int) -> pd.DataFrame:
 
 @st.cache_data(ttl=300)
 def get_roi_kpi(team_id: str, days: int) -> pd.DataFrame:
-    """導入効果KPI（DAILY/USER/TOOL_SUMMARY 横断）"""
+    """導入効果KPI（DAILY/USER/TOOL_SUMMARY 横断。アクティブユーザー数は USERS_HLL の推定値）"""
     query = f"""
     WITH cur AS (
         SELECT
@@ -437,9 +410,9 @@ def get_roi_kpi(team_id: str, days: int) -> pd.DataFrame:
     ),
     cur_users AS (
         SELECT
-            COUNT(DISTINCT USER_ID) AS ACTIVE_USERS,
-            SUM(TOTAL_EVENTS)       AS TOTAL_EVENTS
-        FROM {_L3}.USER_SUMMARY
+            HLL_ESTIMATE(HLL_COMBINE(USERS_HLL)) AS ACTIVE_USERS,
+            SUM(TOTAL_EVENTS)                    AS TOTAL_EVENTS
+        FROM {_L3}.DAILY_SUMMARY
         WHERE TEAM_ID = '{team_id}'
           AND SUMMARY_DATE >= DATEADD('day', -{days}, CURRENT_DATE())
     ),
@@ -477,9 +450,9 @@ def get_roi_kpi(team_id: str, days: int) -> pd.DataFrame:
     ),
     prev_users AS (
         SELECT
-            COUNT(DISTINCT USER_ID) AS ACTIVE_USERS,
-            SUM(TOTAL_EVENTS)       AS TOTAL_EVENTS
-        FROM {_L3}.USER_SUMMARY
+            HLL_ESTIMATE(HLL_COMBINE(USERS_HLL)) AS ACTIVE_USERS,
+            SUM(TOTAL_EVENTS)                    AS TOTAL_EVENTS
+        FROM {_L3}.DAILY_SUMMARY
         WHERE TEAM_ID = '{team_id}'
           AND SUMMARY_DATE >= DATEADD('day', -{days * 2}, CURRENT_DATE())
           AND SUMMARY_DATE <  DATEADD('day', -{days}, CURRENT_DATE())
@@ -512,8 +485,8 @@ def get_roi_kpi(team_id: str, days: int) -> pd.DataFrame:
         )
     ),
     tot AS (
-        SELECT COUNT(DISTINCT USER_ID) AS TOTAL_USERS
-        FROM {_L3}.USER_SUMMARY
+        SELECT HLL_ESTIMATE(HLL_COMBINE(USERS_HLL)) AS TOTAL_USERS
+        FROM {_L3}.DAILY_SUMMARY
         WHERE TEAM_ID = '{team_id}'
     )
     SELECT
@@ -543,39 +516,20 @@ def get_roi_kpi(team_id: str, days: int) -> pd.DataFrame:
 
 @st.cache_data(ttl=300)
 def get_productivity_trend(team_id: str, days: int) -> pd.DataFrame:
-    """日次生産性トレンド（DAILY_SUMMARY + USER_SUMMARY）"""
+    """日次生産性トレンド（DAILY_SUMMARY。1日単位なので ACTIVE_USERS をそのまま使う）"""
     cap = min(days, 90)
     query = f"""
-    WITH daily_tools AS (
-        SELECT
-            SUMMARY_DATE,
-            SUM(TOOL_EXECUTION_COUNT) AS TOOL_EXECS,
-            SUM(MESSAGE_COUNT)        AS MESSAGES,
-            SUM(SESSION_COUNT)        AS SESSIONS
-        FROM {_L3}.DAILY_SUMMARY
-        WHERE TEAM_ID = '{team_id}'
-          AND SUMMARY_DATE >= DATEADD('day', -{cap}, CURRENT_DATE())
-        GROUP BY SUMMARY_DATE
-    ),
-    daily_users AS (
-        SELECT
-            SUMMARY_DATE,
-            COUNT(DISTINCT USER_ID) AS ACTIVE_USERS
-        FROM {_L3}.USER_SUMMARY
-        WHERE TEAM_ID = '{team_id}'
-          AND SUMMARY_DATE >= DATEADD('day', -{cap}, CURRENT_DATE())
-        GROUP BY SUMMARY_DATE
-    )
     SELECT
-        t.SUMMARY_DATE AS EVENT_DATE,
-        t.TOOL_EXECS,
-        t.MESSAGES,
-        t.SESSIONS,
-        u.ACTIVE_USERS,
-        ROUND(t.TOOL_EXECS / NULLIF(u.ACTIVE_USERS, 0), 1) AS TOOLS_PER_USER,
-        ROUND(t.MESSAGES  / NULLIF(u.ACTIVE_USERS, 0), 1)  AS MSGS_PER_USER
-    FROM daily_tools t
-    LEFT JOIN daily_users u ON t.SUMMARY_DATE = u.SUMMARY_DATE
+        SUMMARY_DATE                                             AS EVENT_DATE,
+        TOOL_EXECUTION_COUNT                                     AS TOOL_EXECS,
+        MESSAGE_COUNT                                            AS MESSAGES,
+        SESSION_COUNT                                            AS SESSIONS,
+        ACTIVE_USERS,
+        ROUND(TOOL_EXECUTION_COUNT / NULLIF(ACTIVE_USERS, 0), 1) AS TOOLS_PER_USER,
+        ROUND(MESSAGE_COUNT        / NULLIF(ACTIVE_USERS, 0), 1) AS MSGS_PER_USER
+    FROM {_L3}.DAILY_SUMMARY
+    WHERE TEAM_ID = '{team_id}'
+      AND SUMMARY_DATE >= DATEADD('day', -{cap}, CURRENT_DATE())
     ORDER BY 1
     """
     try:
@@ -86,7 +86,7 @@ def render_sessions(team_id: str, days: int):
                 textfont=dict(size=11, color="#0f172a"),
             ))
             fig.update_layout(
-                title_text="停止理由の内訳",
+                title_text="停止理由の内訳<br><sup>セッションごとの最後の停止理由</sup>",
                 annotations=[dict(
                     text=f"{total_sess}<br><span style='font-size:10px'>Sessions</span>",
                     x=0.5, y=0.5, font_size=15, showarrow=False,
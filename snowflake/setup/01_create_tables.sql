@@ -3,7 +3,7 @@
 -- 実行順序: 01_create_tables.sql → 02_load_data.sql → 03_create_streamlit.sql
 --
 -- レイヤー構成:
---   LAYER1 (Raw)   : ステージ + RAW_EVENTS（JSONL そのまま保持）
+--   LAYER1 (Raw)   : ステージ + RAW_EVENTS（JSONL そのまま保持。LAYER2 取り込み後 14 日で削除）
 --   LAYER2 (Clean) : EVENTS（カラム展開・重複排除・蓄積）
 --   LAYER3 (Mart)  : サマリーテーブル + ダッシュボード用ビュー
 -- ============================================================================
@@ -45,12 +45,23 @@ CREATE STAGE IF NOT EXISTS CLAUDE_USAGE_INTERNAL_STAGE
     COMMENT = 'JSONL イベントログのアップロード先';
 
 -- 生ログテーブル（JSONL の各行を VARIANT としてそのまま保持）
+-- LAYER2 への取り込み待ちのバッファ。取り込み済みの行は 14 日で削除する（02_load_data.sql STEP 2-1）。
+-- 重複排除は LAYER2 の EVENT_HASH で行うため、ここには主キーを置かない。
+-- 生データの原本はステージのファイルにあるため、Time Travel は最小にする。
 CREATE TABLE IF NOT EXISTS RAW_EVENTS (
     RAW_DATA      VARIANT        NOT NULL,       -- JSONL 1行 = 1レコード
-    SOURCE_FILE   VARCHAR(255),                   -- アップロード元ファイル名
-    RECEIVED_AT   TIMESTAMP_NTZ  DEFAULT CURRENT_TIMESTAMP(),
-    PRIMARY KEY (RAW_DATA)                        -- VARIANT の完全一致で重複防止
-);
+    SOURCE_FILE   VARCHAR(255),                   -- ステージ上のファイルパス (METADATA$FILENAME)
+    SOURCE_ROW    INTEGER,                        -- ファイル内の行番号 (METADATA$FILE_ROW_NUMBER)
+    RECEIVED_AT   TIMESTAMP_NTZ  DEFAULT CURRENT_TIMESTAMP()
+)
+DATA_RETENTION_TIME_IN_DAYS = 1;
+
+-- RAW_EVENTS に追加された行だけを LAYER2 の MERGE に渡すストリーム
+-- （MERGE のコミットで消費され、次回は以降に COPY された行だけが見える）
+CREATE STREAM IF NOT EXISTS RAW_EVENTS_STREAM
+    ON TABLE RAW_EVENTS
+    APPEND_ONLY = TRUE
+    COMMENT = 'LAYER2.EVENTS への差分 MERGE 用';
 
 -- ============================================================================
 -- 2. LAYER2: EVENTS（カラム展開・重複排除・蓄積）
@@ -59,7 +70,7 @@ USE SCHEMA CLAUDE_USAGE_DB.LAYER2;
 
 CREATE TABLE IF NOT EXISTS EVENTS (
     -- 重複排除キー
-    EVENT_HASH       VARCHAR(64)   NOT NULL,      -- SHA2(RAW_DATA) で生成
+    EVENT_HASH       VARCHAR(64)   NOT NULL,      -- RAW_DATA:event_id（旧データは SHA2(RAW_DATA)）
 
     -- イベント基本情報
     EVENT_TYPE       VARCHAR(50)   NOT NULL,
@@ -90,8 +101,9 @@ CREATE TABLE IF NOT EXISTS EVENTS (
     IS_USAGE_LIMIT   BOOLEAN DEFAULT FALSE,
     STOP_REASON      VARCHAR(50),
 
-    -- 生データ参照
-    RAW_DATA         VARIANT,
+    -- 生データへのポインタ（ステージ上のファイルと行番号。RAW_DATA 自体は持たない）
+    SOURCE_FILE      VARCHAR(255),
+    SOURCE_ROW       INTEGER,
 
     PRIMARY KEY (EVENT_HASH)
 );
@@ -118,7 +130,8 @@ CREATE TABLE IF NOT EXISTS DAILY_SUMMARY (
     COMMAND_COUNT         INTEGER      DEFAULT 0,
     SKILL_COUNT           INTEGER      DEFAULT 0,
     LIMIT_HIT_COUNT       INTEGER      DEFAULT 0,
-    ACTIVE_USERS          INTEGER      DEFAULT 0,
+    ACTIVE_USERS          INTEGER      DEFAULT 0,     -- その日の COUNT(DISTINCT)。日をまたいで足せない
+    USERS_HLL             BINARY,                     -- ユーザーの HLL 状態。HLL_COMBINE で期間合算する
     SUCCESS_RATE          FLOAT,
     UPDATED_AT            TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP(),
     PRIMARY KEY (SUMMARY_DATE, TEAM_ID)
@@ -151,10 +164,123 @@ CREATE TABLE IF NOT EXISTS TOOL_SUMMARY (
     EXECUTION_COUNT  INTEGER      DEFAULT 0,
     SUCCESS_COUNT    INTEGER      DEFAULT 0,
     FAILURE_COUNT    INTEGER      DEFAULT 0,
+    USERS_HLL        BINARY,                          -- ツールを使ったユーザーの HLL 状態
     UPDATED_AT       TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP(),
     PRIMARY KEY (SUMMARY_DATE, TEAM_ID, TOOL_NAME)
 );
 
+-- 時間帯別サマリー（ヒートマップ・時間帯別の制限ヒット用。HOUR_OF_DAY は JST の 0〜23）
+CREATE TABLE IF NOT EXISTS HOURLY_SUMMARY (
+    SUMMARY_DATE          DATE         NOT NULL,
+    HOUR_OF_DAY           INTEGER      NOT NULL,
+    TEAM_ID               VARCHAR(100) NOT NULL,
+    TOTAL_EVENTS          INTEGER      DEFAULT 0,
+    MESSAGE_COUNT         INTEGER      DEFAULT 0,
+    TOOL_EXECUTION_COUNT  INTEGER      DEFAULT 0,
+    LIMIT_HIT_COUNT       INTEGER      DEFAULT 0,
+    ACTIVE_USERS          INTEGER      DEFAULT 0,
+    UPDATED_AT            TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP(),
+    PRIMARY KEY (SUMMARY_DATE, HOUR_OF_DAY, TEAM_ID)
+);
+
+-- プロジェクト別日次サマリー（PROJECT_NAME が無いイベントは '(no project)'）
+CREATE TABLE IF NOT EXISTS PROJECT_SUMMARY (
+    SUMMARY_DATE          DATE         NOT NULL,
+    TEAM_ID               VARCHAR(100) NOT NULL,
+    PROJECT_NAME          VARCHAR(255) NOT NULL,
+    TOTAL_EVENTS          INTEGER      DEFAULT 0,
+    MESSAGE_COUNT         INTEGER      DEFAULT 0,
+    SESSION_COUNT         INTEGER      DEFAULT 0,
+    TOOL_EXECUTION_COUNT  INTEGER      DEFAULT 0,
+    SUCCESS_COUNT         INTEGER      DEFAULT 0,
+    FAILURE_COUNT         INTEGER      DEFAULT 0,
+    SKILL_COUNT           INTEGER      DEFAULT 0,
+    MCP_COUNT             INTEGER      DEFAULT 0,
+    ACTIVE_USERS          INTEGER      DEFAULT 0,
+    USERS_HLL             BINARY,                     -- プロジェクトのユーザーの HLL 状態
+    UPDATED_AT            TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP(),
+    PRIMARY KEY (SUMMARY_DATE, TEAM_ID, PROJECT_NAME)
+);
+
+-- ユーザー×ツール別日次サマリー（ユーザー詳細の Top ツール用）
+CREATE TABLE IF NOT EXISTS USER_TOOL_SUMMARY (
+    SUMMARY_DATE     DATE         NOT NULL,
+    TEAM_ID          VARCHAR(100) NOT NULL,
+    USER_ID          VARCHAR(255) NOT NULL,
+    TOOL_NAME        VARCHAR(100) NOT NULL,
+    EXECUTION_COUNT  INTEGER      DEFAULT 0,
+    SUCCESS_COUNT    INTEGER      DEFAULT 0,
+    FAILURE_COUNT    INTEGER      DEFAULT 0,
+    UPDATED_AT       TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP(),
+    PRIMARY KEY (SUMMARY_DATE, TEAM_ID, USER_ID, TOOL_NAME)
+);
+
+-- セッション別サマリー（セッションタブ用。イベントが追加されたセッションだけ更新する）
+CREATE TABLE IF NOT EXISTS SESSION_SUMMARY (
+    TEAM_ID               VARCHAR(100) NOT NULL,
+    SESSION_ID            VARCHAR(100) NOT NULL,
+    USER_ID               VARCHAR(255) NOT NULL,
+    PROJECT_NAME          VARCHAR(255),
+    START_AT              TIMESTAMP_NTZ,                 -- JST
+    END_AT                TIMESTAMP_NTZ,                 -- JST
+    DURATION_MIN          INTEGER,
+    EVENT_COUNT           INTEGER      DEFAULT 0,
+    MESSAGE_COUNT         INTEGER      DEFAULT 0,
+    TOOL_EXECUTION_COUNT  INTEGER      DEFAULT 0,
+    TOOL_FAILURE_COUNT    INTEGER      DEFAULT 0,
+    LIMIT_HIT_COUNT       INTEGER      DEFAULT 0,
+    STOP_REASON           VARCHAR(50),                   -- Stop イベントが無いセッションは NULL
+    IS_LIMIT_STOPPED      BOOLEAN      DEFAULT FALSE,
+    UPDATED_AT            TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP(),
+    PRIMARY KEY (TEAM_ID, SESSION_ID, USER_ID)
+);
+
+-- USERS_HLL が無い旧定義で作成済みの環境向け（ADMIN_GUIDE.md「新しいサマリーテーブルの初期投入」で埋める）
+ALTER TABLE DAILY_SUMMARY   ADD COLUMN IF NOT EXISTS USERS_HLL BINARY;
+ALTER TABLE TOOL_SUMMARY    ADD COLUMN IF NOT EXISTS USERS_HLL BINARY;
+ALTER TABLE PROJECT_SUMMARY ADD COLUMN IF NOT EXISTS USERS_HLL BINARY;
+
+-- サマリー更新の状態（ロールアップの排他制御と、前回の更新位置）
+-- 更新はこの行を UPDATE してロックを取ったトランザクションの中で行う（アップローダー・タスク共通）。
+-- WATERMARK 以降に LAYER2 に追加された行のパーティションを次回集計する。
+-- 1970-01-01 に戻すと次回の更新で全期間を集計し直す。
+CREATE TABLE IF NOT EXISTS SUMMARY_REFRESH_STATE (
+    NAME                  VARCHAR(50)  NOT NULL,
+    WATERMARK             TIMESTAMP_NTZ,                 -- 前回の更新の開始時刻（RECEIVED_AT と比較）
+    LOCKED_AT             TIMESTAMP_NTZ,                 -- 更新中のみ設定
+    UPDATED_AT            TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP(),
+    PRIMARY KEY (NAME)
+);
+
+INSERT INTO SUMMARY_REFRESH_STATE (NAME, WATERMARK)
+SELECT 'LAYER3', '1970-01-01'::TIMESTAMP_NTZ
+WHERE NOT EXISTS (SELECT 1 FROM SUMMARY_REFRESH_STATE WHERE NAME = 'LAYER3');
+
+-- サマリー集計の作業用テーブル（(日付, 時, チーム, ユーザー, プロジェクト, ツール) 粒度）。
+-- 上のロックを取ったトランザクション内で DELETE → INSERT する（一時テーブルの CREATE は
+-- トランザクションを暗黙にコミットするため使わない）。
+CREATE TRANSIENT TABLE IF NOT EXISTS SUMMARY_GRAIN (
+    SUMMARY_DATE          DATE,
+    HOUR_OF_DAY           INTEGER,
+    TEAM_ID               VARCHAR(100),
+    USER_ID               VARCHAR(255),
+    PROJECT_NAME          VARCHAR(255),
+    TOOL_NAME             VARCHAR(100),
+    TOTAL_EVENTS          INTEGER,
+    MESSAGE_COUNT         INTEGER,
+    SESSION_COUNT         INTEGER,
+    TOOL_EXECUTION_COUNT  INTEGER,
+    MCP_COUNT             INTEGER,
+    SUBAGENT_COUNT        INTEGER,
+    COMMAND_COUNT         INTEGER,
+    SKILL_COUNT           INTEGER,
+    LIMIT_HIT_COUNT       INTEGER,
+    SUCCESS_COUNT         INTEGER,
+    FAILURE_COUNT         INTEGER,
+    LAST_ACTIVE_AT        TIMESTAMP_NTZ
+)
+DATA_RETENTION_TIME_IN_DAYS = 0;
+
 -- ============================================================================
 -- 4. LAYER3: ビュー（ダッシュボード用 — ソースは LAYER2.EVENTS）
 -- ============================================================================
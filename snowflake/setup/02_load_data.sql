@@ -11,7 +11,8 @@ USE WAREHOUSE CLAUDE_USAGE_WH;
 -- STEP 1: Stage → LAYER1.RAW_EVENTS
 --
 -- JSONL の各行を VARIANT としてそのまま保持。
--- ファイル名をメタデータとして記録。
+-- ファイル名と行番号をメタデータとして記録（LAYER2 から生データを参照するためのポインタ）。
+-- LAYER2 に取り込んだ行は 14 日後に STEP 2-1 で削除する。
 --
 -- 【手順】
 --   1. PUT でローカルファイルをステージにアップロード:
@@ -21,11 +22,12 @@ USE WAREHOUSE CLAUDE_USAGE_WH;
 --   2. 以下の COPY INTO を実行
 -- ============================================================================
 
-COPY INTO CLAUDE_USAGE_DB.LAYER1.RAW_EVENTS (RAW_DATA, SOURCE_FILE)
+COPY INTO CLAUDE_USAGE_DB.LAYER1.RAW_EVENTS (RAW_DATA, SOURCE_FILE, SOURCE_ROW)
 FROM (
     SELECT
         $1,
-        METADATA$FILENAME
+        METADATA$FILENAME,
+        METADATA$FILE_ROW_NUMBER
     FROM @CLAUDE_USAGE_DB.LAYER1.CLAUDE_USAGE_INTERNAL_STAGE
 )
 ON_ERROR = 'CONTINUE';
@@ -35,13 +37,18 @@ ON_ERROR = 'CONTINUE';
 -- STEP 2: LAYER1.RAW_EVENTS → LAYER2.EVENTS
 --
 -- カラム展開・型変換・重複排除して蓄積。
--- EVENT_HASH (SHA2) で MERGE するため、同一データの重複ロードを防止。
+-- EVENT_HASH（Hook が生成した event_id。旧データは SHA2(RAW_DATA)）で MERGE するため、
+-- 同一イベントの重複ロードを防止。
+--
+-- ソースは RAW_EVENTS 全体ではなくストリーム RAW_EVENTS_STREAM（前回の MERGE 以降に
+-- COPY された行だけ）。コストは履歴全体ではなく新しい行数に比例する。
+-- ストリームを作り直した場合・stale になった場合は、末尾の「全件 MERGE」を1回実行する。
 -- ============================================================================
 
 MERGE INTO CLAUDE_USAGE_DB.LAYER2.EVENTS AS tgt
 USING (
     SELECT
-        SHA2(RAW_DATA::VARCHAR)                                       AS EVENT_HASH,
+        COALESCE(RAW_DATA:event_id::VARCHAR, SHA2(RAW_DATA::VARCHAR)) AS EVENT_HASH,
         RAW_DATA:event_type::VARCHAR                                  AS EVENT_TYPE,
         CONVERT_TIMEZONE('UTC', 'Asia/Tokyo',
             TRY_TO_TIMESTAMP_NTZ(RAW_DATA:timestamp::VARCHAR))        AS EVENT_TIMESTAMP,
@@ -61,48 +68,134 @@ USING (
         COALESCE(RAW_DATA:categories:file_operation::BOOLEAN, FALSE)  AS IS_FILE_OPERATION,
         COALESCE(RAW_DATA:is_usage_limit::BOOLEAN,            FALSE)  AS IS_USAGE_LIMIT,
         RAW_DATA:stop_reason::VARCHAR                                 AS STOP_REASON,
-        RAW_DATA                                                      AS RAW_DATA
-    FROM CLAUDE_USAGE_DB.LAYER1.RAW_EVENTS
+        SOURCE_FILE                                                   AS SOURCE_FILE,
+        SOURCE_ROW                                                    AS SOURCE_ROW
+    FROM CLAUDE_USAGE_DB.LAYER1.RAW_EVENTS_STREAM
     WHERE RAW_DATA:event_type IS NOT NULL
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY EVENT_HASH ORDER BY RECEIVED_AT) = 1
 ) AS src
 ON tgt.EVENT_HASH = src.EVENT_HASH
 WHEN NOT MATCHED THEN INSERT (
     EVENT_HASH, EVENT_TYPE, EVENT_TIMESTAMP, USER_ID, TEAM_ID,
     SESSION_ID, PROJECT_NAME, TOOL_NAME, TOOL_SUCCESS, OUTPUT_LENGTH,
     ERROR_MESSAGE, PROMPT_LENGTH, IS_SKILL, IS_SUBAGENT, IS_MCP,
-    IS_COMMAND, IS_FILE_OPERATION, IS_USAGE_LIMIT, STOP_REASON, RAW_DATA
+    IS_COMMAND, IS_FILE_OPERATION, IS_USAGE_LIMIT, STOP_REASON, SOURCE_FILE, SOURCE_ROW
 ) VALUES (
     src.EVENT_HASH, src.EVENT_TYPE, src.EVENT_TIMESTAMP, src.USER_ID, src.TEAM_ID,
     src.SESSION_ID, src.PROJECT_NAME, src.TOOL_NAME, src.TOOL_SUCCESS, src.OUTPUT_LENGTH,
     src.ERROR_MESSAGE, src.PROMPT_LENGTH, src.IS_SKILL, src.IS_SUBAGENT, src.IS_MCP,
-    src.IS_COMMAND, src.IS_FILE_OPERATION, src.IS_USAGE_LIMIT, src.STOP_REASON, src.RAW_DATA
+    src.IS_COMMAND, src.IS_FILE_OPERATION, src.IS_USAGE_LIMIT, src.STOP_REASON,
+    src.SOURCE_FILE, src.SOURCE_ROW
 );
 
 
+-- ============================================================================
+-- STEP 2-1: LAYER1.RAW_EVENTS の保持期間削除
+--
+-- STEP 2 の MERGE（ストリームの消費）が成功した直後に実行する。
+-- 14 日より前に COPY された行はすべて LAYER2 に取り込み済みなので削除する。
+-- 生データはステージの元ファイルに残り、LAYER2.EVENTS の SOURCE_FILE / SOURCE_ROW から参照できる:
+--   SELECT $1 FROM @CLAUDE_USAGE_DB.LAYER1.CLAUDE_USAGE_INTERNAL_STAGE/<SOURCE_FILE>
+--   WHERE METADATA$FILE_ROW_NUMBER = <SOURCE_ROW>;
+-- ============================================================================
+
+DELETE FROM CLAUDE_USAGE_DB.LAYER1.RAW_EVENTS
+WHERE RECEIVED_AT < DATEADD('DAY', -14, CURRENT_TIMESTAMP()::TIMESTAMP_NTZ);
+
 -- ============================================================================
 -- STEP 3: LAYER2.EVENTS → LAYER3 サマリーテーブル
+--
+-- 前回の更新（SUMMARY_REFRESH_STATE.WATERMARK）以降に追加された行（RECEIVED_AT >= $REFRESH_FROM）の
+-- (日付, チーム) を touched とし、そのパーティションの EVENTS を1回だけ読んで作業用テーブル SUMMARY_GRAIN に集計する。
+-- 各サマリーは SUMMARY_GRAIN からロールアップして MERGE する。
+-- 集計はパーティション内の全イベントで行うため、結果は全件再集計と同じになる。
+-- DAILY / TOOL / PROJECT_SUMMARY の USERS_HLL（HLL_ACCUMULATE）は期間をまたいだユーザー数の推定用。
+--
+-- 3-0 から 3-8 までを1つのトランザクションで実行する。先頭の UPDATE でロックを取るため、
+-- 同時に実行したアップローダー・タスクは COMMIT まで待つ（古い集計で上書きしない）。
+-- 途中で失敗したら ROLLBACK する（WATERMARK が進まないので、次回同じ範囲を集計し直す）。
+-- サマリーを全期間で再集計したい場合は、3-0 の SET を次に置き換える:
+--   SET (REFRESH_FROM, REFRESH_STARTED_AT) = ('1970-01-01'::TIMESTAMP_NTZ, CURRENT_TIMESTAMP()::TIMESTAMP_NTZ);
 -- ============================================================================
 
+-- 3-0. ロックと集計範囲（WATERMARK の 1 日前から。コミットの遅れ・セッションの TIMEZONE の違いを吸収する）
+MERGE INTO CLAUDE_USAGE_DB.LAYER3.SUMMARY_REFRESH_STATE AS tgt
+USING (SELECT 'LAYER3' AS NAME) AS src
+ON tgt.NAME = src.NAME
+WHEN NOT MATCHED THEN INSERT (NAME, WATERMARK) VALUES (src.NAME, '1970-01-01'::TIMESTAMP_NTZ);
+
+BEGIN TRANSACTION;
+
+UPDATE CLAUDE_USAGE_DB.LAYER3.SUMMARY_REFRESH_STATE
+SET LOCKED_AT = CURRENT_TIMESTAMP()::TIMESTAMP_NTZ
+WHERE NAME = 'LAYER3';
+
+SET (REFRESH_FROM, REFRESH_STARTED_AT) = (
+    SELECT DATEADD('DAY', -1, WATERMARK), CURRENT_TIMESTAMP()::TIMESTAMP_NTZ
+    FROM CLAUDE_USAGE_DB.LAYER3.SUMMARY_REFRESH_STATE
+    WHERE NAME = 'LAYER3'
+);
+
+-- 最も細かい粒度 (日付, 時, チーム, ユーザー, プロジェクト, ツール) の作業用テーブル（EVENTS を読むのはここだけ）
+DELETE FROM CLAUDE_USAGE_DB.LAYER3.SUMMARY_GRAIN;
+
+INSERT INTO CLAUDE_USAGE_DB.LAYER3.SUMMARY_GRAIN
+WITH touched AS (
+    -- 前回の更新以降に LAYER2 に追加された行のキー（RECEIVED_AT で新しいマイクロパーティションだけを読む）
+    SELECT DISTINCT
+        DATE_TRUNC('DAY', EVENT_TIMESTAMP)::DATE AS SUMMARY_DATE,
+        TEAM_ID
+    FROM CLAUDE_USAGE_DB.LAYER2.EVENTS
+    WHERE RECEIVED_AT >= $REFRESH_FROM
+)
+SELECT
+    DATE_TRUNC('DAY', EVENT_TIMESTAMP)::DATE AS SUMMARY_DATE,
+    HOUR(EVENT_TIMESTAMP)                    AS HOUR_OF_DAY,
+    TEAM_ID,
+    USER_ID,
+    COALESCE(PROJECT_NAME, '(no project)')   AS PROJECT_NAME,
+    TOOL_NAME,
+    COUNT(*)                                               AS TOTAL_EVENTS,
+    COUNT(CASE WHEN EVENT_TYPE = 'UserPromptSubmit' THEN 1 END) AS MESSAGE_COUNT,
+    COUNT(CASE WHEN EVENT_TYPE = 'SessionStart'     THEN 1 END) AS SESSION_COUNT,
+    COUNT(CASE WHEN TOOL_NAME IS NOT NULL           THEN 1 END) AS TOOL_EXECUTION_COUNT,
+    COUNT(CASE WHEN IS_MCP      = TRUE THEN 1 END)  AS MCP_COUNT,
+    COUNT(CASE WHEN IS_SUBAGENT = TRUE THEN 1 END)  AS SUBAGENT_COUNT,
+    COUNT(CASE WHEN IS_COMMAND  = TRUE THEN 1 END)  AS COMMAND_COUNT,
+    COUNT(CASE WHEN IS_SKILL    = TRUE THEN 1 END)  AS SKILL_COUNT,
+    COUNT(CASE WHEN IS_USAGE_LIMIT = TRUE THEN 1 END) AS LIMIT_HIT_COUNT,
+    COUNT(CASE WHEN TOOL_SUCCESS = TRUE  THEN 1 END)  AS SUCCESS_COUNT,
+    COUNT(CASE WHEN TOOL_SUCCESS = FALSE THEN 1 END)  AS FAILURE_COUNT,
+    MAX(EVENT_TIMESTAMP)                             AS LAST_ACTIVE_AT
+FROM CLAUDE_USAGE_DB.LAYER2.EVENTS
+WHERE EVENT_TIMESTAMP >= (SELECT MIN(SUMMARY_DATE) FROM touched)
+  AND EVENT_TIMESTAMP <  (SELECT DATEADD('DAY', 1, MAX(SUMMARY_DATE)) FROM touched)
+  AND (DATE_TRUNC('DAY', EVENT_TIMESTAMP)::DATE, TEAM_ID) IN
+      (SELECT SUMMARY_DATE, TEAM_ID FROM touched)
+GROUP BY DATE_TRUNC('DAY', EVENT_TIMESTAMP), HOUR(EVENT_TIMESTAMP), TEAM_ID, USER_ID,
+         COALESCE(PROJECT_NAME, '(no project)'), TOOL_NAME;
+
 -- 3-1. 日別サマリー
 MERGE INTO CLAUDE_USAGE_DB.LAYER3.DAILY_SUMMARY AS tgt
 USING (
     SELECT
-        DATE_TRUNC('DAY', EVENT_TIMESTAMP)::DATE              AS SUMMARY_DATE,
+        SUMMARY_DATE,
         TEAM_ID,
-        COUNT(*)                                               AS TOTAL_EVENTS,
-        COUNT(CASE WHEN EVENT_TYPE = 'UserPromptSubmit' THEN 1 END) AS MESSAGE_COUNT,
-        COUNT(CASE WHEN EVENT_TYPE = 'SessionStart'     THEN 1 END) AS SESSION_COUNT,
-        COUNT(CASE WHEN TOOL_NAME IS NOT NULL           THEN 1 END) AS TOOL_EXECUTION_COUNT,
-        COUNT(CASE WHEN IS_MCP      = TRUE THEN 1 END)        AS MCP_COUNT,
-        COUNT(CASE WHEN IS_SUBAGENT = TRUE THEN 1 END)        AS SUBAGENT_COUNT,
-        COUNT(CASE WHEN IS_COMMAND  = TRUE THEN 1 END)        AS COMMAND_COUNT,
-        COUNT(CASE WHEN IS_SKILL    = TRUE THEN 1 END)        AS SKILL_COUNT,
-        COUNT(CASE WHEN IS_USAGE_LIMIT = TRUE THEN 1 END)     AS LIMIT_HIT_COUNT,
-        COUNT(DISTINCT USER_ID)                                AS ACTIVE_USERS,
-        ROUND(AVG(CASE WHEN TOOL_SUCCESS IS NOT NULL
-            THEN CASE WHEN TOOL_SUCCESS THEN 1.0 ELSE 0.0 END END) * 100, 1) AS SUCCESS_RATE
-    FROM CLAUDE_USAGE_DB.LAYER2.EVENTS
-    GROUP BY DATE_TRUNC('DAY', EVENT_TIMESTAMP), TEAM_ID
+        SUM(TOTAL_EVENTS)          AS TOTAL_EVENTS,
+        SUM(MESSAGE_COUNT)         AS MESSAGE_COUNT,
+        SUM(SESSION_COUNT)         AS SESSION_COUNT,
+        SUM(TOOL_EXECUTION_COUNT)  AS TOOL_EXECUTION_COUNT,
+        SUM(MCP_COUNT)             AS MCP_COUNT,
+        SUM(SUBAGENT_COUNT)        AS SUBAGENT_COUNT,
+        SUM(COMMAND_COUNT)         AS COMMAND_COUNT,
+        SUM(SKILL_COUNT)           AS SKILL_COUNT,
+        SUM(LIMIT_HIT_COUNT)       AS LIMIT_HIT_COUNT,
+        COUNT(DISTINCT USER_ID)    AS ACTIVE_USERS,
+        HLL_ACCUMULATE(USER_ID)    AS USERS_HLL,
+        ROUND(SUM(SUCCESS_COUNT)
+            / NULLIF(SUM(SUCCESS_COUNT) + SUM(FAILURE_COUNT), 0) * 100, 1) AS SUCCESS_RATE
+    FROM CLAUDE_USAGE_DB.LAYER3.SUMMARY_GRAIN
+    GROUP BY SUMMARY_DATE, TEAM_ID
 ) AS src
 ON tgt.SUMMARY_DATE = src.SUMMARY_DATE AND tgt.TEAM_ID = src.TEAM_ID
 WHEN MATCHED THEN UPDATE SET
@@ -116,37 +209,38 @@ WHEN MATCHED THEN UPDATE SET
     SKILL_COUNT          = src.SKILL_COUNT,
     LIMIT_HIT_COUNT      = src.LIMIT_HIT_COUNT,
     ACTIVE_USERS         = src.ACTIVE_USERS,
+    USERS_HLL            = src.USERS_HLL,
     SUCCESS_RATE         = src.SUCCESS_RATE,
     UPDATED_AT           = CURRENT_TIMESTAMP()
 WHEN NOT MATCHED THEN INSERT (
     SUMMARY_DATE, TEAM_ID, TOTAL_EVENTS, MESSAGE_COUNT, SESSION_COUNT,
     TOOL_EXECUTION_COUNT, MCP_COUNT, SUBAGENT_COUNT, COMMAND_COUNT, SKILL_COUNT,
-    LIMIT_HIT_COUNT, ACTIVE_USERS, SUCCESS_RATE
+    LIMIT_HIT_COUNT, ACTIVE_USERS, USERS_HLL, SUCCESS_RATE
 ) VALUES (
     src.SUMMARY_DATE, src.TEAM_ID, src.TOTAL_EVENTS, src.MESSAGE_COUNT, src.SESSION_COUNT,
     src.TOOL_EXECUTION_COUNT, src.MCP_COUNT, src.SUBAGENT_COUNT, src.COMMAND_COUNT, src.SKILL_COUNT,
-    src.LIMIT_HIT_COUNT, src.ACTIVE_USERS, src.SUCCESS_RATE
+    src.LIMIT_HIT_COUNT, src.ACTIVE_USERS, src.USERS_HLL, src.SUCCESS_RATE
 );
 
 -- 3-2. ユーザー別日次サマリー
 MERGE INTO CLAUDE_USAGE_DB.LAYER3.USER_SUMMARY AS tgt
 USING (
     SELECT
-        DATE_TRUNC('DAY', EVENT_TIMESTAMP)::DATE              AS SUMMARY_DATE,
+        SUMMARY_DATE,
         USER_ID,
         TEAM_ID,
-        COUNT(*)                                               AS TOTAL_EVENTS,
-        COUNT(CASE WHEN EVENT_TYPE = 'UserPromptSubmit' THEN 1 END) AS MESSAGE_COUNT,
-        COUNT(CASE WHEN EVENT_TYPE = 'SessionStart'     THEN 1 END) AS SESSION_COUNT,
-        COUNT(CASE WHEN TOOL_NAME IS NOT NULL           THEN 1 END) AS TOOL_EXECUTION_COUNT,
-        COUNT(CASE WHEN IS_MCP      = TRUE THEN 1 END)        AS MCP_COUNT,
-        COUNT(CASE WHEN IS_SUBAGENT = TRUE THEN 1 END)        AS SUBAGENT_COUNT,
-        COUNT(CASE WHEN IS_COMMAND  = TRUE THEN 1 END)        AS COMMAND_COUNT,
-        COUNT(CASE WHEN IS_SKILL    = TRUE THEN 1 END)        AS SKILL_COUNT,
-        COUNT(CASE WHEN IS_USAGE_LIMIT = TRUE THEN 1 END)     AS LIMIT_HIT_COUNT,
-        MAX(EVENT_TIMESTAMP)                                   AS LAST_ACTIVE_AT
-    FROM CLAUDE_USAGE_DB.LAYER2.EVENTS
-    GROUP BY DATE_TRUNC('DAY', EVENT_TIMESTAMP), USER_ID, TEAM_ID
+        SUM(TOTAL_EVENTS)          AS TOTAL_EVENTS,
+        SUM(MESSAGE_COUNT)         AS MESSAGE_COUNT,
+        SUM(SESSION_COUNT)         AS SESSION_COUNT,
+        SUM(TOOL_EXECUTION_COUNT)  AS TOOL_EXECUTION_COUNT,
+        SUM(MCP_COUNT)             AS MCP_COUNT,
+        SUM(SUBAGENT_COUNT)        AS SUBAGENT_COUNT,
+        SUM(COMMAND_COUNT)         AS COMMAND_COUNT,
+        SUM(SKILL_COUNT)           AS SKILL_COUNT,
+        SUM(LIMIT_HIT_COUNT)       AS LIMIT_HIT_COUNT,
+        MAX(LAST_ACTIVE_AT)        AS LAST_ACTIVE_AT
+    FROM CLAUDE_USAGE_DB.LAYER3.SUMMARY_GRAIN
+    GROUP BY SUMMARY_DATE, USER_ID, TEAM_ID
 ) AS src
 ON  tgt.SUMMARY_DATE = src.SUMMARY_DATE
 AND tgt.USER_ID      = src.USER_ID
@@ -177,15 +271,16 @@ WHEN NOT MATCHED THEN INSERT (
 MERGE INTO CLAUDE_USAGE_DB.LAYER3.TOOL_SUMMARY AS tgt
 USING (
     SELECT
-        DATE_TRUNC('DAY', EVENT_TIMESTAMP)::DATE  AS SUMMARY_DATE,
+        SUMMARY_DATE,
         TEAM_ID,
         TOOL_NAME,
-        COUNT(*)                                           AS EXECUTION_COUNT,
-        COUNT(CASE WHEN TOOL_SUCCESS = TRUE  THEN 1 END)  AS SUCCESS_COUNT,
-        COUNT(CASE WHEN TOOL_SUCCESS = FALSE THEN 1 END)  AS FAILURE_COUNT
-    FROM CLAUDE_USAGE_DB.LAYER2.EVENTS
+        SUM(TOTAL_EVENTS)   AS EXECUTION_COUNT,
+        SUM(SUCCESS_COUNT)  AS SUCCESS_COUNT,
+        SUM(FAILURE_COUNT)  AS FAILURE_COUNT,
+        HLL_ACCUMULATE(USER_ID) AS USERS_HLL
+    FROM CLAUDE_USAGE_DB.LAYER3.SUMMARY_GRAIN
     WHERE TOOL_NAME IS NOT NULL
-    GROUP BY DATE_TRUNC('DAY', EVENT_TIMESTAMP), TEAM_ID, TOOL_NAME
+    GROUP BY SUMMARY_DATE, TEAM_ID, TOOL_NAME
 ) AS src
 ON  tgt.SUMMARY_DATE = src.SUMMARY_DATE
 AND tgt.TEAM_ID      = src.TEAM_ID
@@ -194,14 +289,203 @@ WHEN MATCHED THEN UPDATE SET
     EXECUTION_COUNT = src.EXECUTION_COUNT,
     SUCCESS_COUNT   = src.SUCCESS_COUNT,
     FAILURE_COUNT   = src.FAILURE_COUNT,
+    USERS_HLL       = src.USERS_HLL,
     UPDATED_AT      = CURRENT_TIMESTAMP()
 WHEN NOT MATCHED THEN INSERT (
-    SUMMARY_DATE, TEAM_ID, TOOL_NAME, EXECUTION_COUNT, SUCCESS_COUNT, FAILURE_COUNT
+    SUMMARY_DATE, TEAM_ID, TOOL_NAME, EXECUTION_COUNT, SUCCESS_COUNT, FAILURE_COUNT, USERS_HLL
 ) VALUES (
     src.SUMMARY_DATE, src.TEAM_ID, src.TOOL_NAME,
+    src.EXECUTION_COUNT, src.SUCCESS_COUNT, src.FAILURE_COUNT, src.USERS_HLL
+);
+
+-- 3-4. 時間帯別サマリー（ヒートマップ・時間帯別の制限ヒット用）
+MERGE INTO CLAUDE_USAGE_DB.LAYER3.HOURLY_SUMMARY AS tgt
+USING (
+    SELECT
+        SUMMARY_DATE,
+        HOUR_OF_DAY,
+        TEAM_ID,
+        SUM(TOTAL_EVENTS)          AS TOTAL_EVENTS,
+        SUM(MESSAGE_COUNT)         AS MESSAGE_COUNT,
+        SUM(TOOL_EXECUTION_COUNT)  AS TOOL_EXECUTION_COUNT,
+        SUM(LIMIT_HIT_COUNT)       AS LIMIT_HIT_COUNT,
+        COUNT(DISTINCT USER_ID)    AS ACTIVE_USERS
+    FROM CLAUDE_USAGE_DB.LAYER3.SUMMARY_GRAIN
+    GROUP BY SUMMARY_DATE, HOUR_OF_DAY, TEAM_ID
+) AS src
+ON  tgt.SUMMARY_DATE = src.SUMMARY_DATE
+AND tgt.HOUR_OF_DAY  = src.HOUR_OF_DAY
+AND tgt.TEAM_ID      = src.TEAM_ID
+WHEN MATCHED THEN UPDATE SET
+    TOTAL_EVENTS         = src.TOTAL_EVENTS,
+    MESSAGE_COUNT        = src.MESSAGE_COUNT,
+    TOOL_EXECUTION_COUNT = src.TOOL_EXECUTION_COUNT,
+    LIMIT_HIT_COUNT      = src.LIMIT_HIT_COUNT,
+    ACTIVE_USERS         = src.ACTIVE_USERS,
+    UPDATED_AT           = CURRENT_TIMESTAMP()
+WHEN NOT MATCHED THEN INSERT (
+    SUMMARY_DATE, HOUR_OF_DAY, TEAM_ID, TOTAL_EVENTS, MESSAGE_COUNT,
+    TOOL_EXECUTION_COUNT, LIMIT_HIT_COUNT, ACTIVE_USERS
+) VALUES (
+    src.SUMMARY_DATE, src.HOUR_OF_DAY, src.TEAM_ID, src.TOTAL_EVENTS, src.MESSAGE_COUNT,
+    src.TOOL_EXECUTION_COUNT, src.LIMIT_HIT_COUNT, src.ACTIVE_USERS
+);
+
+-- 3-5. プロジェクト別日次サマリー
+MERGE INTO CLAUDE_USAGE_DB.LAYER3.PROJECT_SUMMARY AS tgt
+USING (
+    SELECT
+        SUMMARY_DATE,
+        TEAM_ID,
+        PROJECT_NAME,
+        SUM(TOTAL_EVENTS)          AS TOTAL_EVENTS,
+        SUM(MESSAGE_COUNT)         AS MESSAGE_COUNT,
+        SUM(SESSION_COUNT)         AS SESSION_COUNT,
+        SUM(TOOL_EXECUTION_COUNT)  AS TOOL_EXECUTION_COUNT,
+        SUM(SUCCESS_COUNT)         AS SUCCESS_COUNT,
+        SUM(FAILURE_COUNT)         AS FAILURE_COUNT,
+        SUM(SKILL_COUNT)           AS SKILL_COUNT,
+        SUM(MCP_COUNT)             AS MCP_COUNT,
+        COUNT(DISTINCT USER_ID)    AS ACTIVE_USERS,
+        HLL_ACCUMULATE(USER_ID)    AS USERS_HLL
+    FROM CLAUDE_USAGE_DB.LAYER3.SUMMARY_GRAIN
+    GROUP BY SUMMARY_DATE, TEAM_ID, PROJECT_NAME
+) AS src
+ON  tgt.SUMMARY_DATE = src.SUMMARY_DATE
+AND tgt.TEAM_ID      = src.TEAM_ID
+AND tgt.PROJECT_NAME = src.PROJECT_NAME
+WHEN MATCHED THEN UPDATE SET
+    TOTAL_EVENTS         = src.TOTAL_EVENTS,
+    MESSAGE_COUNT        = src.MESSAGE_COUNT,
+    SESSION_COUNT        = src.SESSION_COUNT,
+    TOOL_EXECUTION_COUNT = src.TOOL_EXECUTION_COUNT,
+    SUCCESS_COUNT        = src.SUCCESS_COUNT,
+    FAILURE_COUNT        = src.FAILURE_COUNT,
+    SKILL_COUNT          = src.SKILL_COUNT,
+    MCP_COUNT            = src.MCP_COUNT,
+    ACTIVE_USERS         = src.ACTIVE_USERS,
+    USERS_HLL            = src.USERS_HLL,
+    UPDATED_AT           = CURRENT_TIMESTAMP()
+WHEN NOT MATCHED THEN INSERT (
+    SUMMARY_DATE, TEAM_ID, PROJECT_NAME, TOTAL_EVENTS, MESSAGE_COUNT, SESSION_COUNT,
+    TOOL_EXECUTION_COUNT, SUCCESS_COUNT, FAILURE_COUNT, SKILL_COUNT, MCP_COUNT, ACTIVE_USERS,
+    USERS_HLL
+) VALUES (
+    src.SUMMARY_DATE, src.TEAM_ID, src.PROJECT_NAME, src.TOTAL_EVENTS, src.MESSAGE_COUNT, src.SESSION_COUNT,
+    src.TOOL_EXECUTION_COUNT, src.SUCCESS_COUNT, src.FAILURE_COUNT, src.SKILL_COUNT, src.MCP_COUNT,
+    src.ACTIVE_USERS, src.USERS_HLL
+);
+
+-- 3-6. ユーザー×ツール別日次サマリー
+MERGE INTO CLAUDE_USAGE_DB.LAYER3.USER_TOOL_SUMMARY AS tgt
+USING (
+    SELECT
+        SUMMARY_DATE,
+        TEAM_ID,
+        USER_ID,
+        TOOL_NAME,
+        SUM(TOTAL_EVENTS)   AS EXECUTION_COUNT,
+        SUM(SUCCESS_COUNT)  AS SUCCESS_COUNT,
+        SUM(FAILURE_COUNT)  AS FAILURE_COUNT
+    FROM CLAUDE_USAGE_DB.LAYER3.SUMMARY_GRAIN
+    WHERE TOOL_NAME IS NOT NULL
+    GROUP BY SUMMARY_DATE, TEAM_ID, USER_ID, TOOL_NAME
+) AS src
+ON  tgt.SUMMARY_DATE = src.SUMMARY_DATE
+AND tgt.TEAM_ID      = src.TEAM_ID
+AND tgt.USER_ID      = src.USER_ID
+AND tgt.TOOL_NAME    = src.TOOL_NAME
+WHEN MATCHED THEN UPDATE SET
+    EXECUTION_COUNT = src.EXECUTION_COUNT,
+    SUCCESS_COUNT   = src.SUCCESS_COUNT,
+    FAILURE_COUNT   = src.FAILURE_COUNT,
+    UPDATED_AT      = CURRENT_TIMESTAMP()
+WHEN NOT MATCHED THEN INSERT (
+    SUMMARY_DATE, TEAM_ID, USER_ID, TOOL_NAME, EXECUTION_COUNT, SUCCESS_COUNT, FAILURE_COUNT
+) VALUES (
+    src.SUMMARY_DATE, src.TEAM_ID, src.USER_ID, src.TOOL_NAME,
     src.EXECUTION_COUNT, src.SUCCESS_COUNT, src.FAILURE_COUNT
 );
 
+-- 3-7. セッション別サマリー（SUMMARY_GRAIN ではなく、前回の更新以降にイベントが追加されたセッションだけ EVENTS から集計）
+MERGE INTO CLAUDE_USAGE_DB.LAYER3.SESSION_SUMMARY AS tgt
+USING (
+    WITH touched AS (
+        -- 前回の更新以降に LAYER2 に追加された行のセッション
+        SELECT DISTINCT TEAM_ID, SESSION_ID
+        FROM CLAUDE_USAGE_DB.LAYER2.EVENTS
+        WHERE RECEIVED_AT >= $REFRESH_FROM
+          AND SESSION_ID IS NOT NULL
+          AND SESSION_ID <> ''
+    )
+    SELECT
+        TEAM_ID,
+        SESSION_ID,
+        USER_ID,
+        MAX(PROJECT_NAME)                                      AS PROJECT_NAME,
+        MIN(EVENT_TIMESTAMP)                                   AS START_AT,
+        MAX(EVENT_TIMESTAMP)                                   AS END_AT,
+        DATEDIFF('minute', MIN(EVENT_TIMESTAMP), MAX(EVENT_TIMESTAMP)) AS DURATION_MIN,
+        COUNT(*)                                               AS EVENT_COUNT,
+        COUNT(CASE WHEN EVENT_TYPE = 'UserPromptSubmit' THEN 1 END) AS MESSAGE_COUNT,
+        COUNT(CASE WHEN TOOL_NAME IS NOT NULL           THEN 1 END) AS TOOL_EXECUTION_COUNT,
+        COUNT(CASE WHEN TOOL_SUCCESS = FALSE            THEN 1 END) AS TOOL_FAILURE_COUNT,
+        COUNT(CASE WHEN IS_USAGE_LIMIT = TRUE           THEN 1 END) AS LIMIT_HIT_COUNT,
+        MAX_BY(STOP_REASON, CASE WHEN STOP_REASON IS NOT NULL THEN EVENT_TIMESTAMP END) AS STOP_REASON,
+        MAX(CASE WHEN STOP_REASON = 'usage_limit' THEN 1 ELSE 0 END) = 1 AS IS_LIMIT_STOPPED
+    FROM CLAUDE_USAGE_DB.LAYER2.EVENTS
+    WHERE (TEAM_ID, SESSION_ID) IN (SELECT TEAM_ID, SESSION_ID FROM touched)
+    GROUP BY TEAM_ID, SESSION_ID, USER_ID
+) AS src
+ON  tgt.TEAM_ID    = src.TEAM_ID
+AND tgt.SESSION_ID = src.SESSION_ID
+AND tgt.USER_ID    = src.USER_ID
+WHEN MATCHED THEN UPDATE SET
+    PROJECT_NAME         = src.PROJECT_NAME,
+    START_AT             = src.START_AT,
+    END_AT               = src.END_AT,
+    DURATION_MIN         = src.DURATION_MIN,
+    EVENT_COUNT          = src.EVENT_COUNT,
+    MESSAGE_COUNT        = src.MESSAGE_COUNT,
+    TOOL_EXECUTION_COUNT = src.TOOL_EXECUTION_COUNT,
+    TOOL_FAILURE_COUNT   = src.TOOL_FAILURE_COUNT,
+    LIMIT_HIT_COUNT      = src.LIMIT_HIT_COUNT,
+    STOP_REASON          = src.STOP_REASON,
+    IS_LIMIT_STOPPED     = src.IS_LIMIT_STOPPED,
+    UPDATED_AT           = CURRENT_TIMESTAMP()
+WHEN NOT MATCHED THEN INSERT (
+    TEAM_ID, SESSION_ID, USER_ID, PROJECT_NAME, START_AT, END_AT, DURATION_MIN,
+    EVENT_COUNT, MESSAGE_COUNT, TOOL_EXECUTION_COUNT, TOOL_FAILURE_COUNT,
+    LIMIT_HIT_COUNT, STOP_REASON, IS_LIMIT_STOPPED
+) VALUES (
+    src.TEAM_ID, src.SESSION_ID, src.USER_ID, src.PROJECT_NAME, src.START_AT, src.END_AT, src.DURATION_MIN,
+    src.EVENT_COUNT, src.MESSAGE_COUNT, src.TOOL_EXECUTION_COUNT, src.TOOL_FAILURE_COUNT,
+    src.LIMIT_HIT_COUNT, src.STOP_REASON, src.IS_LIMIT_STOPPED
+);
+
+-- 3-8. 更新位置を進めてロックを解放する
+UPDATE CLAUDE_USAGE_DB.LAYER3.SUMMARY_REFRESH_STATE
+SET WATERMARK  = $REFRESH_STARTED_AT,
+    LOCKED_AT  = NULL,
+    UPDATED_AT = CURRENT_TIMESTAMP()
+WHERE NAME = 'LAYER3';
+
+COMMIT;
+
+-- ============================================================================
+-- （必要時のみ）ストリームの作り直しと全件 MERGE
+--
+-- ストリームが stale になった（保持期間を超えて MERGE されなかった）場合や、
+-- 既存環境にストリームを追加した場合に実行する。
+-- 先にストリームを作り直し、その後 STEP 2 の MERGE を
+-- FROM CLAUDE_USAGE_DB.LAYER1.RAW_EVENTS に置き換えて1回実行する。
+-- （upload_to_snowflake.py はストリームが使えないとき自動でこの手順を行う）
+-- ============================================================================
+
+-- CREATE OR REPLACE STREAM CLAUDE_USAGE_DB.LAYER1.RAW_EVENTS_STREAM
+--     ON TABLE CLAUDE_USAGE_DB.LAYER1.RAW_EVENTS
+--     APPEND_ONLY = TRUE;
+
 -- ============================================================================
 -- 確認クエリ
 -- ============================================================================
@@ -209,4 +493,8 @@ SELECT 'LAYER1.RAW_EVENTS'    AS TABLE_NAME, COUNT(*) AS ROW_COUNT FROM CLAUDE_U
 SELECT 'LAYER2.EVENTS',                      COUNT(*) FROM CLAUDE_USAGE_DB.LAYER2.EVENTS                  UNION ALL
 SELECT 'LAYER3.DAILY_SUMMARY',               COUNT(*) FROM CLAUDE_USAGE_DB.LAYER3.DAILY_SUMMARY           UNION ALL
 SELECT 'LAYER3.USER_SUMMARY',                COUNT(*) FROM CLAUDE_USAGE_DB.LAYER3.USER_SUMMARY            UNION ALL
-SELECT 'LAYER3.TOOL_SUMMARY',                COUNT(*) FROM CLAUDE_USAGE_DB.LAYER3.TOOL_SUMMARY;
+SELECT 'LAYER3.TOOL_SUMMARY',                COUNT(*) FROM CLAUDE_USAGE_DB.LAYER3.TOOL_SUMMARY            UNION ALL
+SELECT 'LAYER3.HOURLY_SUMMARY',              COUNT(*) FROM CLAUDE_USAGE_DB.LAYER3.HOURLY_SUMMARY          UNION ALL
+SELECT 'LAYER3.SESSION_SUMMARY',             COUNT(*) FROM CLAUDE_USAGE_DB.LAYER3.SESSION_SUMMARY         UNION ALL
+SELECT 'LAYER3.PROJECT_SUMMARY',             COUNT(*) FROM CLAUDE_USAGE_DB.LAYER3.PROJECT_SUMMARY         UNION ALL
+SELECT 'LAYER3.USER_TOOL_SUMMARY',           COUNT(*) FROM CLAUDE_USAGE_DB.LAYER3.USER_TOOL_SUMMARY;
@@ -0,0 +1,455 @@
+-- ============================================================================
+-- Claude Code Usage Tracker - サーバー側パイプライン（タスク DAG）
+-- 実行順序: 01_create_tables.sql → 05_create_tasks.sql
+--
+-- このファイルは upload_to_snowflake.py --action task-sql で生成しています。
+-- 直接編集せず、アップローダーの SQL を変更したら再生成し、
+-- upload_to_snowflake.py --action lint-tasks で確認してください。
+--
+-- PIPELINE_COPY_TASK（SCHEDULE = '15 MINUTE'）: ステージ → LAYER1.RAW_EVENTS
+--   └ PIPELINE_MERGE_TASK: RAW_EVENTS_STREAM → LAYER2.EVENTS → LAYER3 サマリー
+--                          → 保持期間（14日）を過ぎた RAW_EVENTS の削除
+--
+-- タスクはサーバー側で直列に実行され（前回の実行中は次の実行をスキップ）、
+-- ウェアハウスの起動も1回にまとまる。クライアントは
+-- upload_to_snowflake.py --action upload --put-only で PUT だけを行う。
+-- ============================================================================
+
+USE WAREHOUSE CLAUDE_USAGE_WH;
+
+-- 作り直す前にルートタスクを止める
+ALTER TASK IF EXISTS CLAUDE_USAGE_DB.LAYER1.PIPELINE_COPY_TASK SUSPEND;
+
+-- ルート: ステージの新しいファイルを RAW_EVENTS に COPY
+CREATE OR REPLACE TASK CLAUDE_USAGE_DB.LAYER1.PIPELINE_COPY_TASK
+    WAREHOUSE = CLAUDE_USAGE_WH
+    SCHEDULE = '15 MINUTE'
+    ALLOW_OVERLAPPING_EXECUTION = FALSE
+    COMMENT = 'Claude Usage: stage -> LAYER1.RAW_EVENTS'
+AS
+    COPY INTO CLAUDE_USAGE_DB.LAYER1.RAW_EVENTS (RAW_DATA, SOURCE_FILE, SOURCE_ROW)
+    FROM (
+        SELECT
+            $1,
+            METADATA$FILENAME,
+            METADATA$FILE_ROW_NUMBER
+        FROM @CLAUDE_USAGE_DB.LAYER1.CLAUDE_USAGE_INTERNAL_STAGE
+    )
+    ON_ERROR = 'CONTINUE';
+
+-- 子: ストリームに新しい行があれば LAYER2 → LAYER3 を更新
+CREATE OR REPLACE TASK CLAUDE_USAGE_DB.LAYER2.PIPELINE_MERGE_TASK
+    WAREHOUSE = CLAUDE_USAGE_WH
+    COMMENT = 'Claude Usage: RAW_EVENTS_STREAM -> LAYER2.EVENTS -> LAYER3'
+    AFTER CLAUDE_USAGE_DB.LAYER1.PIPELINE_COPY_TASK
+AS
+EXECUTE IMMEDIATE $$
+DECLARE
+    refresh_from TIMESTAMP_NTZ;
+    refresh_started_at TIMESTAMP_NTZ;
+BEGIN
+    IF (NOT SYSTEM$STREAM_HAS_DATA('CLAUDE_USAGE_DB.LAYER1.RAW_EVENTS_STREAM')) THEN
+        RETURN 'no new rows';
+    END IF;
+
+    MERGE INTO CLAUDE_USAGE_DB.LAYER2.EVENTS AS tgt
+    USING (
+        SELECT
+            COALESCE(RAW_DATA:event_id::VARCHAR, SHA2(RAW_DATA::VARCHAR)) AS EVENT_HASH,
+            RAW_DATA:event_type::VARCHAR                                  AS EVENT_TYPE,
+            CONVERT_TIMEZONE('UTC', 'Asia/Tokyo',
+                TRY_TO_TIMESTAMP_NTZ(RAW_DATA:timestamp::VARCHAR))        AS EVENT_TIMESTAMP,
+            RAW_DATA:user_id::VARCHAR                                     AS USER_ID,
+            COALESCE(RAW_DATA:team_id::VARCHAR, 'default-team')           AS TEAM_ID,
+            RAW_DATA:session_id::VARCHAR                                  AS SESSION_ID,
+            RAW_DATA:project::VARCHAR                                     AS PROJECT_NAME,
+            RAW_DATA:tool_name::VARCHAR                                   AS TOOL_NAME,
+            RAW_DATA:success::BOOLEAN                                     AS TOOL_SUCCESS,
+            RAW_DATA:output_length::INTEGER                               AS OUTPUT_LENGTH,
+            RAW_DATA:error::VARCHAR                                       AS ERROR_MESSAGE,
+            RAW_DATA:prompt_length::INTEGER                               AS PROMPT_LENGTH,
+            COALESCE(RAW_DATA:categories:skill::BOOLEAN,          FALSE)  AS IS_SKILL,
+            COALESCE(RAW_DATA:categories:subagent::BOOLEAN,       FALSE)  AS IS_SUBAGENT,
+            COALESCE(RAW_DATA:categories:mcp::BOOLEAN,            FALSE)  AS IS_MCP,
+            COALESCE(RAW_DATA:categories:command::BOOLEAN,        FALSE)  AS IS_COMMAND,
+            COALESCE(RAW_DATA:categories:file_operation::BOOLEAN, FALSE)  AS IS_FILE_OPERATION,
+            COALESCE(RAW_DATA:is_usage_limit::BOOLEAN,            FALSE)  AS IS_USAGE_LIMIT,
+            RAW_DATA:stop_reason::VARCHAR                                 AS STOP_REASON,
+            SOURCE_FILE                                                   AS SOURCE_FILE,
+            SOURCE_ROW                                                    AS SOURCE_ROW
+        FROM CLAUDE_USAGE_DB.LAYER1.RAW_EVENTS_STREAM
+        WHERE RAW_DATA:event_type IS NOT NULL
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY EVENT_HASH ORDER BY RECEIVED_AT) = 1
+    ) AS src
+    ON tgt.EVENT_HASH = src.EVENT_HASH
+    WHEN NOT MATCHED THEN INSERT (
+        EVENT_HASH, EVENT_TYPE, EVENT_TIMESTAMP, USER_ID, TEAM_ID,
+        SESSION_ID, PROJECT_NAME, TOOL_NAME, TOOL_SUCCESS, OUTPUT_LENGTH,
+        ERROR_MESSAGE, PROMPT_LENGTH, IS_SKILL, IS_SUBAGENT, IS_MCP,
+        IS_COMMAND, IS_FILE_OPERATION, IS_USAGE_LIMIT, STOP_REASON, SOURCE_FILE, SOURCE_ROW
+    ) VALUES (
+        src.EVENT_HASH, src.EVENT_TYPE, src.EVENT_TIMESTAMP, src.USER_ID, src.TEAM_ID,
+        src.SESSION_ID, src.PROJECT_NAME, src.TOOL_NAME, src.TOOL_SUCCESS, src.OUTPUT_LENGTH,
+        src.ERROR_MESSAGE, src.PROMPT_LENGTH, src.IS_SKILL, src.IS_SUBAGENT, src.IS_MCP,
+        src.IS_COMMAND, src.IS_FILE_OPERATION, src.IS_USAGE_LIMIT, src.STOP_REASON,
+        src.SOURCE_FILE, src.SOURCE_ROW
+    );
+
+    MERGE INTO CLAUDE_USAGE_DB.LAYER3.SUMMARY_REFRESH_STATE AS tgt
+    USING (SELECT 'LAYER3' AS NAME) AS src
+    ON tgt.NAME = src.NAME
+    WHEN NOT MATCHED THEN INSERT (NAME, WATERMARK) VALUES (src.NAME, '1970-01-01'::TIMESTAMP_NTZ);
+
+    BEGIN TRANSACTION;
+
+    UPDATE CLAUDE_USAGE_DB.LAYER3.SUMMARY_REFRESH_STATE
+    SET LOCKED_AT = CURRENT_TIMESTAMP()::TIMESTAMP_NTZ
+    WHERE NAME = 'LAYER3';
+
+    SELECT DATEADD('DAY', -1, WATERMARK), CURRENT_TIMESTAMP()::TIMESTAMP_NTZ
+    INTO :refresh_from, :refresh_started_at
+    FROM CLAUDE_USAGE_DB.LAYER3.SUMMARY_REFRESH_STATE
+    WHERE NAME = 'LAYER3';
+
+    DELETE FROM CLAUDE_USAGE_DB.LAYER3.SUMMARY_GRAIN;
+
+    INSERT INTO CLAUDE_USAGE_DB.LAYER3.SUMMARY_GRAIN
+    WITH touched AS (
+        -- 前回の更新以降に LAYER2 に追加された行のキー（RECEIVED_AT で新しいマイクロパーティションだけを読む）
+        SELECT DISTINCT
+            DATE_TRUNC('DAY', EVENT_TIMESTAMP)::DATE AS SUMMARY_DATE,
+            TEAM_ID
+        FROM CLAUDE_USAGE_DB.LAYER2.EVENTS
+        WHERE RECEIVED_AT >= :refresh_from
+    )
+    SELECT
+        DATE_TRUNC('DAY', EVENT_TIMESTAMP)::DATE AS SUMMARY_DATE,
+        HOUR(EVENT_TIMESTAMP)                    AS HOUR_OF_DAY,
+        TEAM_ID,
+        USER_ID,
+        COALESCE(PROJECT_NAME, '(no project)')   AS PROJECT_NAME,
+        TOOL_NAME,
+        COUNT(*)                                               AS TOTAL_EVENTS,
+        COUNT(CASE WHEN EVENT_TYPE = 'UserPromptSubmit' THEN 1 END) AS MESSAGE_COUNT,
+        COUNT(CASE WHEN EVENT_TYPE = 'SessionStart'     THEN 1 END) AS SESSION_COUNT,
+        COUNT(CASE WHEN TOOL_NAME IS NOT NULL           THEN 1 END) AS TOOL_EXECUTION_COUNT,
+        COUNT(CASE WHEN IS_MCP      = TRUE THEN 1 END)  AS MCP_COUNT,
+        COUNT(CASE WHEN IS_SUBAGENT = TRUE THEN 1 END)  AS SUBAGENT_COUNT,
+        COUNT(CASE WHEN IS_COMMAND  = TRUE THEN 1 END)  AS COMMAND_COUNT,
+        COUNT(CASE WHEN IS_SKILL    = TRUE THEN 1 END)  AS SKILL_COUNT,
+        COUNT(CASE WHEN IS_USAGE_LIMIT = TRUE THEN 1 END) AS LIMIT_HIT_COUNT,
+        COUNT(CASE WHEN TOOL_SUCCESS = TRUE  THEN 1 END)  AS SUCCESS_COUNT,
+        COUNT(CASE WHEN TOOL_SUCCESS = FALSE THEN 1 END)  AS FAILURE_COUNT,
+        MAX(EVENT_TIMESTAMP)                             AS LAST_ACTIVE_AT
+    FROM CLAUDE_USAGE_DB.LAYER2.EVENTS
+    WHERE EVENT_TIMESTAMP >= (SELECT MIN(SUMMARY_DATE) FROM touched)
+      AND EVENT_TIMESTAMP <  (SELECT DATEADD('DAY', 1, MAX(SUMMARY_DATE)) FROM touched)
+      AND (DATE_TRUNC('DAY', EVENT_TIMESTAMP)::DATE, TEAM_ID) IN
+          (SELECT SUMMARY_DATE, TEAM_ID FROM touched)
+    GROUP BY DATE_TRUNC('DAY', EVENT_TIMESTAMP), HOUR(EVENT_TIMESTAMP), TEAM_ID, USER_ID,
+             COALESCE(PROJECT_NAME, '(no project)'), TOOL_NAME;
+
+    MERGE INTO CLAUDE_USAGE_DB.LAYER3.DAILY_SUMMARY AS tgt
+    USING (
+        SELECT
+            SUMMARY_DATE,
+            TEAM_ID,
+            SUM(TOTAL_EVENTS)          AS TOTAL_EVENTS,
+            SUM(MESSAGE_COUNT)         AS MESSAGE_COUNT,
+            SUM(SESSION_COUNT)         AS SESSION_COUNT,
+            SUM(TOOL_EXECUTION_COUNT)  AS TOOL_EXECUTION_COUNT,
+            SUM(MCP_COUNT)             AS MCP_COUNT,
+            SUM(SUBAGENT_COUNT)        AS SUBAGENT_COUNT,
+            SUM(COMMAND_COUNT)         AS COMMAND_COUNT,
+            SUM(SKILL_COUNT)           AS SKILL_COUNT,
+            SUM(LIMIT_HIT_COUNT)       AS LIMIT_HIT_COUNT,
+            COUNT(DISTINCT USER_ID)    AS ACTIVE_USERS,
+            HLL_ACCUMULATE(USER_ID)    AS USERS_HLL,
+            ROUND(SUM(SUCCESS_COUNT)
+                / NULLIF(SUM(SUCCESS_COUNT) + SUM(FAILURE_COUNT), 0) * 100, 1) AS SUCCESS_RATE
+        FROM CLAUDE_USAGE_DB.LAYER3.SUMMARY_GRAIN
+        GROUP BY SUMMARY_DATE, TEAM_ID
+    ) AS src
+    ON tgt.SUMMARY_DATE = src.SUMMARY_DATE AND tgt.TEAM_ID = src.TEAM_ID
+    WHEN MATCHED THEN UPDATE SET
+        TOTAL_EVENTS         = src.TOTAL_EVENTS,
+        MESSAGE_COUNT        = src.MESSAGE_COUNT,
+        SESSION_COUNT        = src.SESSION_COUNT,
+        TOOL_EXECUTION_COUNT = src.TOOL_EXECUTION_COUNT,
+        MCP_COUNT            = src.MCP_COUNT,
+        SUBAGENT_COUNT       = src.SUBAGENT_COUNT,
+        COMMAND_COUNT        = src.COMMAND_COUNT,
+        SKILL_COUNT          = src.SKILL_COUNT,
+        LIMIT_HIT_COUNT      = src.LIMIT_HIT_COUNT,
+        ACTIVE_USERS         = src.ACTIVE_USERS,
+        USERS_HLL            = src.USERS_HLL,
+        SUCCESS_RATE         = src.SUCCESS_RATE,
+        UPDATED_AT           = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED THEN INSERT (
+        SUMMARY_DATE, TEAM_ID, TOTAL_EVENTS, MESSAGE_COUNT, SESSION_COUNT,
+        TOOL_EXECUTION_COUNT, MCP_COUNT, SUBAGENT_COUNT, COMMAND_COUNT, SKILL_COUNT,
+        LIMIT_HIT_COUNT, ACTIVE_USERS, USERS_HLL, SUCCESS_RATE
+    ) VALUES (
+        src.SUMMARY_DATE, src.TEAM_ID, src.TOTAL_EVENTS, src.MESSAGE_COUNT, src.SESSION_COUNT,
+        src.TOOL_EXECUTION_COUNT, src.MCP_COUNT, src.SUBAGENT_COUNT, src.COMMAND_COUNT, src.SKILL_COUNT,
+        src.LIMIT_HIT_COUNT, src.ACTIVE_USERS, src.USERS_HLL, src.SUCCESS_RATE
+    );
+
+    MERGE INTO CLAUDE_USAGE_DB.LAYER3.USER_SUMMARY AS tgt
+    USING (
+        SELECT
+            SUMMARY_DATE,
+            USER_ID,
+            TEAM_ID,
+            SUM(TOTAL_EVENTS)          AS TOTAL_EVENTS,
+            SUM(MESSAGE_COUNT)         AS MESSAGE_COUNT,
+            SUM(SESSION_COUNT)         AS SESSION_COUNT,
+            SUM(TOOL_EXECUTION_COUNT)  AS TOOL_EXECUTION_COUNT,
+            SUM(MCP_COUNT)             AS MCP_COUNT,
+            SUM(SUBAGENT_COUNT)        AS SUBAGENT_COUNT,
+            SUM(COMMAND_COUNT)         AS COMMAND_COUNT,
+            SUM(SKILL_COUNT)           AS SKILL_COUNT,
+            SUM(LIMIT_HIT_COUNT)       AS LIMIT_HIT_COUNT,
+            MAX(LAST_ACTIVE_AT)        AS LAST_ACTIVE_AT
+        FROM CLAUDE_USAGE_DB.LAYER3.SUMMARY_GRAIN
+        GROUP BY SUMMARY_DATE, USER_ID, TEAM_ID
+    ) AS src
+    ON  tgt.SUMMARY_DATE = src.SUMMARY_DATE
+    AND tgt.USER_ID      = src.USER_ID
+    AND tgt.TEAM_ID      = src.TEAM_ID
+    WHEN MATCHED THEN UPDATE SET
+        TOTAL_EVENTS         = src.TOTAL_EVENTS,
+        MESSAGE_COUNT        = src.MESSAGE_COUNT,
+        SESSION_COUNT        = src.SESSION_COUNT,
+        TOOL_EXECUTION_COUNT = src.TOOL_EXECUTION_COUNT,
+        MCP_COUNT            = src.MCP_COUNT,
+        SUBAGENT_COUNT       = src.SUBAGENT_COUNT,
+        COMMAND_COUNT        = src.COMMAND_COUNT,
+        SKILL_COUNT          = src.SKILL_COUNT,
+        LIMIT_HIT_COUNT      = src.LIMIT_HIT_COUNT,
+        LAST_ACTIVE_AT       = src.LAST_ACTIVE_AT,
+        UPDATED_AT           = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED THEN INSERT (
+        SUMMARY_DATE, USER_ID, TEAM_ID, TOTAL_EVENTS, MESSAGE_COUNT,
+        SESSION_COUNT, TOOL_EXECUTION_COUNT, MCP_COUNT, SUBAGENT_COUNT,
+        COMMAND_COUNT, SKILL_COUNT, LIMIT_HIT_COUNT, LAST_ACTIVE_AT
+    ) VALUES (
+        src.SUMMARY_DATE, src.USER_ID, src.TEAM_ID, src.TOTAL_EVENTS, src.MESSAGE_COUNT,
+        src.SESSION_COUNT, src.TOOL_EXECUTION_COUNT, src.MCP_COUNT, src.SUBAGENT_COUNT,
+        src.COMMAND_COUNT, src.SKILL_COUNT, src.LIMIT_HIT_COUNT, src.LAST_ACTIVE_AT
+    );
+
+    MERGE INTO CLAUDE_USAGE_DB.LAYER3.TOOL_SUMMARY AS tgt
+    USING (
+        SELECT
+            SUMMARY_DATE,
+            TEAM_ID,
+            TOOL_NAME,
+            SUM(TOTAL_EVENTS)   AS EXECUTION_COUNT,
+            SUM(SUCCESS_COUNT)  AS SUCCESS_COUNT,
+            SUM(FAILURE_COUNT)  AS FAILURE_COUNT,
+            HLL_ACCUMULATE(USER_ID) AS USERS_HLL
+        FROM CLAUDE_USAGE_DB.LAYER3.SUMMARY_GRAIN
+        WHERE TOOL_NAME IS NOT NULL
+        GROUP BY SUMMARY_DATE, TEAM_ID, TOOL_NAME
+    ) AS src
+    ON  tgt.SUMMARY_DATE = src.SUMMARY_DATE
+    AND tgt.TEAM_ID      = src.TEAM_ID
+    AND tgt.TOOL_NAME    = src.TOOL_NAME
+    WHEN MATCHED THEN UPDATE SET
+        EXECUTION_COUNT = src.EXECUTION_COUNT,
+        SUCCESS_COUNT   = src.SUCCESS_COUNT,
+        FAILURE_COUNT   = src.FAILURE_COUNT,
+        USERS_HLL       = src.USERS_HLL,
+        UPDATED_AT      = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED THEN INSERT (
+        SUMMARY_DATE, TEAM_ID, TOOL_NAME, EXECUTION_COUNT, SUCCESS_COUNT, FAILURE_COUNT, USERS_HLL
+    ) VALUES (
+        src.SUMMARY_DATE, src.TEAM_ID, src.TOOL_NAME,
+        src.EXECUTION_COUNT, src.SUCCESS_COUNT, src.FAILURE_COUNT, src.USERS_HLL
+    );
+
+    MERGE INTO CLAUDE_USAGE_DB.LAYER3.HOURLY_SUMMARY AS tgt
+    USING (
+        SELECT
+            SUMMARY_DATE,
+            HOUR_OF_DAY,
+            TEAM_ID,
+            SUM(TOTAL_EVENTS)          AS TOTAL_EVENTS,
+            SUM(MESSAGE_COUNT)         AS MESSAGE_COUNT,
+            SUM(TOOL_EXECUTION_COUNT)  AS TOOL_EXECUTION_COUNT,
+            SUM(LIMIT_HIT_COUNT)       AS LIMIT_HIT_COUNT,
+            COUNT(DISTINCT USER_ID)    AS ACTIVE_USERS
+        FROM CLAUDE_USAGE_DB.LAYER3.SUMMARY_GRAIN
+        GROUP BY SUMMARY_DATE, HOUR_OF_DAY, TEAM_ID
+    ) AS src
+    ON  tgt.SUMMARY_DATE = src.SUMMARY_DATE
+    AND tgt.HOUR_OF_DAY  = src.HOUR_OF_DAY
+    AND tgt.TEAM_ID      = src.TEAM_ID
+    WHEN MATCHED THEN UPDATE SET
+        TOTAL_EVENTS         = src.TOTAL_EVENTS,
+        MESSAGE_COUNT        = src.MESSAGE_COUNT,
+        TOOL_EXECUTION_COUNT = src.TOOL_EXECUTION_COUNT,
+        LIMIT_HIT_COUNT      = src.LIMIT_HIT_COUNT,
+        ACTIVE_USERS         = src.ACTIVE_USERS,
+        UPDATED_AT           = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED THEN INSERT (
+        SUMMARY_DATE, HOUR_OF_DAY, TEAM_ID, TOTAL_EVENTS, MESSAGE_COUNT,
+        TOOL_EXECUTION_COUNT, LIMIT_HIT_COUNT, ACTIVE_USERS
+    ) VALUES (
+        src.SUMMARY_DATE, src.HOUR_OF_DAY, src.TEAM_ID, src.TOTAL_EVENTS, src.MESSAGE_COUNT,
+        src.TOOL_EXECUTION_COUNT, src.LIMIT_HIT_COUNT, src.ACTIVE_USERS
+    );
+
+    MERGE INTO CLAUDE_USAGE_DB.LAYER3.PROJECT_SUMMARY AS tgt
+    USING (
+        SELECT
+            SUMMARY_DATE,
+            TEAM_ID,
+            PROJECT_NAME,
+            SUM(TOTAL_EVENTS)          AS TOTAL_EVENTS,
+            SUM(MESSAGE_COUNT)         AS MESSAGE_COUNT,
+            SUM(SESSION_COUNT)         AS SESSION_COUNT,
+            SUM(TOOL_EXECUTION_COUNT)  AS TOOL_EXECUTION_COUNT,
+            SUM(SUCCESS_COUNT)         AS SUCCESS_COUNT,
+            SUM(FAILURE_COUNT)         AS FAILURE_COUNT,
+            SUM(SKILL_COUNT)           AS SKILL_COUNT,
+            SUM(MCP_COUNT)             AS MCP_COUNT,
+            COUNT(DISTINCT USER_ID)    AS ACTIVE_USERS,
+            HLL_ACCUMULATE(USER_ID)    AS USERS_HLL
+        FROM CLAUDE_USAGE_DB.LAYER3.SUMMARY_GRAIN
+        GROUP BY SUMMARY_DATE, TEAM_ID, PROJECT_NAME
+    ) AS src
+    ON  tgt.SUMMARY_DATE = src.SUMMARY_DATE
+    AND tgt.TEAM_ID      = src.TEAM_ID
+    AND tgt.PROJECT_NAME = src.PROJECT_NAME
+    WHEN MATCHED THEN UPDATE SET
+        TOTAL_EVENTS         = src.TOTAL_EVENTS,
+        MESSAGE_COUNT        = src.MESSAGE_COUNT,
+        SESSION_COUNT        = src.SESSION_COUNT,
+        TOOL_EXECUTION_COUNT = src.TOOL_EXECUTION_COUNT,
+        SUCCESS_COUNT        = src.SUCCESS_COUNT,
+        FAILURE_COUNT        = src.FAILURE_COUNT,
+        SKILL_COUNT          = src.SKILL_COUNT,
+        MCP_COUNT            = src.MCP_COUNT,
+        ACTIVE_USERS         = src.ACTIVE_USERS,
+        USERS_HLL            = src.USERS_HLL,
+        UPDATED_AT           = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED THEN INSERT (
+        SUMMARY_DATE, TEAM_ID, PROJECT_NAME, TOTAL_EVENTS, MESSAGE_COUNT, SESSION_COUNT,
+        TOOL_EXECUTION_COUNT, SUCCESS_COUNT, FAILURE_COUNT, SKILL_COUNT, MCP_COUNT, ACTIVE_USERS,
+        USERS_HLL
+    ) VALUES (
+        src.SUMMARY_DATE, src.TEAM_ID, src.PROJECT_NAME, src.TOTAL_EVENTS, src.MESSAGE_COUNT, src.SESSION_COUNT,
+        src.TOOL_EXECUTION_COUNT, src.SUCCESS_COUNT, src.FAILURE_COUNT, src.SKILL_COUNT, src.MCP_COUNT,
+        src.ACTIVE_USERS, src.USERS_HLL
+    );
+
+    MERGE INTO CLAUDE_USAGE_DB.LAYER3.USER_TOOL_SUMMARY AS tgt
+    USING (
+        SELECT
+            SUMMARY_DATE,
+            TEAM_ID,
+            USER_ID,
+            TOOL_NAME,
+            SUM(TOTAL_EVENTS)   AS EXECUTION_COUNT,
+            SUM(SUCCESS_COUNT)  AS SUCCESS_COUNT,
+            SUM(FAILURE_COUNT)  AS FAILURE_COUNT
+        FROM CLAUDE_USAGE_DB.LAYER3.SUMMARY_GRAIN
+        WHERE TOOL_NAME IS NOT NULL
+        GROUP BY SUMMARY_DATE, TEAM_ID, USER_ID, TOOL_NAME
+    ) AS src
+    ON  tgt.SUMMARY_DATE = src.SUMMARY_DATE
+    AND tgt.TEAM_ID      = src.TEAM_ID
+    AND tgt.USER_ID      = src.USER_ID
+    AND tgt.TOOL_NAME    = src.TOOL_NAME
+    WHEN MATCHED THEN UPDATE SET
+        EXECUTION_COUNT = src.EXECUTION_COUNT,
+        SUCCESS_COUNT   = src.SUCCESS_COUNT,
+        FAILURE_COUNT   = src.FAILURE_COUNT,
+        UPDATED_AT      = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED THEN INSERT (
+        SUMMARY_DATE, TEAM_ID, USER_ID, TOOL_NAME, EXECUTION_COUNT, SUCCESS_COUNT, FAILURE_COUNT
+    ) VALUES (
+        src.SUMMARY_DATE, src.TEAM_ID, src.USER_ID, src.TOOL_NAME,
+        src.EXECUTION_COUNT, src.SUCCESS_COUNT, src.FAILURE_COUNT
+    );
+
+    MERGE INTO CLAUDE_USAGE_DB.LAYER3.SESSION_SUMMARY AS tgt
+    USING (
+        WITH touched AS (
+            -- 前回の更新以降に LAYER2 に追加された行のセッション
+            SELECT DISTINCT TEAM_ID, SESSION_ID
+            FROM CLAUDE_USAGE_DB.LAYER2.EVENTS
+            WHERE RECEIVED_AT >= :refresh_from
+              AND SESSION_ID IS NOT NULL
+              AND SESSION_ID <> ''
+        )
+        SELECT
+            TEAM_ID,
+            SESSION_ID,
+            USER_ID,
+            MAX(PROJECT_NAME)                                      AS PROJECT_NAME,
+            MIN(EVENT_TIMESTAMP)                                   AS START_AT,
+            MAX(EVENT_TIMESTAMP)                                   AS END_AT,
+            DATEDIFF('minute', MIN(EVENT_TIMESTAMP), MAX(EVENT_TIMESTAMP)) AS DURATION_MIN,
+            COUNT(*)                                               AS EVENT_COUNT,
+            COUNT(CASE WHEN EVENT_TYPE = 'UserPromptSubmit' THEN 1 END) AS MESSAGE_COUNT,
+            COUNT(CASE WHEN TOOL_NAME IS NOT NULL           THEN 1 END) AS TOOL_EXECUTION_COUNT,
+            COUNT(CASE WHEN TOOL_SUCCESS = FALSE            THEN 1 END) AS TOOL_FAILURE_COUNT,
+            COUNT(CASE WHEN IS_USAGE_LIMIT = TRUE           THEN 1 END) AS LIMIT_HIT_COUNT,
+            MAX_BY(STOP_REASON, CASE WHEN STOP_REASON IS NOT NULL THEN EVENT_TIMESTAMP END) AS STOP_REASON,
+            MAX(CASE WHEN STOP_REASON = 'usage_limit' THEN 1 ELSE 0 END) = 1 AS IS_LIMIT_STOPPED
+        FROM CLAUDE_USAGE_DB.LAYER2.EVENTS
+        WHERE (TEAM_ID, SESSION_ID) IN (SELECT TEAM_ID, SESSION_ID FROM touched)
+        GROUP BY TEAM_ID, SESSION_ID, USER_ID
+    ) AS src
+    ON  tgt.TEAM_ID    = src.TEAM_ID
+    AND tgt.SESSION_ID = src.SESSION_ID
+    AND tgt.USER_ID    = src.USER_ID
+    WHEN MATCHED THEN UPDATE SET
+        PROJECT_NAME         = src.PROJECT_NAME,
+        START_AT             = src.START_AT,
+        END_AT               = src.END_AT,
+        DURATION_MIN         = src.DURATION_MIN,
+        EVENT_COUNT          = src.EVENT_COUNT,
+        MESSAGE_COUNT        = src.MESSAGE_COUNT,
+        TOOL_EXECUTION_COUNT = src.TOOL_EXECUTION_COUNT,
+        TOOL_FAILURE_COUNT   = src.TOOL_FAILURE_COUNT,
+        LIMIT_HIT_COUNT      = src.LIMIT_HIT_COUNT,
+        STOP_REASON          = src.STOP_REASON,
+        IS_LIMIT_STOPPED     = src.IS_LIMIT_STOPPED,
+        UPDATED_AT           = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED THEN INSERT (
+        TEAM_ID, SESSION_ID, USER_ID, PROJECT_NAME, START_AT, END_AT, DURATION_MIN,
+        EVENT_COUNT, MESSAGE_COUNT, TOOL_EXECUTION_COUNT, TOOL_FAILURE_COUNT,
+        LIMIT_HIT_COUNT, STOP_REASON, IS_LIMIT_STOPPED
+    ) VALUES (
+        src.TEAM_ID, src.SESSION_ID, src.USER_ID, src.PROJECT_NAME, src.START_AT, src.END_AT, src.DURATION_MIN,
+        src.EVENT_COUNT, src.MESSAGE_COUNT, src.TOOL_EXECUTION_COUNT, src.TOOL_FAILURE_COUNT,
+        src.LIMIT_HIT_COUNT, src.STOP_REASON, src.IS_LIMIT_STOPPED
+    );
+
+    UPDATE CLAUDE_USAGE_DB.LAYER3.SUMMARY_REFRESH_STATE
+    SET WATERMARK  = :refresh_started_at,
+        LOCKED_AT  = NULL,
+        UPDATED_AT = CURRENT_TIMESTAMP()
+    WHERE NAME = 'LAYER3';
+
+    COMMIT;
+
+    DELETE FROM CLAUDE_USAGE_DB.LAYER1.RAW_EVENTS
+    WHERE RECEIVED_AT < DATEADD('DAY', -14, CURRENT_TIMESTAMP()::TIMESTAMP_NTZ);
+
+    RETURN 'ok';
+EXCEPTION
+    WHEN OTHER THEN
+        -- LAYER3 の更新を取り消す（WATERMARK は進めず、次回同じ範囲を集計し直す）
+        ROLLBACK;
+        RAISE;
+END;
+$$;
+
+-- 子タスク → ルートタスクの順に再開する
+ALTER TASK CLAUDE_USAGE_DB.LAYER2.PIPELINE_MERGE_TASK RESUME;
+ALTER TASK CLAUDE_USAGE_DB.LAYER1.PIPELINE_COPY_TASK RESUME;
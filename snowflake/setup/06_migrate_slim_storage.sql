@@ -0,0 +1,220 @@
+-- ============================================================================
+-- Claude Code Usage Tracker - 既存環境のストレージ移行
+-- 対象: 01_create_tables.sql の旧定義（RAW_EVENTS の PRIMARY KEY (RAW_DATA)、
+--       LAYER2.EVENTS.RAW_DATA）で作成済みの環境
+--
+-- 変更内容:
+--   LAYER1.RAW_EVENTS : PRIMARY KEY (RAW_DATA) を削除し、SOURCE_ROW（ファイル内の行番号）を追加。
+--                       Time Travel を1日にし、LAYER2 取り込み済みの行は 14 日で削除する。
+--   LAYER2.EVENTS     : RAW_DATA 列を削除し、生データへのポインタ SOURCE_FILE / SOURCE_ROW を追加。
+--                       （列の削除だけでは領域が解放されないため、全行を書き直す）
+--   LAYER1.RAW_EVENTS_STREAM : 無ければ作成する（STEP 3）
+--
+-- 生データの原本はステージのファイルに残るため、この移行でイベントは失われない。
+-- 実行前後に STEP 0 / STEP 5 のサイズレポートを実行し、結果を比較すること
+-- （uv run snowflake-upload/upload_to_snowflake.py --action storage-report でも同じ内容を表示）。
+--
+-- 実行ロール: テーブルの所有ロール（ACCOUNTADMIN など）
+-- 実行中はアップロードとタスクを止めておく:
+--   ALTER TASK IF EXISTS CLAUDE_USAGE_DB.LAYER1.PIPELINE_COPY_TASK SUSPEND;
+-- ============================================================================
+
+USE WAREHOUSE CLAUDE_USAGE_WH;
+
+-- ============================================================================
+-- STEP 0: 移行前のサイズ
+-- ============================================================================
+SELECT
+    TABLE_SCHEMA,
+    TABLE_NAME,
+    DELETED,
+    ROUND(ACTIVE_BYTES              / POWER(1024, 2), 2) AS ACTIVE_MB,
+    ROUND(TIME_TRAVEL_BYTES         / POWER(1024, 2), 2) AS TIME_TRAVEL_MB,
+    ROUND(FAILSAFE_BYTES            / POWER(1024, 2), 2) AS FAILSAFE_MB,
+    ROUND(RETAINED_FOR_CLONE_BYTES  / POWER(1024, 2), 2) AS CLONE_MB
+FROM CLAUDE_USAGE_DB.INFORMATION_SCHEMA.TABLE_STORAGE_METRICS
+WHERE TABLE_SCHEMA IN ('LAYER1', 'LAYER2', 'LAYER3')
+ORDER BY TABLE_SCHEMA, TABLE_NAME, DELETED;
+
+-- ============================================================================
+-- STEP 1: LAYER1.RAW_EVENTS
+-- （テーブルを作り直さないため、既存の RAW_EVENTS_STREAM があればそのまま使える）
+-- ============================================================================
+USE SCHEMA CLAUDE_USAGE_DB.LAYER1;
+
+ALTER TABLE RAW_EVENTS DROP PRIMARY KEY;
+ALTER TABLE RAW_EVENTS ADD COLUMN IF NOT EXISTS SOURCE_ROW INTEGER;
+ALTER TABLE RAW_EVENTS SET DATA_RETENTION_TIME_IN_DAYS = 1;
+
+-- ============================================================================
+-- STEP 2: LAYER2.EVENTS を RAW_DATA なしで書き直す
+--
+-- 列の削除だけでは領域が解放されないため、作業用テーブルに写してから INSERT OVERWRITE で全行を書き直す。
+-- EVENTS 自体は作り直さない（入れ替えない）ので、どのロールに付けた権限もそのまま残る。
+-- ============================================================================
+USE SCHEMA CLAUDE_USAGE_DB.LAYER2;
+
+CREATE OR REPLACE TRANSIENT TABLE EVENTS_SLIM (
+    EVENT_HASH       VARCHAR(64)   NOT NULL,
+    EVENT_TYPE       VARCHAR(50)   NOT NULL,
+    EVENT_TIMESTAMP  TIMESTAMP_NTZ NOT NULL,
+    RECEIVED_AT      TIMESTAMP_NTZ,
+    USER_ID          VARCHAR(255)  NOT NULL,
+    TEAM_ID          VARCHAR(100),
+    SESSION_ID       VARCHAR(100),
+    PROJECT_NAME     VARCHAR(255),
+    TOOL_NAME        VARCHAR(100),
+    TOOL_SUCCESS     BOOLEAN,
+    OUTPUT_LENGTH    INTEGER,
+    ERROR_MESSAGE    VARCHAR(16777216),
+    PROMPT_LENGTH    INTEGER,
+    IS_SKILL         BOOLEAN,
+    IS_SUBAGENT      BOOLEAN,
+    IS_MCP           BOOLEAN,
+    IS_COMMAND       BOOLEAN,
+    IS_FILE_OPERATION BOOLEAN,
+    IS_USAGE_LIMIT   BOOLEAN,
+    STOP_REASON      VARCHAR(50),
+    SOURCE_FILE      VARCHAR(255),
+    SOURCE_ROW       INTEGER
+)
+DATA_RETENTION_TIME_IN_DAYS = 0;
+
+-- 既存行のポインタは RAW_EVENTS に残っている行からだけ引ける（行番号は旧データに無いため NULL）
+INSERT INTO EVENTS_SLIM
+SELECT
+    e.EVENT_HASH, e.EVENT_TYPE, e.EVENT_TIMESTAMP, e.RECEIVED_AT,
+    e.USER_ID, e.TEAM_ID, e.SESSION_ID, e.PROJECT_NAME,
+    e.TOOL_NAME, e.TOOL_SUCCESS, e.OUTPUT_LENGTH, e.ERROR_MESSAGE, e.PROMPT_LENGTH,
+    e.IS_SKILL, e.IS_SUBAGENT, e.IS_MCP, e.IS_COMMAND, e.IS_FILE_OPERATION,
+    e.IS_USAGE_LIMIT, e.STOP_REASON,
+    r.SOURCE_FILE,
+    r.SOURCE_ROW
+FROM EVENTS e
+LEFT JOIN (
+    SELECT
+        COALESCE(RAW_DATA:event_id::VARCHAR, SHA2(RAW_DATA::VARCHAR)) AS EVENT_HASH,
+        SOURCE_FILE,
+        SOURCE_ROW
+    FROM CLAUDE_USAGE_DB.LAYER1.RAW_EVENTS
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY EVENT_HASH ORDER BY RECEIVED_AT) = 1
+) r
+    ON r.EVENT_HASH = e.EVENT_HASH;
+
+-- 件数が一致することを確認してから書き直す
+SELECT
+    (SELECT COUNT(*) FROM EVENTS)      AS EVENTS_ROWS,
+    (SELECT COUNT(*) FROM EVENTS_SLIM) AS EVENTS_SLIM_ROWS;
+
+ALTER TABLE EVENTS DROP COLUMN IF EXISTS RAW_DATA;
+ALTER TABLE EVENTS ADD COLUMN IF NOT EXISTS SOURCE_FILE VARCHAR(255);
+ALTER TABLE EVENTS ADD COLUMN IF NOT EXISTS SOURCE_ROW INTEGER;
+
+-- 旧マイクロパーティション（RAW_DATA 付き）は Time Travel / Fail-safe の期間後に解放される
+INSERT OVERWRITE INTO EVENTS (
+    EVENT_HASH, EVENT_TYPE, EVENT_TIMESTAMP, RECEIVED_AT,
+    USER_ID, TEAM_ID, SESSION_ID, PROJECT_NAME,
+    TOOL_NAME, TOOL_SUCCESS, OUTPUT_LENGTH, ERROR_MESSAGE, PROMPT_LENGTH,
+    IS_SKILL, IS_SUBAGENT, IS_MCP, IS_COMMAND, IS_FILE_OPERATION,
+    IS_USAGE_LIMIT, STOP_REASON, SOURCE_FILE, SOURCE_ROW
+)
+SELECT
+    EVENT_HASH, EVENT_TYPE, EVENT_TIMESTAMP, RECEIVED_AT,
+    USER_ID, TEAM_ID, SESSION_ID, PROJECT_NAME,
+    TOOL_NAME, TOOL_SUCCESS, OUTPUT_LENGTH, ERROR_MESSAGE, PROMPT_LENGTH,
+    IS_SKILL, IS_SUBAGENT, IS_MCP, IS_COMMAND, IS_FILE_OPERATION,
+    IS_USAGE_LIMIT, STOP_REASON, SOURCE_FILE, SOURCE_ROW
+FROM EVENTS_SLIM;
+
+DROP TABLE EVENTS_SLIM;
+
+-- ============================================================================
+-- STEP 3: 未取り込みの行を LAYER2 に取り込む
+--
+-- STEP 1・2 で新しい列ができてから、02_load_data.sql STEP 2 と同じ MERGE を RAW_EVENTS 全体に対して実行する
+-- （02_load_data.sql 末尾の「ストリームの作り直しと全件 MERGE」と同じ手順）。
+-- 旧環境にはストリームが無いことがあるため、先にストリームを作り直す（既存のストリームの権限は COPY GRANTS で引き継ぐ）。
+-- 作成後に COPY された行は次回の差分に含まれ、全件 MERGE と重なった分は NOT MATCHED で除外される。
+-- ============================================================================
+CREATE OR REPLACE STREAM CLAUDE_USAGE_DB.LAYER1.RAW_EVENTS_STREAM
+    COPY GRANTS
+    ON TABLE CLAUDE_USAGE_DB.LAYER1.RAW_EVENTS
+    APPEND_ONLY = TRUE;
+
+-- ストリームが無かった環境向け（ADMIN_GUIDE.md「ロールの作成」と同じ）
+GRANT SELECT ON STREAM CLAUDE_USAGE_DB.LAYER1.RAW_EVENTS_STREAM
+    TO ROLE CLAUDE_USAGE_UPLOADER;
+
+MERGE INTO CLAUDE_USAGE_DB.LAYER2.EVENTS AS tgt
+USING (
+    SELECT
+        COALESCE(RAW_DATA:event_id::VARCHAR, SHA2(RAW_DATA::VARCHAR)) AS EVENT_HASH,
+        RAW_DATA:event_type::VARCHAR                                  AS EVENT_TYPE,
+        CONVERT_TIMEZONE('UTC', 'Asia/Tokyo',
+            TRY_TO_TIMESTAMP_NTZ(RAW_DATA:timestamp::VARCHAR))        AS EVENT_TIMESTAMP,
+        RAW_DATA:user_id::VARCHAR                                     AS USER_ID,
+        COALESCE(RAW_DATA:team_id::VARCHAR, 'default-team')           AS TEAM_ID,
+        RAW_DATA:session_id::VARCHAR                                  AS SESSION_ID,
+        RAW_DATA:project::VARCHAR                                     AS PROJECT_NAME,
+        RAW_DATA:tool_name::VARCHAR                                   AS TOOL_NAME,
+        RAW_DATA:success::BOOLEAN                                     AS TOOL_SUCCESS,
+        RAW_DATA:output_length::INTEGER                               AS OUTPUT_LENGTH,
+        RAW_DATA:error::VARCHAR                                       AS ERROR_MESSAGE,
+        RAW_DATA:prompt_length::INTEGER                               AS PROMPT_LENGTH,
+        COALESCE(RAW_DATA:categories:skill::BOOLEAN,          FALSE)  AS IS_SKILL,
+        COALESCE(RAW_DATA:categories:subagent::BOOLEAN,       FALSE)  AS IS_SUBAGENT,
+        COALESCE(RAW_DATA:categories:mcp::BOOLEAN,            FALSE)  AS IS_MCP,
+        COALESCE(RAW_DATA:categories:command::BOOLEAN,        FALSE)  AS IS_COMMAND,
+        COALESCE(RAW_DATA:categories:file_operation::BOOLEAN, FALSE)  AS IS_FILE_OPERATION,
+        COALESCE(RAW_DATA:is_usage_limit::BOOLEAN,            FALSE)  AS IS_USAGE_LIMIT,
+        RAW_DATA:stop_reason::VARCHAR                                 AS STOP_REASON,
+        SOURCE_FILE                                                   AS SOURCE_FILE,
+        SOURCE_ROW                                                    AS SOURCE_ROW
+    FROM CLAUDE_USAGE_DB.LAYER1.RAW_EVENTS
+    WHERE RAW_DATA:event_type IS NOT NULL
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY EVENT_HASH ORDER BY RECEIVED_AT) = 1
+) AS src
+ON tgt.EVENT_HASH = src.EVENT_HASH
+WHEN NOT MATCHED THEN INSERT (
+    EVENT_HASH, EVENT_TYPE, EVENT_TIMESTAMP, USER_ID, TEAM_ID,
+    SESSION_ID, PROJECT_NAME, TOOL_NAME, TOOL_SUCCESS, OUTPUT_LENGTH,
+    ERROR_MESSAGE, PROMPT_LENGTH, IS_SKILL, IS_SUBAGENT, IS_MCP,
+    IS_COMMAND, IS_FILE_OPERATION, IS_USAGE_LIMIT, STOP_REASON, SOURCE_FILE, SOURCE_ROW
+) VALUES (
+    src.EVENT_HASH, src.EVENT_TYPE, src.EVENT_TIMESTAMP, src.USER_ID, src.TEAM_ID,
+    src.SESSION_ID, src.PROJECT_NAME, src.TOOL_NAME, src.TOOL_SUCCESS, src.OUTPUT_LENGTH,
+    src.ERROR_MESSAGE, src.PROMPT_LENGTH, src.IS_SKILL, src.IS_SUBAGENT, src.IS_MCP,
+    src.IS_COMMAND, src.IS_FILE_OPERATION, src.IS_USAGE_LIMIT, src.STOP_REASON,
+    src.SOURCE_FILE, src.SOURCE_ROW
+);
+
+-- ============================================================================
+-- STEP 4: 保持期間を過ぎた RAW_EVENTS を削除（02_load_data.sql STEP 2-1 と同じ）
+-- ============================================================================
+-- STEP 3 の全件 MERGE の後なので、削除対象はすべて LAYER2 に取り込み済み
+DELETE FROM CLAUDE_USAGE_DB.LAYER1.RAW_EVENTS
+WHERE RECEIVED_AT < DATEADD('DAY', -14, CURRENT_TIMESTAMP()::TIMESTAMP_NTZ);
+
+GRANT DELETE ON TABLE CLAUDE_USAGE_DB.LAYER1.RAW_EVENTS
+    TO ROLE CLAUDE_USAGE_UPLOADER;
+
+-- サーバー側タスクを使っている場合は 05_create_tasks.sql を実行し直す（タスクも再開される）
+
+-- ============================================================================
+-- STEP 5: 移行後のサイズ
+--
+-- ACTIVE_MB は直後に減る。削除・置き換えた分は DELETED = TRUE の行や
+-- TIME_TRAVEL_MB / FAILSAFE_MB に移り、保持期間（Time Travel + Fail-safe 7日）の後に解放される。
+-- TABLE_STORAGE_METRICS の反映には最大で数時間かかることがある。
+-- ============================================================================
+SELECT
+    TABLE_SCHEMA,
+    TABLE_NAME,
+    DELETED,
+    ROUND(ACTIVE_BYTES              / POWER(1024, 2), 2) AS ACTIVE_MB,
+    ROUND(TIME_TRAVEL_BYTES         / POWER(1024, 2), 2) AS TIME_TRAVEL_MB,
+    ROUND(FAILSAFE_BYTES            / POWER(1024, 2), 2) AS FAILSAFE_MB,
+    ROUND(RETAINED_FOR_CLONE_BYTES  / POWER(1024, 2), 2) AS CLONE_MB
+FROM CLAUDE_USAGE_DB.INFORMATION_SCHEMA.TABLE_STORAGE_METRICS
+WHERE TABLE_SCHEMA IN ('LAYER1', 'LAYER2', 'LAYER3')
+ORDER BY TABLE_SCHEMA, TABLE_NAME, DELETED;